@@ -12,27 +12,71 @@ import bootstrap  # noqa
 import argparse
 
 from performance import prod_config
-from performance.reports.rp import generate_weekly_report_for_date
-
-from performance.reports.rp import test_upload
 
 
 def load_args_from_command_line():
     parser = argparse.ArgumentParser(description=__doc__)
 
     parser.add_argument('--report_start_date', help='expected format: YYYY-MM-DD', required=True)
+    parser.add_argument('--report_end_date',
+                        help='expected format: YYYY-MM-DD. Also generate reports for every following week up to this '
+                             'date, processing weeks in parallel')
     parser.add_argument('--report_output_path', help='relative path to output report CSV',
                         default=('%s' % prod_config.DEFAULT_OUTPUT_PATH))
     parser.add_argument('--test-upload-to-gsheets-key',
                         help='Set a sheet key to test uploading to GSheets only: dummy data will be used.')
-    return parser.parse_args()
+    parser.add_argument('--granularity', choices=['week', 'day'], default='week',
+                        help='Report on each week, or on each day of the weeks (exported to CSV only)')
+    parser.add_argument('--bypass_piwik_cache', action='store_true',
+                        help='Fetch all Piwik data afresh instead of using cached responses')
+    parser.add_argument('--force_regenerate', action='store_true',
+                        help='Regenerate weekly reports for every RP, even if none of their inputs have changed')
+    piwik_transport = parser.add_mutually_exclusive_group()
+    piwik_transport.add_argument('--record_piwik', metavar='PATH',
+                                 help='Record every Piwik query and response to this file, to be replayed later')
+    piwik_transport.add_argument('--replay_piwik', metavar='PATH',
+                                 help='Answer Piwik queries from a file recorded with --record_piwik, offline')
+    args = parser.parse_args()
+    # Dates in the expected format compare in the same order as strings
+    if args.report_end_date and args.report_end_date < args.report_start_date:
+        parser.error('--report_end_date must not be before --report_start_date')
+    return args
 
 
 if __name__ == '__main__':
     args = load_args_from_command_line()
+    # Imported once the arguments have been parsed, as pandas and the AWS, Google and Piwik clients take a while to load
+    from performance import piwik
+    from performance.reports.rp import (
+        generate_weekly_report_for_date, generate_weekly_reports_for_date_range, generate_daily_report_for_date,
+        generate_daily_reports_for_date_range, test_upload,
+    )
+
+    if args.bypass_piwik_cache:
+        piwik.bypass_cache()
+    if args.record_piwik:
+        piwik.record_exchanges(args.record_piwik)
+    if args.replay_piwik:
+        piwik.replay_exchanges(args.replay_piwik)
+
+    try:
+        if args.test_upload_to_gsheets_key:
+            test_upload(args.test_upload_to_gsheets_key, args.report_start_date)
+
+        elif args.granularity == 'day' and args.report_end_date:
+            generate_daily_reports_for_date_range(args.report_start_date, args.report_end_date,
+                                                  args.report_output_path)
+
+        elif args.granularity == 'day':
+            generate_daily_report_for_date(args.report_start_date, args.report_output_path)
 
-    if args.test_upload_to_gsheets_key:
-        test_upload(args.test_upload_to_gsheets_key, args.report_start_date)
+        elif args.report_end_date:
+            generate_weekly_reports_for_date_range(args.report_start_date, args.report_end_date,
+                                                   args.report_output_path, args.force_regenerate)
 
-    else:
-        generate_weekly_report_for_date(args.report_start_date, args.report_output_path)
+        else:
+            generate_weekly_report_for_date(args.report_start_date, args.report_output_path, args.force_regenerate)
+    finally:
+        # Whatever was fetched before a failure is still worth replaying
+        if args.record_piwik:
+            piwik.save_recorded_exchanges()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the stages of the RP report on generated verifications_by_rp reports, and compare their timings and peak
+memory use against the stored baseline. Exits with status 1 if any of them has regressed.
+
+Usage:
+    python3 run_benchmarks.py --sizes 10k 1m
+"""
+
+import bootstrap  # noqa
+import argparse
+import json
+import os
+import sys
+
+# The benchmarks generate their own configuration, and must not use production credentials
+os.environ['ENV'] = 'test'
+
+from performance.benchmarks.suite import (  # noqa: E402
+    BASELINE_PATH, BENCHMARK_SIZES, MEMORY_ENVIRONMENT, find_regressions, get_environment_differences, load_baseline,
+    run_benchmarks, save_baseline,
+)
+from performance.config import BASE_DIR  # noqa: E402
+
+
+def load_args_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', choices=list(BENCHMARK_SIZES), default=['10k', '1m'],
+                        help='Numbers of rows of the generated reports to benchmark')
+    parser.add_argument('--work_dir', default=os.path.join(BASE_DIR, 'cache', 'benchmarks'),
+                        help='Directory for generated reports, which are kept to be reused')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline file to compare against')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='Record the results as the baseline for the sizes run, instead of comparing them')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Fraction by which a measurement can exceed the baseline before it counts as a regression')
+    parser.add_argument('--no_memory', action='store_true', help='Only measure timings, not peak memory use')
+    parser.add_argument('--ignore_environment', action='store_true',
+                        help='Compare against the baseline even if it was recorded in a different environment')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = load_args_from_command_line()
+    results = run_benchmarks(args.work_dir, args.sizes, measure_memory=not args.no_memory)
+    print(json.dumps(results, indent=2))
+
+    if args.save_baseline:
+        save_baseline(results, args.baseline)
+        print(f'Baseline saved to {args.baseline}')
+        sys.exit(0)
+
+    baseline = load_baseline(args.baseline)
+    if not baseline['results']:
+        print(f'No baseline in {args.baseline} to compare against; record one on this machine with --save_baseline')
+        sys.exit(0)
+    environment_differences = get_environment_differences(baseline['environment'])
+    for difference in environment_differences:
+        print(f'Environment differs from the baseline: {difference}')
+    compare_timings = args.ignore_environment or not environment_differences
+    compare_memory = args.ignore_environment or not get_environment_differences(
+        baseline['environment'], names=MEMORY_ENVIRONMENT)
+    if not compare_timings:
+        print(f"Not comparing timings{'' if compare_memory else ' or peak memory use'}, as the baseline was recorded "
+              f'in a different environment; record a baseline on this machine with --save_baseline first')
+
+    regressions = find_regressions(results, baseline, args.tolerance, compare_timings, compare_memory)
+    for regression in regressions:
+        print(f'Regression: {regression}')
+    sys.exit(1 if regressions else 0)
@@ -1,30 +1,37 @@
 #!/usr/bin/env python3
 
 """
-Upload a file to S3.
+Upload a file, or every changed file in a directory, to S3.
 
 Usage:
-    python3 upload.py <file-name>
+    python3 upload.py [--include_internal] <file-or-directory-name>
 """
 
 import bootstrap  # noqa
 import argparse
+import os
 from performance.env import check_get_env
-from performance import aws
+from performance import aws, prod_config as config
 from performance.uploader import Uploader
 
 RP_REPORT_OUTPUT_BUCKET = check_get_env('RP_REPORT_OUTPUT_BUCKET')
 
 
-def main(file_name):
+def main(file_name, include_internal=False):
     resource = aws.get_s3_resource()
-    uploader = Uploader(resource)
-    uploader.upload(RP_REPORT_OUTPUT_BUCKET, file_name)
-    print('File uploaded successfully.')
+    uploader = Uploader(resource, aws.get_transfer_config(), config.S3_MAX_CONCURRENT_UPLOADS)
+    if os.path.isdir(file_name):
+        uploaded = uploader.upload_directory(RP_REPORT_OUTPUT_BUCKET, file_name, include_internal)
+        print(f'{len(uploaded)} changed files uploaded successfully.')
+    else:
+        uploader.upload(RP_REPORT_OUTPUT_BUCKET, file_name)
+        print('File uploaded successfully.')
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
-    parser.add_argument('filename', help='File to upload', type=str)
+    parser.add_argument('filename', help='File or directory to upload', type=str)
+    parser.add_argument('--include_internal', action='store_true',
+                        help='When uploading a directory, also upload the reports\' manifests and run reports')
     args = parser.parse_args()
-    main(args.filename)
+    main(args.filename, args.include_internal)
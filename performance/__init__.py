@@ -1,7 +1,5 @@
 import os
-from performance.config import Config, TestConfig
+from performance.config import Config, LazyConfig, TestConfig
 
-if os.getenv('ENV') == 'test':
-    prod_config = TestConfig()
-else:
-    prod_config = Config()
+# Built on first use, so that importing the package doesn't need the configuration files
+prod_config = LazyConfig(TestConfig if os.getenv('ENV') == 'test' else Config)
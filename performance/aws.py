@@ -1,19 +1,229 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+
 import boto3
+from boto3.s3.transfer import TransferConfig
+
+from performance import metrics
+from performance import prod_config as config
+
+_session = None
+_s3_client = None
+_session_lock = threading.Lock()
+# Process the session and client belong to
+_session_pid = os.getpid()
+
+
+def _reset_session_after_fork():
+    """
+    boto3 sessions and clients aren't fork safe, so a process forked from this one, such as a ProcessPoolExecutor
+    worker, creates its own rather than using the ones it inherited
+    """
+    global _session, _s3_client, _session_lock, _session_pid
+    if _session_pid != os.getpid():
+        _session = None
+        _s3_client = None
+        # The inherited lock may have been held by a thread which doesn't exist in this process
+        _session_lock = threading.Lock()
+        _session_pid = os.getpid()
 
 
 def get_aws_session():
-    return boto3.Session()
+    """
+    Return the session shared by every S3 call, so credentials (and an assumed role) are only resolved once
+    """
+    global _session
+    _reset_session_after_fork()
+    with _session_lock:
+        if _session is None:
+            _session = boto3.Session()
+        return _session
 
 
 def get_s3_resource():
     session = get_aws_session()
-    return session.resource('s3')
+    # Sessions aren't thread safe, but the resources and clients they create are once created
+    with _session_lock:
+        return session.resource('s3')
+
+
+def get_s3_client():
+    global _s3_client
+    session = get_aws_session()
+    with _session_lock:
+        if _s3_client is None:
+            _s3_client = session.client('s3')
+        return _s3_client
 
 
 def get_s3_bucket(bucket_name):
     return get_s3_resource().Bucket(bucket_name)
 
 
+def get_transfer_config():
+    return TransferConfig(
+        multipart_threshold=config.S3_MULTIPART_THRESHOLD,
+        multipart_chunksize=config.S3_MULTIPART_CHUNKSIZE,
+        max_concurrency=config.S3_MAX_CONCURRENCY,
+    )
+
+
+def get_etag_path(destination):
+    return destination + '.etag'
+
+
+def get_local_etag(destination):
+    """
+    :return: dict with the 'etag' and 'size' of the S3 object `destination` was downloaded from, or None if it wasn't
+        downloaded by `get_report_file` or `SavingStreamingBody`
+    """
+    try:
+        with open(get_etag_path(destination)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_local_etag(destination, etag, size):
+    with open(get_etag_path(destination), 'w') as f:
+        json.dump({'etag': etag, 'size': size}, f)
+
+
+def get_file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def get_file_multipart_etag(path, part_size):
+    """
+    :return: the ETag S3 gives an object uploaded from `path` in parts of `part_size` bytes: the MD5 of the parts'
+        MD5s followed by the number of parts
+    """
+    part_md5s = []
+    with open(path, 'rb') as f:
+        for part in iter(lambda: f.read(part_size), b''):
+            part_md5s.append(hashlib.md5(part).digest())
+    return f'{hashlib.md5(b"".join(part_md5s)).hexdigest()}-{len(part_md5s)}'
+
+
+def file_matches_etag(path, etag):
+    """
+    Check whether `path` holds the content of the S3 object with the given ETag. Multipart ETags can only be matched
+    if the object was uploaded in parts of `S3_MULTIPART_CHUNKSIZE` bytes.
+    """
+    etag = etag.strip('"')
+    if '-' in etag:
+        return get_file_multipart_etag(path, config.S3_MULTIPART_CHUNKSIZE) == etag
+    return get_file_md5(path) == etag
+
+
+def is_local_copy_current(destination, etag, size):
+    """
+    Check whether `destination` holds the S3 object with the given ETag and size
+    """
+    try:
+        if os.path.getsize(destination) != size:
+            return False
+    except OSError:
+        return False
+    local_etag = get_local_etag(destination)
+    if local_etag is not None:
+        return local_etag == {'etag': etag, 'size': size}
+    return file_matches_etag(destination, etag)
+
+
 def get_report_file(bucket_name, file_path, destination):
-    bucket = get_s3_bucket(bucket_name)
-    bucket.download_file(file_path, destination)
+    """
+    Download an S3 object to `destination` unless it already holds the same version of the object
+    :return: True if the object was downloaded
+    """
+    run_report = metrics.run_report()
+    s3_client = get_s3_client()
+    with run_report.time_request('s3.head_object'):
+        head = s3_client.head_object(Bucket=bucket_name, Key=file_path)
+    if is_local_copy_current(destination, head['ETag'], head['ContentLength']):
+        logging.info(f'Local copy of {file_path} is up to date')
+        run_report.increment('s3.downloads_skipped')
+        return False
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(destination), prefix='.', suffix='.partial',
+                                     delete=False) as f:
+        partial_path = f.name
+    try:
+        with run_report.time_request('s3.download_file'):
+            s3_client.download_file(bucket_name, file_path, partial_path, Config=get_transfer_config())
+        os.replace(partial_path, destination)
+    except Exception:
+        os.remove(partial_path)
+        raise
+    save_local_etag(destination, head['ETag'], head['ContentLength'])
+    run_report.increment('s3.downloads')
+    run_report.increment('s3.bytes_downloaded', head['ContentLength'])
+    return True
+
+
+class SavingStreamingBody(io.RawIOBase):
+    """
+    Binary file object reading an S3 object's body, which saves what's read to `destination` so the object can be
+    parsed while it downloads. `destination` is only replaced once the whole body has been read; closing the stream
+    before then discards what was saved.
+    """
+
+    def __init__(self, body, destination, etag, size):
+        super().__init__()
+        self._body = body
+        self._destination = destination
+        self._etag = etag
+        self._size = size
+        self._bytes_read = 0
+        self._file = tempfile.NamedTemporaryFile(dir=os.path.dirname(destination), prefix='.', suffix='.partial',
+                                                 delete=False)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._body.read(len(buffer))
+        if data:
+            self._file.write(data)
+            self._bytes_read += len(data)
+            buffer[:len(data)] = data
+        elif not self._file.closed:
+            self._save()
+        return len(data)
+
+    def _save(self):
+        self._file.close()
+        if self._bytes_read != self._size:
+            os.remove(self._file.name)
+            raise IOError(f'Read {self._bytes_read} of {self._size} bytes for {self._destination}')
+        os.replace(self._file.name, self._destination)
+        save_local_etag(self._destination, self._etag, self._size)
+        run_report = metrics.run_report()
+        run_report.increment('s3.downloads')
+        run_report.increment('s3.bytes_downloaded', self._size)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self._file.name)
+        self._body.close()
+        super().close()
+
+
+def open_report_stream(bucket_name, file_path, destination):
+    """
+    Open an S3 object for reading, saving it to `destination` as it's read
+    :return: SavingStreamingBody
+    """
+    with metrics.run_report().time_request('s3.get_object'):
+        response = get_s3_client().get_object(Bucket=bucket_name, Key=file_path)
+    return SavingStreamingBody(response['Body'], destination, response['ETag'], response['ContentLength'])
@@ -0,0 +1,81 @@
+"""
+Seeded generator of synthetic verifications_by_rp reports, for benchmarking the RP report
+"""
+
+import numpy
+import pandas
+
+VERIFICATIONS_BY_RP_COLUMNS = ['RP Entity Id', 'Timestamp', 'Response type', 'IDP Entity Id']
+DEFAULT_RESPONSE_TYPE_MIX = {'RETURNING': 0.6, 'NEW': 0.4}
+WEEK_MILLISECONDS = 7 * 24 * 60 * 60 * 1000
+
+
+def get_rp_entity_id(index):
+    return f'https://rp-{index}.benchmark.test.id'
+
+
+def get_rp_name(index):
+    return f'Benchmark RP {index}'
+
+
+def get_rp_mapping(rps):
+    return {get_rp_entity_id(index): get_rp_name(index) for index in range(rps)}
+
+
+def get_rp_information(rps):
+    return {
+        get_rp_name(index): {
+            'rp_name': get_rp_name(index),
+            'department': f'Benchmark dept {index}',
+            'service_description': f'Benchmark service {index}',
+            'loa': 'LOA_2',
+            'sheet_key': f'BENCHMARK{index}',
+        }
+        for index in range(rps)
+    }
+
+
+def get_skewed_weights(count):
+    """A few RPs and IdPs get most of the traffic, so weight the n-th of them by 1/n"""
+    weights = 1 / numpy.arange(1, count + 1)
+    return weights / weights.sum()
+
+
+def generate_verifications_by_rp(rows, rps=50, idps=8, response_type_mix=None, date_start='2018-07-02', seed=0):
+    """
+    Generate a verifications_by_rp report with verifications spread over the week starting `date_start`
+    :param rows: number of verifications
+    :param rps: number of RPs, named as in `get_rp_mapping`
+    :param idps: number of IdPs
+    :param response_type_mix: dict of the fraction of verifications with each response type
+    :param seed: seed for the random number generator, so that the same arguments generate the same report
+    :return: pandas.Dataframe with the columns of a verifications_by_rp report
+    """
+    response_type_mix = response_type_mix or DEFAULT_RESPONSE_TYPE_MIX
+    random_state = numpy.random.RandomState(seed)
+
+    rp_entity_ids = numpy.array([get_rp_entity_id(index) for index in range(rps)], dtype=object)
+    idp_entity_ids = numpy.array([f'https://idp-{index}.benchmark.test.id/SAML2/SSO' for index in range(idps)],
+                                 dtype=object)
+    response_types = numpy.array(list(response_type_mix), dtype=object)
+    response_type_weights = numpy.array(list(response_type_mix.values()), dtype='float64')
+
+    offsets = random_state.randint(0, WEEK_MILLISECONDS, size=rows).astype('timedelta64[ms]')
+    timestamps = numpy.datetime_as_string(numpy.datetime64(date_start, 'ms') + numpy.sort(offsets), unit='ms')
+    return pandas.DataFrame({
+        'RP Entity Id': rp_entity_ids[random_state.choice(rps, size=rows, p=get_skewed_weights(rps))],
+        'Timestamp': numpy.char.add(timestamps, 'Z').astype(object),
+        'Response type': response_types[random_state.choice(
+            len(response_types), size=rows, p=response_type_weights / response_type_weights.sum())],
+        'IDP Entity Id': idp_entity_ids[random_state.choice(idps, size=rows, p=get_skewed_weights(idps))],
+    }, columns=VERIFICATIONS_BY_RP_COLUMNS)
+
+
+def write_verifications_by_rp_csv(path, rows, chunk_rows=1000000, seed=0, **kwargs):
+    """
+    Write a generated verifications_by_rp report to `path`, generating it `chunk_rows` rows at a time so that
+    memory use doesn't grow with `rows`. Takes the same keyword arguments as `generate_verifications_by_rp`.
+    """
+    for chunk_index, chunk_start in enumerate(range(0, rows, chunk_rows)):
+        df_chunk = generate_verifications_by_rp(min(chunk_rows, rows - chunk_start), seed=seed + chunk_index, **kwargs)
+        df_chunk.to_csv(path, mode='w' if chunk_index == 0 else 'a', header=chunk_index == 0, index=False)
@@ -0,0 +1,340 @@
+"""
+Benchmarks of the stages of the RP report, run on generated verifications_by_rp reports of several sizes, with
+their timings and peak memory use compared against a stored baseline
+"""
+
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+import numpy
+import pandas
+
+import performance.billing as billing
+import performance.reports.rp as rp
+from performance import prod_config as config
+from performance.benchmarks.generator import get_rp_information, get_rp_mapping, write_verifications_by_rp_csv
+from performance.config import BASE_DIR, Config
+
+BENCHMARK_SIZES = OrderedDict([
+    ('10k', 10000),
+    ('1m', 1000000),
+    ('10m', 10000000),
+])
+BENCHMARK_RPS = 50
+BENCHMARK_DATE_START = '2018-07-02'
+# Timings and peak memory use depend on the machine and the versions of Python and the libraries, so each machine
+# records its own baseline
+BASELINE_PATH = os.path.join(BASE_DIR, 'cache', 'benchmarks', 'baseline.json')
+# Settings which affect performance are benchmarked with their production values
+BENCHMARKED_SETTINGS = ['VERIFICATIONS_CSV_CHUNKSIZE', 'CSV_EXPORT_MAX_WORKERS', 'REPORT_TIMEZONE']
+# Commands whose startup time is benchmarked, each in a new interpreter without the configuration files, which they
+# shouldn't need
+STARTUP_COMMANDS = OrderedDict([
+    ('import_performance', ['-c', 'import performance']),
+    ('generate_rp_report_help', [os.path.join(BASE_DIR, 'bin', 'generate_rp_report.py'), '--help']),
+])
+STARTUP_REPEAT = 5
+# Runs the command given by its arguments in the same way as the interpreter, then prints every module imported
+LIST_IMPORTS_SCRIPT = """
+import os, runpy, sys
+args = sys.argv[1:]
+try:
+    if args[0] == '-c':
+        sys.argv = ['-c'] + args[2:]
+        exec(args[1], {'__name__': '__main__'})
+    else:
+        sys.argv = args
+        sys.path[0] = os.path.dirname(os.path.abspath(args[0]))
+        runpy.run_path(args[0], run_name='__main__')
+except SystemExit:
+    pass
+print(' '.join(sorted(sys.modules)), file=sys.stderr)
+"""
+# Modules which take a while to import, so should only be imported once they're used rather than at startup
+SLOW_IMPORTS = ['pandas', 'numpy', 'boto3', 'pygsheets', 'oauth2client', 'googleapiclient', 'pytest']
+# Differences smaller than these are noise, however large they are relative to the baseline
+MIN_SECONDS_DIFFERENCE = 0.05
+MIN_PEAK_MEMORY_DIFFERENCE = 1024 * 1024
+# Parts of the environment peak memory use depends on, unlike timings which depend on all of it
+MEMORY_ENVIRONMENT = ['python', 'pandas', 'numpy']
+
+
+class NullWorksheet:
+    """Stands in for a pygsheets worksheet, so that exports to Google Sheets only measure their own work"""
+
+    def insert_cols(self, col, number=1, values=None):
+        pass
+
+    def update_col(self, index, values):
+        pass
+
+
+class NullPygsheetsClient:
+    def open_by_key(self, sheet_key):
+        return self
+
+    def worksheet_by_title(self, sheet_tab_name):
+        return NullWorksheet()
+
+
+@contextmanager
+def benchmark_config(work_dir):
+    """
+    Point the configuration at the generated data, and use production values for settings that affect performance
+    """
+    overrides = {name: getattr(Config, name) for name in BENCHMARKED_SETTINGS}
+    overrides.update({
+        'VERIFY_DATA_PIPELINE_CONFIG_PATH': work_dir,
+        'VERIFICATIONS_COLUMNAR_CACHE': False,
+        'rp_mapping': get_rp_mapping(BENCHMARK_RPS),
+        'rp_information': get_rp_information(BENCHMARK_RPS),
+        # Exports to Google Sheets shouldn't wait on the rate limiter, which isn't what's being measured
+        'GSHEETS_REQUESTS_PER_MINUTE_PER_USER': 10 ** 9,
+        'GSHEETS_REQUESTS_PER_MINUTE_PER_PROJECT': 10 ** 9,
+        'GSHEETS_RATE_LIMIT_BURST': 10 ** 9,
+    })
+    original = {name: getattr(config, name) for name in overrides}
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            setattr(config, name, value)
+
+
+def ensure_verifications_by_rp_csv(work_dir, rows):
+    """
+    Generate the report for a week in `work_dir` unless it's already there, as it takes a while for large sizes
+    """
+    date_end = billing.fromisoformat(BENCHMARK_DATE_START) + timedelta(days=6)
+    verifications_directory = os.path.join(work_dir, 'data', 'verifications')
+    path = os.path.join(verifications_directory, f'verifications_by_rp_{BENCHMARK_DATE_START}_{date_end}.csv')
+    rows_path = path + '.rows'
+    try:
+        with open(rows_path) as f:
+            if int(f.read()) == rows:
+                return path
+    except (OSError, ValueError):
+        pass
+
+    logging.info(f'Generating verifications_by_rp report with {rows} rows')
+    os.makedirs(verifications_directory, exist_ok=True)
+    write_verifications_by_rp_csv(path, rows, rps=BENCHMARK_RPS, date_start=BENCHMARK_DATE_START)
+    with open(rows_path, 'w') as f:
+        f.write(str(rows))
+    return path
+
+
+def get_fake_piwik_data(rps):
+    random_state = numpy.random.RandomState(0)
+    return [{column: int(random_state.randint(1000, 100000)) for column in rp.PIWIK_DATA_COLUMNS} for _ in rps]
+
+
+def get_pipeline_stages(report_output_path):
+    """
+    :return: list of (name, function) for each stage, where each function takes the previous stage's result
+    """
+    def augment(df_verifications_by_rp):
+        billing.augment_verifications_by_rp_with_rp_name(df_verifications_by_rp)
+        return df_verifications_by_rp
+
+    def transform(df_successes_rp):
+        df_all_rp = rp.get_df_for_all_rps(df_successes_rp)
+        rps = rp.get_rp_names_from_df(df_all_rp)
+        df_all = rp.merge_piwik_data(df_all_rp, rps, get_fake_piwik_data(rps))
+        rp.transform_metrics(df_all)
+        return df_all[rp.RP_REPORT_COLUMNS]
+
+    def export_csv(df_export):
+        rp.export_metrics_to_csv(df_export, report_output_path, BENCHMARK_DATE_START)
+        return df_export
+
+    def export_google_sheets(df_export):
+        exporter = rp.GoogleSheetsRelyingPartyReportExporter(config, NullPygsheetsClient())
+        exporter.export(df_export, BENCHMARK_DATE_START)
+        return df_export
+
+    return [
+        ('count_verifications_by_rp_csv_for_date',
+         lambda _: billing.count_verifications_by_rp_csv_for_date(BENCHMARK_DATE_START)),
+        ('extract_verifications_by_rp_csv_for_date',
+         lambda _: billing.extract_verifications_by_rp_csv_for_date(BENCHMARK_DATE_START)),
+        ('augment_verifications_by_rp_with_rp_name', augment),
+        ('get_df_successes_by_rp', rp.get_df_successes_by_rp),
+        ('transform_metrics', transform),
+        ('export_metrics_to_csv', export_csv),
+        ('export_metrics_to_google_sheets', export_google_sheets),
+    ]
+
+
+def run_stages(stages, measure_memory):
+    """
+    Run each stage on the result of the previous one
+    :return: dict of the seconds, or peak bytes allocated if `measure_memory` is set, taken by each stage
+    """
+    measurements = OrderedDict()
+    result = None
+    for name, stage in stages:
+        if measure_memory:
+            tracemalloc.start()
+            result = stage(result)
+            measurements[name] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            start = time.perf_counter()
+            result = stage(result)
+            measurements[name] = time.perf_counter() - start
+    return measurements
+
+
+def run_benchmark(work_dir, rows, measure_memory=True):
+    """
+    Time each pipeline stage on a generated report, then run them again to measure their peak memory use, as tracing
+    allocations slows them down
+    :return: dict of {'seconds': ..., 'peak_memory_bytes': ...} by stage
+    """
+    ensure_verifications_by_rp_csv(work_dir, rows)
+    stages = get_pipeline_stages(os.path.join(work_dir, 'output'))
+    with benchmark_config(work_dir):
+        seconds = run_stages(stages, measure_memory=False)
+        peak_memory = run_stages(stages, measure_memory=True) if measure_memory else {}
+    return OrderedDict(
+        (name, {'seconds': round(seconds[name], 4), 'peak_memory_bytes': peak_memory.get(name)}) for name in seconds)
+
+
+def run_startup_command(args, *options):
+    """
+    Run one of `STARTUP_COMMANDS` in a new interpreter, without the environment's configuration
+    :return: subprocess.CompletedProcess
+    """
+    env = {name: value for name, value in os.environ.items() if name != 'ENV'}
+    return subprocess.run([sys.executable, *options, *args], env=env, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+
+def get_startup_imports(args):
+    """
+    :return: set of the top level packages a startup command imports
+    """
+    # Runs the command as the interpreter would, then lists the modules it imported on the last line of stderr.
+    # `-X importtime` would do, but is only available from Python 3.7.
+    lines = run_startup_command(args, '-c', LIST_IMPORTS_SCRIPT).stderr.splitlines()
+    return {module.split('.')[0] for module in lines[-1].split()}
+
+
+def run_startup_benchmark(repeat=STARTUP_REPEAT):
+    """
+    Time each of `STARTUP_COMMANDS`, taking the fastest of `repeat` runs as the others are slowed by whatever else
+    the machine is doing
+    :return: results in the format of the baseline
+    """
+    results = OrderedDict()
+    for name, args in STARTUP_COMMANDS.items():
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run_startup_command(args)
+            timings.append(time.perf_counter() - start)
+        results[name] = {'seconds': round(min(timings), 4), 'peak_memory_bytes': None}
+    return results
+
+
+def run_benchmarks(work_dir, size_names, measure_memory=True):
+    """
+    :param size_names: names of `BENCHMARK_SIZES` to run
+    :return: results by size name, along with the startup times as 'startup', in the format of the baseline
+    """
+    logging.info('Running startup benchmarks')
+    results = OrderedDict([('startup', run_startup_benchmark())])
+    for size_name in size_names:
+        work_dir_for_size = os.path.join(work_dir, size_name)
+        logging.info(f'Running benchmarks for {size_name} rows')
+        results[size_name] = run_benchmark(work_dir_for_size, BENCHMARK_SIZES[size_name], measure_memory)
+    return results
+
+
+def get_environment():
+    return {
+        'python': platform.python_version(),
+        'pandas': pandas.__version__,
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'processor_count': os.cpu_count(),
+    }
+
+
+def get_environment_differences(baseline_environment, environment=None, names=None):
+    """
+    :param environment: the environment to compare, by default the current one
+    :param names: only compare these parts of the environment, e.g. `MEMORY_ENVIRONMENT`, rather than all of it
+    :return: list of messages describing how `environment` differs from the one the baseline was recorded in
+    """
+    environment = environment or get_environment()
+    if not baseline_environment:
+        return ['the baseline does not record the environment it was recorded in']
+    names = names or sorted(set(environment) | set(baseline_environment))
+    return [f'{name} is {environment.get(name)} rather than {baseline_environment.get(name)}'
+            for name in names if environment.get(name) != baseline_environment.get(name)]
+
+
+def load_baseline(path=BASELINE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'environment': None, 'results': {}}
+
+
+def save_baseline(results, path=BASELINE_PATH):
+    """
+    Record `results` in the baseline, keeping the baseline for any size that wasn't run
+    """
+    baseline = load_baseline(path)
+    if baseline['environment'] != get_environment():
+        # Results from another environment can't be compared with these
+        baseline['results'] = {}
+    baseline['environment'] = get_environment()
+    baseline['results'].update(results)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+        f.write('\n')
+
+
+def find_regressions(results, baseline, tolerance, compare_timings=True, compare_memory=True):
+    """
+    Measurements from a different environment than the baseline's, see `get_environment_differences`, can't be
+    compared with it
+    :param tolerance: fraction by which a measurement can exceed its baseline before it counts as a regression
+    :param compare_timings: whether to compare timings
+    :param compare_memory: whether to compare peak memory use
+    :return: list of messages describing each measurement that has regressed
+    """
+    measurements_compared = []
+    if compare_timings:
+        measurements_compared.append(('seconds', MIN_SECONDS_DIFFERENCE))
+    if compare_memory:
+        measurements_compared.append(('peak_memory_bytes', MIN_PEAK_MEMORY_DIFFERENCE))
+    regressions = []
+    for size_name, stages in results.items():
+        baseline_stages = baseline['results'].get(size_name, {})
+        for stage, measurements in stages.items():
+            for measurement, min_difference in measurements_compared:
+                value = measurements.get(measurement)
+                baseline_value = baseline_stages.get(stage, {}).get(measurement)
+                if value is None or baseline_value is None:
+                    continue
+                if value > baseline_value * (1 + tolerance) and value - baseline_value > min_difference:
+                    regressions.append(f'{size_name} {stage} {measurement}: {value} against a baseline of '
+                                       f'{baseline_value}')
+    return regressions
@@ -1,12 +1,34 @@
 import os
 import argparse
+import hashlib
+import json
 import logging
+from contextlib import contextmanager
 from datetime import timedelta, datetime
 
 import pandas
+import pyarrow
+import pyarrow.parquet
 
 from performance import prod_config as config
-from performance.aws import get_report_file
+from performance.aws import get_local_etag, get_report_file, open_report_stream
+
+VERIFICATIONS_BY_RP_DTYPES = {
+    'RP Entity Id': 'category',
+    'Timestamp': 'object',
+    'Response type': 'category',
+    'IDP Entity Id': 'category',
+}
+# The only columns needed to count successful verifications for each RP
+VERIFICATIONS_BY_RP_REPORT_COLUMNS = ['RP Entity Id', 'Response type']
+# Column of verification counts by day holding the day, as a timezone naive datetime at midnight
+VERIFICATION_DATE_COLUMN = 'Date'
+
+
+class UnknownRelyingPartyError(LookupError):
+    def __init__(self, entity_ids):
+        self.entity_ids = entity_ids
+        super().__init__(f"RP entity IDs missing from RP mappings: {', '.join(entity_ids)}")
 
 
 def fromisoformat(date_string):
@@ -17,42 +39,278 @@ def fromisoformat(date_string):
         raise argparse.ArgumentTypeError(msg)
 
 
-def extract_verifications_by_rp_csv_for_date(date_start):
+def get_verifications_by_rp_csv_location_for_date(date_start):
     """
-    Extract billing data from the weekly verifications_by_rp.csv report
     :param date_start: start date for the week
-    :return: pandas.Dataframe with non transformed data with matching columns to the original verifications_by_rp
+    :return: S3 key of the weekly verifications_by_rp.csv report and the path to its local copy
     """
     date_end = fromisoformat(date_start) + timedelta(days=6)
     file_name = f'verifications_by_rp_{date_start}_{date_end}.csv'
     verifications_directory = os.path.join(config.VERIFY_DATA_PIPELINE_CONFIG_PATH,
                                            'data',
                                            'verifications')
-    verifications_by_rp_csv_path = os.path.join(verifications_directory, file_name)
+    return os.path.join(config.S3_VERIFICATIONS_DIRECTORY, file_name), os.path.join(verifications_directory, file_name)
+
+
+def get_verifications_by_rp_csv_path_for_date(date_start, download=True):
+    """
+    Get the path to the weekly verifications_by_rp.csv report, downloading it first if there's no local copy.
+    A local copy that was downloaded from S3 is only downloaded again if the object in S3 has changed.
+    :param date_start: start date for the week
+    :param download: if False, don't download a missing report
+    :return: path to the local copy of the report
+    """
+    s3_path, verifications_by_rp_csv_path = get_verifications_by_rp_csv_location_for_date(date_start)
+    file_name = os.path.basename(verifications_by_rp_csv_path)
+    verifications_directory = os.path.dirname(verifications_by_rp_csv_path)
 
     if os.path.exists(verifications_by_rp_csv_path):
-        logging.info(f'Using local copy of {file_name}')
-    else:
+        if get_local_etag(verifications_by_rp_csv_path) is None:
+            logging.info(f'Using local copy of {file_name}')
+        else:
+            get_report_file(config.S3_BILLING_REPORTS_BUCKET, s3_path, verifications_by_rp_csv_path)
+    elif download:
         logging.info(f'Downloading verifications report: {file_name}')
         if not os.path.exists(verifications_directory):
             logging.info('Creating data/verifications directories')
-            os.makedirs(verifications_directory)
+            os.makedirs(verifications_directory, exist_ok=True)
+
+        get_report_file(config.S3_BILLING_REPORTS_BUCKET, s3_path, verifications_by_rp_csv_path)
+
+    return verifications_by_rp_csv_path
+
+
+@contextmanager
+def open_verifications_by_rp_csv_for_date(date_start):
+    """
+    Open the weekly verifications_by_rp.csv report for parsing. If there's no local copy and `S3_STREAM_REPORTS` is
+    set, the report is read straight from S3 and saved locally as it's read, rather than downloaded first.
+    :param date_start: start date for the week
+    :return: context manager giving the path to the local copy and the path or file object to parse
+    """
+    verifications_by_rp_csv_path = get_verifications_by_rp_csv_path_for_date(
+        date_start, download=not config.S3_STREAM_REPORTS)
+    if os.path.exists(verifications_by_rp_csv_path):
+        yield verifications_by_rp_csv_path, verifications_by_rp_csv_path
+        return
+
+    s3_path = get_verifications_by_rp_csv_location_for_date(date_start)[0]
+    logging.info(f'Streaming verifications report: {os.path.basename(verifications_by_rp_csv_path)}')
+    os.makedirs(os.path.dirname(verifications_by_rp_csv_path), exist_ok=True)
+    with open_report_stream(config.S3_BILLING_REPORTS_BUCKET, s3_path, verifications_by_rp_csv_path) as stream:
+        yield verifications_by_rp_csv_path, stream
+
+
+def read_verifications_by_rp_csv(verifications_by_rp_csv_path, columns=None, chunksize=None):
+    """
+    Read a verifications_by_rp.csv report with explicit column types
+    :param columns: only parse these columns, or all of them if None
+    :param chunksize: return an iterator over dataframes of this many rows instead of one dataframe
+    """
+    dtype = {column: dtype for column, dtype in VERIFICATIONS_BY_RP_DTYPES.items() if not columns or column in columns}
+    return pandas.read_csv(verifications_by_rp_csv_path, usecols=columns, dtype=dtype, chunksize=chunksize)
+
+
+def get_file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def get_columnar_copy_paths(verifications_by_rp_csv_path):
+    """
+    :return: paths to the Parquet copy of a verifications_by_rp.csv report and to the JSON file describing the
+        source file it was made from
+    """
+    columnar_copy_path = os.path.splitext(verifications_by_rp_csv_path)[0] + '.parquet'
+    return columnar_copy_path, columnar_copy_path + '.json'
+
+
+def read_columnar_copy(verifications_by_rp_csv_path, columns=None):
+    """
+    Read a verifications_by_rp.csv report from its columnar copy
+    :param columns: only read these columns, or all of them if None
+    :return: pandas.Dataframe, or None if there's no copy holding these columns which matches the report's size,
+        modification time or content
+    """
+    if not config.VERIFICATIONS_COLUMNAR_CACHE:
+        return None
+    columnar_copy_path, metadata_path = get_columnar_copy_paths(verifications_by_rp_csv_path)
+    try:
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if not set(columns or VERIFICATIONS_BY_RP_DTYPES).issubset(metadata['columns']):
+        return None
+    stat = os.stat(verifications_by_rp_csv_path)
+    if stat.st_size != metadata['size']:
+        return None
+    if stat.st_mtime != metadata['mtime']:
+        # The report may have been downloaded again; it's still valid if the content hasn't changed
+        if get_file_sha256(verifications_by_rp_csv_path) != metadata['sha256']:
+            return None
+        metadata['mtime'] = stat.st_mtime
+        with open(metadata_path, 'w') as f:
+            json.dump(metadata, f)
 
-        get_report_file(
-            config.S3_BILLING_REPORTS_BUCKET,
-            os.path.join(config.S3_VERIFICATIONS_DIRECTORY, file_name),
-            verifications_by_rp_csv_path
-        )
+    logging.info(f'Using columnar copy of {os.path.basename(verifications_by_rp_csv_path)}')
+    df_verifications_by_rp = pandas.read_parquet(columnar_copy_path, columns=columns)
+    return df_verifications_by_rp.astype({column: VERIFICATIONS_BY_RP_DTYPES[column]
+                                          for column in df_verifications_by_rp.columns})
 
-    df_verifications_by_rp = pandas.read_csv(verifications_by_rp_csv_path)
+
+class ColumnarCopyWriter:
+    """
+    Writes a Parquet copy of a verifications_by_rp.csv report one dataframe at a time, so that chunks of a report
+    can be saved as they are streamed. The copy only replaces any existing one once `close` is called.
+    """
+
+    def __init__(self, verifications_by_rp_csv_path, columns):
+        self._verifications_by_rp_csv_path = verifications_by_rp_csv_path
+        self._columns = columns
+        self._columnar_copy_path, self._metadata_path = get_columnar_copy_paths(verifications_by_rp_csv_path)
+        self._partial_path = self._columnar_copy_path + '.partial'
+        # Categories differ between chunks, so columns are stored as strings; Parquet dictionary encodes them
+        self._schema = pyarrow.schema([(column, pyarrow.string()) for column in columns])
+        self._writer = pyarrow.parquet.ParquetWriter(self._partial_path, self._schema)
+
+    def write(self, df_verifications_by_rp):
+        table = pyarrow.Table.from_pandas(df_verifications_by_rp[self._columns].astype('object'),
+                                          schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
+        os.replace(self._partial_path, self._columnar_copy_path)
+        stat = os.stat(self._verifications_by_rp_csv_path)
+        with open(self._metadata_path, 'w') as f:
+            json.dump({
+                'columns': self._columns,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': get_file_sha256(self._verifications_by_rp_csv_path),
+            }, f)
+
+    def abort(self):
+        self._writer.close()
+        os.remove(self._partial_path)
+
+
+def create_columnar_copy_writer(verifications_by_rp_csv_path, columns=None):
+    if not config.VERIFICATIONS_COLUMNAR_CACHE:
+        return None
+    return ColumnarCopyWriter(verifications_by_rp_csv_path, columns or list(VERIFICATIONS_BY_RP_DTYPES))
+
+
+def extract_verifications_by_rp_csv_for_date(date_start, columns=None):
+    """
+    Extract billing data from the weekly verifications_by_rp.csv report, preferring its columnar copy and making
+    one if there isn't a valid copy already
+    :param date_start: start date for the week
+    :param columns: only extract these columns, or all of them if None
+    :return: pandas.Dataframe with non transformed data with matching columns to the original verifications_by_rp
+    """
+    with open_verifications_by_rp_csv_for_date(date_start) as (verifications_by_rp_csv_path, source):
+        if source == verifications_by_rp_csv_path:
+            df_verifications_by_rp = read_columnar_copy(verifications_by_rp_csv_path, columns)
+            if df_verifications_by_rp is not None:
+                return df_verifications_by_rp
+        df_verifications_by_rp = read_verifications_by_rp_csv(source, columns)
+
+    writer = create_columnar_copy_writer(verifications_by_rp_csv_path, columns)
+    if writer:
+        writer.write(df_verifications_by_rp)
+        writer.close()
     return df_verifications_by_rp
 
 
+def get_verification_dates(timestamps):
+    """
+    Bucket verification timestamps by the day they happened on, in the `REPORT_TIMEZONE` days that Piwik uses
+    :param timestamps: series of ISO 8601 UTC timestamps from a verifications_by_rp report
+    :return: series of timezone naive datetimes at midnight
+    """
+    local_times = pandas.to_datetime(timestamps, utc=True).dt.tz_convert(config.REPORT_TIMEZONE)
+    return local_times.dt.normalize().dt.tz_localize(None)
+
+
+def count_verifications(df_verifications_by_rp, by_date=False):
+    """
+    :param by_date: also count by the day of each verification, in a `VERIFICATION_DATE_COLUMN` column
+    """
+    keys = VERIFICATIONS_BY_RP_REPORT_COLUMNS
+    if by_date:
+        df_verifications_by_rp = df_verifications_by_rp.assign(
+            **{VERIFICATION_DATE_COLUMN: get_verification_dates(df_verifications_by_rp['Timestamp'])})
+        keys = keys + [VERIFICATION_DATE_COLUMN]
+    return df_verifications_by_rp.groupby(keys, observed=True).size().reset_index(name='count')
+
+
+def count_verifications_by_rp_csv_for_date(date_start, chunksize=None, by_date=False):
+    """
+    Count verifications for each RP entity ID and response type in the weekly verifications_by_rp.csv report.
+    Without a columnar copy the report is streamed in chunks, so that memory use doesn't grow with its size, and
+    the columnar copy is written as it goes. A report that isn't available locally is parsed as it downloads.
+    :param date_start: start date for the week
+    :param chunksize: rows to read at a time, defaults to `VERIFICATIONS_CSV_CHUNKSIZE`
+    :param by_date: also count by the day of each verification
+    :return: pandas.Dataframe with 'RP Entity Id', 'Response type' and 'count' columns, and a `VERIFICATION_DATE_COLUMN`
+        column if `by_date` is set
+    """
+    columns = VERIFICATIONS_BY_RP_REPORT_COLUMNS + (['Timestamp'] if by_date else [])
+    with open_verifications_by_rp_csv_for_date(date_start) as (verifications_by_rp_csv_path, source):
+        if source == verifications_by_rp_csv_path:
+            df_verifications_by_rp = read_columnar_copy(verifications_by_rp_csv_path, columns)
+            if df_verifications_by_rp is not None:
+                return sum_verification_counts([count_verifications(df_verifications_by_rp, by_date)])
+
+        chunks = read_verifications_by_rp_csv(source, columns, chunksize or config.VERIFICATIONS_CSV_CHUNKSIZE)
+        # A report read from S3 is only saved once it has been read in full, so the copy is finished afterwards
+        writer = create_columnar_copy_writer(verifications_by_rp_csv_path, columns)
+        verification_counts = []
+        try:
+            for chunk in chunks:
+                if writer:
+                    writer.write(chunk)
+                verification_counts.append(count_verifications(chunk, by_date))
+        except Exception:
+            if writer:
+                writer.abort()
+            raise
+    if writer:
+        writer.close()
+    return sum_verification_counts(verification_counts)
+
+
+def sum_verification_counts(verification_counts):
+    """
+    Combine several dataframes of verification counts, e.g. one per chunk of a report
+    :param verification_counts: iterable of dataframes with 'RP Entity Id', 'Response type' and 'count' columns,
+        and optionally a `VERIFICATION_DATE_COLUMN` column
+    """
+    # Categories differ between chunks, so the keys are concatenated as objects and made categorical again once summed
+    df_counts = pandas.concat(verification_counts, ignore_index=True)
+    df_counts = df_counts.astype({column: 'object' for column in VERIFICATIONS_BY_RP_REPORT_COLUMNS})
+    keys = [column for column in df_counts.columns if column != 'count']
+    df_counts = df_counts.groupby(keys)['count'].sum().reset_index()
+    return df_counts.astype({column: 'category' for column in VERIFICATIONS_BY_RP_REPORT_COLUMNS})
+
+
 def augment_verifications_by_rp_with_rp_name(df_verifications_by_rp):
     """
-    Transformation step that gets the human readable RP name and adds it inplace to a new column
+    Transformation step that gets the human readable RP name and adds it inplace to a new categorical column
     for verifications_by_rp data
     :param df_verifications_by_rp: dataframe created from a verifications_by_rp report
+    :raises UnknownRelyingPartyError: listing every entity ID that has no RP mapping
     """
-    df_verifications_by_rp['rp'] = df_verifications_by_rp.apply(lambda row: config.rp_mapping[row['RP Entity Id']],
-                                                                axis=1)
+    # Mapping the categories rather than every row means only one lookup per distinct entity ID
+    rp_names = df_verifications_by_rp['RP Entity Id'].astype('category').map(config.rp_mapping)
+    rp_names = pandas.Series(rp_names, index=df_verifications_by_rp.index, dtype='category')
+    unknown_entity_ids = df_verifications_by_rp.loc[rp_names.isnull(), 'RP Entity Id'].unique()
+    if len(unknown_entity_ids):
+        raise UnknownRelyingPartyError(sorted(str(entity_id) for entity_id in unknown_entity_ids))
+    df_verifications_by_rp['rp'] = rp_names
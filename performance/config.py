@@ -5,8 +5,7 @@ Functions to config and initialise the system. Expects environment variables for
 import json
 import os
 import logging  # noqa
-
-from performance.tests.fixtures import get_sample_rp_mapping  # TODO fixture should move in here
+import threading
 
 logging.basicConfig(level=logging.INFO)  # noqa
 
@@ -18,16 +17,65 @@ class Config:
 
     S3_BILLING_REPORTS_BUCKET = 'govukverify-hub-prod-billing-reports'
     S3_VERIFICATIONS_DIRECTORY = 'rp'
+    # Download objects bigger than the threshold in parts of chunksize bytes, up to max_concurrency parts at once
+    S3_MULTIPART_THRESHOLD = 64 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 16 * 1024 * 1024
+    S3_MAX_CONCURRENCY = 10
+    # Files uploaded at once when uploading a directory, each using up to S3_MAX_CONCURRENCY threads for its parts
+    S3_MAX_CONCURRENT_UPLOADS = 4
+    # Parse verifications reports as they download rather than once they've been saved
+    S3_STREAM_REPORTS = True
     VERIFY_DATA_PIPELINE_CONFIG_PATH = os.path.abspath(
         os.path.join(BASE_DIR, '..', 'verify-data-pipeline-config'))
     PIWIK_PERIOD = 'week'
+    # Timezone of the Piwik site, whose days daily reports are split into
+    REPORT_TIMEZONE = 'Europe/London'
     PIWIK_LIMIT = '-1'
     PIWIK_BASE_URL = 'https://analytics.tools.signin.service.gov.uk/index.php'
+    # Upper bound on Piwik requests in flight at once; 1 fetches RPs sequentially
+    PIWIK_MAX_CONCURRENT_REQUESTS = 8
+    # Send Piwik queries through `API.getBulkRequest`, this many sub-queries per round trip
+    PIWIK_BULK_REQUESTS = True
+    PIWIK_BULK_BATCH_SIZE = 50
+    # Get each journey type's attempts for every RP from one CustomVariables.getCustomVariables query, broken down by
+    # the RP name held in this visit custom variable slot, rather than querying each RP and journey type separately
+    PIWIK_CUSTOM_VARIABLE_BREAKDOWN = True
+    PIWIK_RP_CUSTOM_VARIABLE_SLOT = 1
+    # With the breakdown, also get the visits to each funnel page for every RP from one query segmented by page title
+    PIWIK_FUNNEL_PAGE_BREAKDOWN = True
+    PIWIK_POOL_SIZE = PIWIK_MAX_CONCURRENT_REQUESTS
+    # (connect, read) timeouts in seconds
+    PIWIK_TIMEOUT = (5, 120)
+    # Retries for connection errors, 429 and 5xx responses, waiting backoff_factor * 2 ** (retry - 1) seconds between
+    PIWIK_MAX_RETRIES = 5
+    PIWIK_RETRY_BACKOFF_FACTOR = 0.5
+    PIWIK_CACHE_ENABLED = True
+    PIWIK_CACHE_PATH = os.path.join(BASE_DIR, 'cache', 'piwik')
+    PIWIK_CACHE_MAX_SIZE = 256 * 1024 * 1024
+    # Seconds to keep responses for periods that haven't finished yet; finished periods are kept until evicted
+    PIWIK_CACHE_TTL = 60 * 60
     DEFAULT_OUTPUT_PATH = os.path.join(BASE_DIR, 'output')
+    CSV_EXPORT_MAX_WORKERS = 8
+    # Log the timings and counters of each run as well as saving them in a run report next to the CSV output
+    LOG_RUN_REPORT = False
+    # Rows of a verifications_by_rp report to hold in memory at once when counting verifications
+    VERIFICATIONS_CSV_CHUNKSIZE = 500000
+    # Keep a Parquet copy next to each verifications_by_rp report, which is much quicker to load than the CSV
+    VERIFICATIONS_COLUMNAR_CACHE = True
+    # Processes loading billing data in parallel when reporting on several weeks
+    REPORT_MAX_PROCESSES = 4
     # This is only used if Google auth credentials aren't already present in environment variables See
     # `performance.gsheets.get_pygsheets_client` for implementation details.
     GSHEETS_CREDENTIALS_FILE = os.path.join(
         VERIFY_DATA_PIPELINE_CONFIG_PATH, 'credentials', 'google_sheets_credentials.json')
+    # Spreadsheets written to at once, and the Google Sheets API quotas to stay within while doing so
+    GSHEETS_MAX_CONCURRENT_WRITES = 4
+    GSHEETS_REQUESTS_PER_MINUTE_PER_USER = 60
+    GSHEETS_REQUESTS_PER_MINUTE_PER_PROJECT = 300
+    GSHEETS_RATE_LIMIT_BURST = 10
+    # Retries for requests rejected for exceeding the quotas, waiting backoff_factor * 2 ** retry seconds between
+    GSHEETS_MAX_RETRIES = 5
+    GSHEETS_RETRY_BACKOFF_FACTOR = 2
 
     def __init__(self):
         # TODO: grab these from ENV variables
@@ -55,6 +103,46 @@ class Config:
             raise LookupError('RP information and RP mappings are different:', diff)
 
 
+class LazyConfig:
+    """
+    Stands in for an instance of a config class, which is only built when a setting it loads is first used, as
+    building `Config` reads the Piwik token and the JSON configuration. Settings which are class attributes are read
+    from the class until then, so that e.g. command line defaults don't need the configuration to be present.
+    """
+
+    def __init__(self, config_class):
+        object.__setattr__(self, '_config_class', config_class)
+        object.__setattr__(self, '_config', None)
+        object.__setattr__(self, '_lock', threading.Lock())
+
+    def _get_config(self):
+        with self._lock:
+            if self._config is None:
+                object.__setattr__(self, '_config', self._config_class())
+            return self._config
+
+    def __getattr__(self, name):
+        if self.__dict__['_config'] is None and name.isupper() and hasattr(self._config_class, name):
+            return getattr(self._config_class, name)
+        return getattr(self._get_config(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_config(), name, value)
+
+    def __delattr__(self, name):
+        delattr(self._get_config(), name)
+
+
+def get_sample_rp_mapping():
+    return {
+        "https://rp-entity-id-1.test.id": "RP 1",
+        "https://rp-entity-id-2.test.id": "RP 2",
+        "https://rp-entity-id-3.test.id": "RP 3",
+        "https://rp-entity-id-4.test.id": "RP 4",
+        "https://rp-entity-id-4.other.test.id": "RP 4",
+    }
+
+
 _sample_rp_information = [
     {
         "rp_name": "RP 1",
@@ -92,13 +180,44 @@ class TestConfig:
     VERIFY_DATA_PIPELINE_CONFIG_PATH = 'path'
     S3_BILLING_REPORTS_BUCKET = 'billing_reports_bucket'
     S3_VERIFICATIONS_DIRECTORY = 'rp'
+    S3_MULTIPART_THRESHOLD = 1024
+    S3_MULTIPART_CHUNKSIZE = 1024
+    S3_MAX_CONCURRENCY = 2
+    S3_MAX_CONCURRENT_UPLOADS = 2
+    S3_STREAM_REPORTS = True
     PIWIK_PERIOD = 'week'
+    REPORT_TIMEZONE = 'Europe/London'
     PIWIK_LIMIT = '-1'
     PIWIK_BASE_URL = 'url'
+    PIWIK_MAX_CONCURRENT_REQUESTS = 4
+    PIWIK_BULK_REQUESTS = True
+    PIWIK_BULK_BATCH_SIZE = 5
+    PIWIK_CUSTOM_VARIABLE_BREAKDOWN = False
+    PIWIK_RP_CUSTOM_VARIABLE_SLOT = 1
+    PIWIK_FUNNEL_PAGE_BREAKDOWN = False
+    PIWIK_POOL_SIZE = PIWIK_MAX_CONCURRENT_REQUESTS
+    PIWIK_TIMEOUT = (1, 1)
+    PIWIK_MAX_RETRIES = 0
+    PIWIK_RETRY_BACKOFF_FACTOR = 0
+    PIWIK_CACHE_ENABLED = False
+    PIWIK_CACHE_PATH = 'path'
+    PIWIK_CACHE_MAX_SIZE = 1024
+    PIWIK_CACHE_TTL = 60
     DEFAULT_OUTPUT_PATH = 'path'
+    CSV_EXPORT_MAX_WORKERS = 2
+    LOG_RUN_REPORT = False
+    VERIFICATIONS_CSV_CHUNKSIZE = 2
+    VERIFICATIONS_COLUMNAR_CACHE = False
+    REPORT_MAX_PROCESSES = 2
     GSHEETS_CREDENTIALS_FILE = 'file'
+    GSHEETS_MAX_CONCURRENT_WRITES = 2
+    GSHEETS_REQUESTS_PER_MINUTE_PER_USER = 6000
+    GSHEETS_REQUESTS_PER_MINUTE_PER_PROJECT = 6000
+    GSHEETS_RATE_LIMIT_BURST = 100
+    GSHEETS_MAX_RETRIES = 2
+    GSHEETS_RETRY_BACKOFF_FACTOR = 0
 
     def __init__(self):
         self.PIWIK_AUTH_TOKEN = "DUMMY_PIWIK_TOKEN"
-        self.rp_information = {rp['rp_name']: rp for rp in _sample_rp_information}
+        self.rp_information = {rp['rp_name']: dict(rp) for rp in _sample_rp_information}
         self.rp_mapping = get_sample_rp_mapping()
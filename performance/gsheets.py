@@ -1,11 +1,19 @@
 import json
+import logging
 import os
+import threading
+import time
+
 import pygsheets
 import tempfile
+from googleapiclient.errors import HttpError
 
+from performance import metrics
 from performance.env import check_get_env
 from performance import prod_config as config
 
+RATE_LIMIT_EXCEEDED_STATUS = 429
+
 
 def get_pygsheets_client():
     google_auth_private_key_id = os.getenv('GOOGLE_AUTH_PRIVATE_KEY_ID')
@@ -33,3 +41,72 @@ def get_pygsheets_client():
         return pygsheets.authorize(service_file=temp.name)
     finally:
         os.unlink(temp.name)
+
+
+class TokenBucket:
+    """
+    Rate limiter allowing bursts of up to `capacity` requests, refilled at `rate` requests per second.
+    Safe to share between threads.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._last_refill = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` requests can be made."""
+        tokens = min(tokens, self._capacity)
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._rate)
+                self._last_refill = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self._rate
+            self._sleep(wait)
+
+
+class GoogleSheetsRateLimiter:
+    """
+    Keeps Google Sheets API calls within the per-user and per-project quotas, and retries calls rejected for
+    exceeding them with exponential backoff.
+    """
+
+    def __init__(self, config, sleep=time.sleep):
+        self._buckets = [
+            TokenBucket(quota / 60, config.GSHEETS_RATE_LIMIT_BURST, sleep=sleep)
+            for quota in (config.GSHEETS_REQUESTS_PER_MINUTE_PER_USER, config.GSHEETS_REQUESTS_PER_MINUTE_PER_PROJECT)
+        ]
+        self._max_retries = config.GSHEETS_MAX_RETRIES
+        self._backoff_factor = config.GSHEETS_RETRY_BACKOFF_FACTOR
+        self._sleep = sleep
+
+    def call(self, api_requests, func, *args, **kwargs):
+        """
+        Call `func` once there's quota for it, retrying if Google reports that the quota has been exceeded anyway.
+        :param api_requests: number of API requests `func` makes
+        """
+        run_report = metrics.run_report()
+        for attempt in range(self._max_retries + 1):
+            with run_report.stage('gsheets_rate_limit_wait'):
+                for bucket in self._buckets:
+                    bucket.acquire(api_requests)
+            run_report.increment('gsheets.calls')
+            run_report.increment('gsheets.api_requests', api_requests)
+            try:
+                with run_report.time_request(f"gsheets.{getattr(func, '__name__', 'call')}"):
+                    return func(*args, **kwargs)
+            except HttpError as e:
+                if e.resp.status != RATE_LIMIT_EXCEEDED_STATUS or attempt == self._max_retries:
+                    raise
+                run_report.increment('gsheets.rate_limit_retries')
+                wait = self._backoff_factor * 2 ** attempt
+                logging.warning(f'Google Sheets quota exceeded, retrying in {wait} seconds')
+                self._sleep(wait)
@@ -0,0 +1,134 @@
+"""
+Timings and counters collected over a run of the pipeline, written out as a JSON run report
+"""
+
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+RUN_REPORT_FILE_NAME = 'run_report.json'
+# Upper bounds in seconds of the buckets latencies are counted into
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0
+        self.max_seconds = 0
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.bucket_counts[sum(1 for bucket in LATENCY_BUCKETS if seconds > bucket)] += 1
+
+    def to_dict(self):
+        bucket_names = [f'<={bucket}' for bucket in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]}']
+        return OrderedDict([
+            ('count', self.count),
+            ('total_seconds', round(self.total_seconds, 4)),
+            ('max_seconds', round(self.max_seconds, 4)),
+            ('buckets', OrderedDict(zip(bucket_names, self.bucket_counts))),
+        ])
+
+
+class RunReport:
+    """
+    Collects the wall time spent in each stage of a run, counters such as requests made and bytes transferred, and a
+    latency histogram for each kind of request. Safe to update from several threads at once.
+    """
+
+    def __init__(self, clock=time.perf_counter):
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._start = clock()
+        self._stages = OrderedDict()
+        self._counters = OrderedDict()
+        self._latencies = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage of the run; the times of stages with the same name, e.g. one per week, are added up
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            seconds = self._clock() - start
+            with self._lock:
+                stage = self._stages.setdefault(name, {'seconds': 0, 'count': 0})
+                stage['seconds'] += seconds
+                stage['count'] += 1
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe_latency(self, name, seconds):
+        with self._lock:
+            self._latencies.setdefault(name, LatencyHistogram()).observe(seconds)
+
+    @contextmanager
+    def time_request(self, name):
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.observe_latency(name, self._clock() - start)
+
+    def to_dict(self):
+        with self._lock:
+            return OrderedDict([
+                ('total_seconds', round(self._clock() - self._start, 4)),
+                ('stages', OrderedDict(
+                    (name, {'seconds': round(stage['seconds'], 4), 'count': stage['count']})
+                    for name, stage in self._stages.items())),
+                ('counters', OrderedDict(self._counters)),
+                ('latencies', OrderedDict((name, histogram.to_dict()) for name, histogram in self._latencies.items())),
+            ])
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), prefix='.', suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(self.to_dict(), f, indent=2)
+        os.replace(f.name, path)
+
+    def log(self):
+        run_report = self.to_dict()
+        logging.info(f"Run took {run_report['total_seconds']}s")
+        for name, stage in run_report['stages'].items():
+            logging.info(f"Stage {name}: {stage['seconds']}s over {stage['count']} runs")
+        for name, value in run_report['counters'].items():
+            logging.info(f'Counter {name}: {value}')
+        for name, latency in run_report['latencies'].items():
+            logging.info(f"Latency {name}: {latency['count']} requests, {latency['total_seconds']}s in total, "
+                         f"{latency['max_seconds']}s at most")
+
+
+_run_report = RunReport()
+
+
+def run_report():
+    """
+    :return: the report for the current run, which the clients record into
+    """
+    return _run_report
+
+
+def start_run_report():
+    """
+    Start recording into a new run report
+    :return: the new RunReport
+    """
+    global _run_report
+    _run_report = RunReport()
+    return _run_report
@@ -0,0 +1,78 @@
+"""
+Runs the stages of a report as a graph, starting each stage as soon as the stages it depends on have finished
+"""
+
+import logging
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from performance import metrics
+
+
+class SkipStage(Exception):
+    """Raised by a stage to skip it, along with every stage which depends on it"""
+
+
+class Pipeline:
+    """
+    Stages which don't depend on each other run at the same time in threads, so a run takes about as long as its
+    slowest chain of stages. The wall time of each stage is recorded in the run report.
+    """
+
+    def __init__(self, max_workers=None):
+        self._stages = OrderedDict()
+        self._max_workers = max_workers
+
+    def add(self, name, func, dependencies=(), after=()):
+        """
+        :param func: called with the results of `dependencies`, in order
+        :param dependencies: names of the stages whose results `func` takes
+        :param after: names of other stages this stage has to wait for
+        """
+        unknown = [stage for stage in (*dependencies, *after) if stage not in self._stages]
+        if unknown:
+            raise ValueError(f'Stage {name} depends on stages which have not been added: {", ".join(unknown)}')
+        self._stages[name] = (func, tuple(dependencies), tuple(dependencies) + tuple(after))
+
+    def run(self):
+        """
+        :return: dict of the result of each stage that ran, by name; skipped stages are left out
+        """
+        run_report = metrics.run_report()
+        results = {}
+        skipped = set()
+        pending = OrderedDict(self._stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self._max_workers or max(len(self._stages), 1)) as executor:
+            while pending or running:
+                # Stages are added after those they wait for, so skips cascade within one pass
+                for name, (func, dependencies, waits_for) in list(pending.items()):
+                    if any(stage in skipped for stage in waits_for):
+                        skipped.add(name)
+                        del pending[name]
+                    elif all(stage in results for stage in waits_for):
+                        del pending[name]
+                        args = [results[stage] for stage in dependencies]
+                        running[executor.submit(self._run_stage, run_report, name, func, args)] = name
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except SkipStage:
+                        skipped.add(name)
+        return results
+
+    @staticmethod
+    def _run_stage(run_report, name, func, args):
+        with run_report.stage(name):
+            try:
+                return func(*args)
+            except SkipStage:
+                raise
+            except Exception:
+                logging.error(f'Stage {name} failed')
+                raise
@@ -1,6 +1,85 @@
+import copy
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from performance import metrics, prod_config
+from performance.piwik_cache import PiwikResponseCache
+from performance.piwik_transport import (
+    HttpTransport, PiwikBulkRequestError, RecordingTransport, ReplayTransport, is_error_result,
+)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Pages of the registration journey whose visits are reported on for LOA2 RPs, as segment conditions
+WILL_NOT_WORK_PAGE = "@GOV.UK Verify will not work for you - GOV.UK Verify - GOV.UK - LEVEL_2"
+MIGHT_NOT_WORK_PAGE = "@Why might this not work for me - GOV.UK Verify - GOV.UK - LEVEL_2"
+
+
+def get_retry(config):
+    retry_args = {
+        'total': config.PIWIK_MAX_RETRIES,
+        'backoff_factor': config.PIWIK_RETRY_BACKOFF_FACTOR,
+        'status_forcelist': RETRY_STATUS_CODES,
+    }
+    # Bulk requests are POSTs but only read data, so they are as safe to retry as GETs
+    methods = frozenset(['GET', 'POST'])
+    try:
+        return Retry(allowed_methods=methods, **retry_args)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **retry_args)
+
+
+def create_session(config):
+    """
+    Create a keep-alive session whose connection pool is shared by all requests to Piwik, retrying transient
+    failures with exponential backoff.
+    """
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.PIWIK_POOL_SIZE, max_retries=get_retry(config))
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def is_multi_period(period, date):
+    """Piwik returns a result for each period, keyed by date, when `date` is a range but `period` isn't 'range'"""
+    return period != 'range' and ',' in date
+
 
-from performance import prod_config
+def parse_by_period(parse):
+    def parse_results(raw_result):
+        return {date: parse(result) for date, result in raw_result.items()}
+    return parse_results
+
+
+def parse_nb_visits_for_rp(raw_result):
+    # The result for each of several periods is a bare number rather than {'value': number}
+    if not isinstance(raw_result, dict):
+        return raw_result
+    return raw_result.get('value', 0)
+
+
+def parse_nb_visits_for_page(raw_result):
+    return next(iter(raw_result), {}).get('nb_visits', 0)
+
+
+def parse_nb_visits_by_custom_variable_value(raw_result, slot):
+    """
+    :param raw_result: expanded `CustomVariables.getCustomVariables` report, with a row for each custom variable
+        name whose subtable has a row for each of its values
+    :param slot: index of the visit scope custom variable to break visits down by
+    :return: dict of the number of visits by value of the custom variable
+    """
+    for row in raw_result:
+        if any(s.get('scope') == 'visit' and int(s.get('index', 0)) == slot for s in row.get('slots', [])):
+            return {value_row['label']: value_row.get('nb_visits', 0) for value_row in row.get('subtable', [])}
+    return {}
 
 
 class PiwikClient:
@@ -15,27 +94,32 @@ class PiwikClient:
         self.piwik_base_url = config.PIWIK_BASE_URL
         self.limit = config.PIWIK_LIMIT
         self.period = config.PIWIK_PERIOD
+        self.bulk_batch_size = config.PIWIK_BULK_BATCH_SIZE
+        self.max_concurrent_requests = config.PIWIK_MAX_CONCURRENT_REQUESTS
+        self.timeout = config.PIWIK_TIMEOUT
+        self.rp_custom_variable_slot = config.PIWIK_RP_CUSTOM_VARIABLE_SLOT
+        self.session = create_session(config)
+        # Answers the queries that aren't answered from the cache; see `record_exchanges` and `replay_exchanges`
+        self.transport = HttpTransport(self.session, self.piwik_base_url, self.token, self.timeout)
+        self.cache = None
+        if config.PIWIK_CACHE_ENABLED:
+            self.cache = PiwikResponseCache(
+                config.PIWIK_CACHE_PATH, config.PIWIK_CACHE_MAX_SIZE, config.PIWIK_CACHE_TTL)
+        # When set, responses are always fetched from Piwik, but still written to the cache
+        self.bypass_cache = False
 
-    def get_nb_visits_for_rp(self, date, segment):
-        qs = {
-            'module': 'API',
-            'idSite': '1',
-            'format': 'JSON',
-            'filter_limit': self.limit,
-            'date': date,
-            'period': self.period,
-            'method': 'VisitsSummary.getVisits',
-            'expanded': '1',
-            'token_auth': self.token,
-            'segment': segment
-        }
+    def for_period(self, period):
+        """
+        :return: a client querying `period` periods, sharing this client's connection pool and cache
+        """
+        client = copy.copy(self)
+        client.period = period
+        return client
 
-        response = requests.get(self.piwik_base_url, qs)
-        
-        raw_result = response.json()
-        return raw_result.get('value', 0)
+    def get_parser(self, date, parse):
+        return parse_by_period(parse) if is_multi_period(self.period, date) else parse
 
-    def get_nb_visits_for_page(self, date, segment):
+    def get_query_string(self, method, date, segment, **params):
         qs = {
             'module': 'API',
             'idSite': '1',
@@ -43,19 +127,190 @@ class PiwikClient:
             'filter_limit': self.limit,
             'date': date,
             'period': self.period,
-            'method': 'Actions.getPageTitles',
+            'method': method,
             'token_auth': self.token,
             'segment': segment,
         }
+        qs.update(params)
+        return qs
+
+    def get_nb_visits_for_rp_query_string(self, date, segment):
+        return self.get_query_string('VisitsSummary.getVisits', date, segment, expanded='1')
+
+    def get_nb_visits_for_page_query_string(self, date, segment):
+        return self.get_query_string('Actions.getPageTitles', date, segment)
+
+    def get_nb_visits_by_rp_query_string(self, date, segment):
+        return self.get_query_string('CustomVariables.getCustomVariables', date, segment, expanded='1')
 
-        response = requests.get(self.piwik_base_url, qs)
+    def get_nb_visits_by_rp_parser(self, date):
+        return self.get_parser(
+            date, partial(parse_nb_visits_by_custom_variable_value, slot=self.rp_custom_variable_slot))
 
-        raw_result = response.json()
-        nb_visits = next(iter(raw_result), {}).get('nb_visits', 0)
-        return nb_visits
+    def get_cached_response(self, qs):
+        if self.cache is None or self.bypass_cache:
+            return None
+        raw_result = self.cache.get(qs)
+        if raw_result is not None:
+            metrics.run_report().increment('piwik.cache_hits')
+        return raw_result
 
+    def cache_response(self, qs, raw_result):
+        if self.cache is not None and not is_error_result(raw_result):
+            self.cache.set(qs, raw_result)
 
-_piwik_client = PiwikClient(prod_config)
+    def get(self, qs):
+        raw_result = self.get_cached_response(qs)
+        if raw_result is not None:
+            return raw_result
+
+        raw_result = self.transport.get(qs)
+        self.cache_response(qs, raw_result)
+        return raw_result
+
+    def get_nb_visits_for_rp(self, date, segment):
+        raw_result = self.get(self.get_nb_visits_for_rp_query_string(date, segment))
+        return self.get_parser(date, parse_nb_visits_for_rp)(raw_result)
+
+    def get_nb_visits_for_page(self, date, segment):
+        raw_result = self.get(self.get_nb_visits_for_page_query_string(date, segment))
+        return self.get_parser(date, parse_nb_visits_for_page)(raw_result)
+
+    def get_nb_visits_by_rp(self, date, segment):
+        """
+        :return: dict of the number of visits matching `segment` by RP name, for the RPs which had any
+        """
+        raw_result = self.get(self.get_nb_visits_by_rp_query_string(date, segment))
+        return self.get_nb_visits_by_rp_parser(date)(raw_result)
+
+    def get_bulk(self, query_strings):
+        """
+        Send several queries in a single `API.getBulkRequest` round trip.
+
+        Args:
+            query_strings: list of query strings as built by `get_query_string`
+        Returns:
+            list of raw results, in the same order as `query_strings`
+        """
+        metrics.run_report().increment('piwik.bulk_sub_requests', len(query_strings))
+        raw_results = self.transport.get_bulk(query_strings)
+        for sub_query_string, raw_result in zip(query_strings, raw_results):
+            self.cache_response(sub_query_string, raw_result)
+        return raw_results
+
+    def bulk_request(self):
+        return PiwikBulkRequest(self)
+
+
+class PiwikBulkResult:
+    def __init__(self, query_string, parse):
+        self.query_string = query_string
+        self._parse = parse
+        self.value = None
+
+    def set_raw_result(self, raw_result):
+        if is_error_result(raw_result):
+            raise PiwikBulkRequestError(
+                self.query_string['method'], self.query_string['segment'], raw_result.get('message'))
+        self.value = self._parse(raw_result)
+
+
+class PiwikBulkRequest:
+    """
+    Collects Piwik queries and sends them in batches of `PIWIK_BULK_BATCH_SIZE` through `API.getBulkRequest`.
+
+    The query methods mirror `PiwikClient` but return a `PiwikBulkResult` whose `value` is filled in by `send`.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._results = []
+
+    def get_nb_visits_for_rp(self, date, segment):
+        return self._add(self._client.get_nb_visits_for_rp_query_string(date, segment),
+                         self._client.get_parser(date, parse_nb_visits_for_rp))
+
+    def get_nb_visits_for_page(self, date, segment):
+        return self._add(self._client.get_nb_visits_for_page_query_string(date, segment),
+                         self._client.get_parser(date, parse_nb_visits_for_page))
+
+    def get_nb_visits_by_rp(self, date, segment):
+        return self._add(self._client.get_nb_visits_by_rp_query_string(date, segment),
+                         self._client.get_nb_visits_by_rp_parser(date))
+
+    def _add(self, query_string, parse):
+        result = PiwikBulkResult(query_string, parse)
+        self._results.append(result)
+        return result
+
+    def send(self):
+        uncached_results = []
+        for result in self._results:
+            raw_result = self._client.get_cached_response(result.query_string)
+            if raw_result is None:
+                uncached_results.append(result)
+            else:
+                result.set_raw_result(raw_result)
+
+        batch_size = self._client.bulk_batch_size
+        batches = [uncached_results[i:i + batch_size] for i in range(0, len(uncached_results), batch_size)]
+        with ThreadPoolExecutor(max_workers=self._client.max_concurrent_requests) as executor:
+            raw_batches = executor.map(lambda batch: self._client.get_bulk([r.query_string for r in batch]), batches)
+            for batch, raw_results in zip(batches, raw_batches):
+                for result, raw_result in zip(batch, raw_results):
+                    result.set_raw_result(raw_result)
+        self._results = []
+
+
+_piwik_client = None
+_piwik_client_lock = threading.Lock()
+
+
+def get_piwik_client():
+    """
+    Return the client shared by every Piwik query, creating it on first use
+    """
+    global _piwik_client
+    with _piwik_client_lock:
+        if _piwik_client is None:
+            _piwik_client = PiwikClient(prod_config)
+        return _piwik_client
+
+
+def bulk_request():
+    return get_piwik_client().bulk_request()
+
+
+def client_for_period(period):
+    return get_piwik_client().for_period(period)
+
+
+def bypass_cache():
+    """Ignore previously cached Piwik responses for the rest of this run."""
+    get_piwik_client().bypass_cache = True
+
+
+def record_exchanges(path):
+    """
+    Record every Piwik query and response for the rest of this run, to be saved to `path` by
+    `save_recorded_exchanges`. Cached responses are ignored, so that every query is recorded.
+    """
+    client = get_piwik_client()
+    client.transport = RecordingTransport(client.transport, path)
+    client.bypass_cache = True
+
+
+def save_recorded_exchanges():
+    get_piwik_client().transport.save()
+
+
+def replay_exchanges(path):
+    """
+    Answer Piwik queries from the exchanges recorded to `path` for the rest of this run, instead of querying Piwik
+    """
+    client = get_piwik_client()
+    client.transport = ReplayTransport.load(path)
+    client.cache = None
 
 
 def get_segment_query_string(rp_name, journey_type=None, page_title=None):
@@ -67,42 +322,67 @@ def get_segment_query_string(rp_name, journey_type=None, page_title=None):
     return segment
 
 
-def get_all_visits_for_rp_and_journey_type(date_start_string, rp_name, journey_type):
+def get_all_visits_for_rp_and_journey_type(date_start_string, rp_name, journey_type, piwik_client=None):
     segment = get_segment_query_string(rp_name, journey_type)
-    return _piwik_client.get_nb_visits_for_rp(date_start_string, segment)
+    return (piwik_client or get_piwik_client()).get_nb_visits_for_rp(date_start_string, segment)
+
+
+def get_journey_type_segment_query_string(journey_type, page_title=None):
+    segment = f"customVariableValue3=={journey_type}"
+    if page_title:
+        segment += f";pageTitle={page_title}"
+    return segment
+
+
+def get_all_attempts_by_rp(date_start_string, journey_type, piwik_client=None):
+    """
+    Get the visits of a journey type for every RP at once, broken down by the RP custom variable
+    :return: dict of the number of visits by RP name, for the RPs which had any
+    """
+    segment = get_journey_type_segment_query_string(journey_type)
+    return (piwik_client or get_piwik_client()).get_nb_visits_by_rp(date_start_string, segment)
+
+
+def get_page_visits_by_rp(date_start_string, page_title, piwik_client=None):
+    """
+    Get the registration visits which viewed a page for every RP at once, broken down by the RP custom variable.
+    These are the same visits `get_visits_will_not_work` and `get_visits_might_not_work` count for a single RP, as
+    `Actions.getPageTitles` can't itself be broken down by RP.
+    :return: dict of the number of visits by RP name, for the RPs which had any
+    """
+    segment = get_journey_type_segment_query_string('REGISTRATION', page_title)
+    return (piwik_client or get_piwik_client()).get_nb_visits_by_rp(date_start_string, segment)
 
 
-def get_all_referrals_for_rp(rp, date_start_string):
+def get_all_referrals_for_rp(rp, date_start_string, piwik_client=None):
     segment_by_rp = get_segment_query_string(rp)
-    return _piwik_client.get_nb_visits_for_rp(date_start_string, segment_by_rp)
+    return (piwik_client or get_piwik_client()).get_nb_visits_for_rp(date_start_string, segment_by_rp)
 
 
-def get_all_signin_attempts_for_rp(rp, date_start_string):
+def get_all_signin_attempts_for_rp(rp, date_start_string, piwik_client=None):
     journey_type = 'SIGN_IN'
-    return get_all_visits_for_rp_and_journey_type(date_start_string, rp, journey_type)
+    return get_all_visits_for_rp_and_journey_type(date_start_string, rp, journey_type, piwik_client)
 
 
-def get_all_signup_attempts_for_rp(rp, date_start_string):
+def get_all_signup_attempts_for_rp(rp, date_start_string, piwik_client=None):
     journey_type = 'REGISTRATION'
-    return get_all_visits_for_rp_and_journey_type(date_start_string, rp, journey_type)
+    return get_all_visits_for_rp_and_journey_type(date_start_string, rp, journey_type, piwik_client)
 
 
-def get_all_single_idp_attempts_for_rp(rp, date_start_string):
+def get_all_single_idp_attempts_for_rp(rp, date_start_string, piwik_client=None):
     journey_type = 'SINGLE_IDP'
-    return get_all_visits_for_rp_and_journey_type(date_start_string, rp, journey_type)
+    return get_all_visits_for_rp_and_journey_type(date_start_string, rp, journey_type, piwik_client)
 
 
-def get_visits_will_not_work(rp, date_start_string):
-    will_not_work_page = "@GOV.UK Verify will not work for you - GOV.UK Verify - GOV.UK - LEVEL_2"
+def get_visits_will_not_work(rp, date_start_string, piwik_client=None):
     journey_type = 'REGISTRATION'
-    will_not_work_segment = get_segment_query_string(rp, journey_type, will_not_work_page)
+    will_not_work_segment = get_segment_query_string(rp, journey_type, WILL_NOT_WORK_PAGE)
 
-    return _piwik_client.get_nb_visits_for_page(date_start_string, will_not_work_segment)
+    return (piwik_client or get_piwik_client()).get_nb_visits_for_page(date_start_string, will_not_work_segment)
 
 
-def get_visits_might_not_work(rp, date_start_string):
-    might_not_work_page = "@Why might this not work for me - GOV.UK Verify - GOV.UK - LEVEL_2"
+def get_visits_might_not_work(rp, date_start_string, piwik_client=None):
     journey_type = 'REGISTRATION'
-    might_not_work_segment = get_segment_query_string(rp, journey_type, might_not_work_page)
+    might_not_work_segment = get_segment_query_string(rp, journey_type, MIGHT_NOT_WORK_PAGE)
 
-    return _piwik_client.get_nb_visits_for_page(date_start_string, might_not_work_segment)
+    return (piwik_client or get_piwik_client()).get_nb_visits_for_page(date_start_string, might_not_work_segment)
@@ -0,0 +1,133 @@
+"""
+On-disk cache of Piwik API responses
+"""
+
+import calendar
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+# Query string parameters that don't change the response, and must not end up on disk
+IGNORED_PARAMS = ('module', 'format', 'token_auth')
+
+
+def get_period_end(period, date_string):
+    """
+    Return the last day covered by a Piwik period, or by the last of several periods when `date_string` is a range
+    of dates, or None if it can't be worked out from `date_string` (e.g. for relative dates such as 'today' or
+    'last7').
+    """
+    try:
+        if ',' in date_string:
+            day = datetime.strptime(date_string.split(',')[1], "%Y-%m-%d").date()
+            if period == 'range':
+                return day
+        else:
+            day = datetime.strptime(date_string, "%Y-%m-%d").date()
+    except (ValueError, IndexError):
+        return None
+    if period == 'day':
+        return day
+    if period == 'week':
+        # Piwik weeks run from Monday to Sunday
+        return day + timedelta(days=6 - day.weekday())
+    if period == 'month':
+        return day.replace(day=calendar.monthrange(day.year, day.month)[1])
+    if period == 'year':
+        return day.replace(month=12, day=31)
+    return None
+
+
+def is_closed_period(period, date_string, today=None):
+    period_end = get_period_end(period, date_string)
+    return period_end is not None and period_end < (today or date.today())
+
+
+class PiwikResponseCache:
+    """
+    Stores each Piwik response in its own JSON file, named by a hash of the query parameters (method, idSite, date,
+    period, segment, filter_limit and any other parameter apart from the auth token and output format).
+
+    Responses for periods which have finished never expire; any other response is kept for `ttl` seconds. Once the
+    files take up more than `max_size` bytes, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path, max_size, ttl):
+        self._path = path
+        self._max_size = max_size
+        self._ttl = ttl
+        self._size = None
+        self._lock = threading.Lock()
+
+    def key(self, qs):
+        params = {k: str(v) for k, v in qs.items() if k not in IGNORED_PARAMS}
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self._path, f'{key}.json')
+
+    def get(self, qs):
+        """Return the cached response for the query string `qs`, or None if there isn't a fresh one."""
+        entry_path = self._entry_path(self.key(qs))
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if entry['expires'] is not None and entry['expires'] < time.time():
+            self._remove(entry_path)
+            return None
+        # Entries are evicted oldest modification time first, so touching them on read makes eviction LRU
+        try:
+            os.utime(entry_path)
+        except OSError:
+            # Evicted since it was read, which doesn't make the response read any less fresh
+            pass
+        return entry['response']
+
+    def set(self, qs, response):
+        expires = None if is_closed_period(qs.get('period'), qs.get('date')) else time.time() + self._ttl
+        data = json.dumps({'expires': expires, 'response': response})
+
+        os.makedirs(self._path, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self._path, suffix='.tmp', delete=False) as f:
+            f.write(data)
+        os.replace(f.name, self._entry_path(self.key(qs)))
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._list_entries())
+            else:
+                self._size += len(data)
+            if self._size > self._max_size:
+                self._evict()
+
+    def _list_entries(self):
+        entries = []
+        for entry in os.scandir(self._path):
+            if entry.name.endswith('.json'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.path, stat.st_size))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._list_entries())
+        self._size = sum(size for _, _, size in entries)
+        for _, entry_path, size in entries:
+            if self._size <= self._max_size:
+                break
+            self._remove(entry_path)
+            self._size -= size
+        logging.info(f'Evicted Piwik cache entries down to {self._size} bytes')
+
+    def _remove(self, entry_path):
+        try:
+            os.remove(entry_path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,171 @@
+"""
+Transports which answer Piwik queries: over HTTP, or from exchanges recorded to a file, so that reports can be
+generated offline
+"""
+
+import gzip
+import json
+import os
+import tempfile
+import threading
+from urllib.parse import urlencode
+
+from performance import metrics
+from performance.piwik_cache import IGNORED_PARAMS
+
+
+class PiwikBulkRequestError(Exception):
+    def __init__(self, method, segment, message):
+        if segment is None:
+            super().__init__(f'Piwik bulk request {method} failed: {message}')
+        else:
+            super().__init__(f"Piwik bulk sub-request {method} for segment '{segment}' failed: {message}")
+
+
+class PiwikReplayError(LookupError):
+    def __init__(self, query_string):
+        super().__init__(f'No recorded Piwik response for {get_exchange_key(query_string)}')
+
+
+def get_exchange_key(query_string):
+    """
+    :return: the query string without the parameters that don't change the response, in a canonical order
+    """
+    return urlencode(sorted((k, v) for k, v in query_string.items() if k not in IGNORED_PARAMS))
+
+
+def is_error_result(raw_result):
+    return isinstance(raw_result, dict) and raw_result.get('result') == 'error'
+
+
+def check_bulk_results(query_strings, raw_results):
+    """
+    Make sure a bulk request returned a result for each of its sub-queries. A failure of the whole request, such as
+    a bad token, returns a single error instead, whose keys would otherwise be taken for the sub-queries' results.
+    :raises PiwikBulkRequestError: if it didn't
+    """
+    if is_error_result(raw_results):
+        raise PiwikBulkRequestError('API.getBulkRequest', None, raw_results.get('message'))
+    if not isinstance(raw_results, list) or len(raw_results) != len(query_strings):
+        raise PiwikBulkRequestError(
+            'API.getBulkRequest', None, f'expected a list of {len(query_strings)} results, got {raw_results!r:.200}')
+
+
+def record_response(response):
+    run_report = metrics.run_report()
+    run_report.increment('piwik.requests')
+    run_report.increment('piwik.bytes_received', len(response.content))
+
+
+class HttpTransport:
+    def __init__(self, session, piwik_base_url, token, timeout):
+        """
+        Args:
+            session: requests session whose connection pool is shared by every query
+            piwik_base_url: URL of Piwik instance to query
+            token: Piwik access token, for bulk requests
+            timeout: (connect, read) timeouts in seconds
+        """
+        self.session = session
+        self.piwik_base_url = piwik_base_url
+        self.token = token
+        self.timeout = timeout
+
+    def get(self, qs):
+        with metrics.run_report().time_request(f"piwik.{qs['method']}"):
+            response = self.session.get(self.piwik_base_url, params=qs, timeout=self.timeout)
+        record_response(response)
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, qs):
+        with metrics.run_report().time_request(f"piwik.{qs['method']}"):
+            response = self.session.post(self.piwik_base_url, data=qs, timeout=self.timeout)
+        record_response(response)
+        response.raise_for_status()
+        return response.json()
+
+    def get_bulk(self, query_strings):
+        """
+        Send several queries in a single `API.getBulkRequest` round trip.
+
+        Args:
+            query_strings: list of query strings as built by `PiwikClient.get_query_string`
+        Returns:
+            list of raw results, in the same order as `query_strings`
+        """
+        qs = {
+            'module': 'API',
+            'format': 'JSON',
+            'method': 'API.getBulkRequest',
+            'token_auth': self.token,
+        }
+        for index, sub_query_string in enumerate(query_strings):
+            qs[f'urls[{index}]'] = urlencode(
+                {k: v for k, v in sub_query_string.items() if k not in IGNORED_PARAMS})
+        raw_results = self.post(qs)
+        check_bulk_results(query_strings, raw_results)
+        return raw_results
+
+
+class RecordingTransport:
+    """
+    Passes queries on to another transport, recording the response to each, until `save` writes them all to a
+    gzipped JSON file that `ReplayTransport` can answer the same queries from.
+    """
+
+    def __init__(self, transport, path):
+        self._transport = transport
+        self._path = path
+        self._exchanges = {}
+        self._lock = threading.Lock()
+
+    def get(self, qs):
+        raw_result = self._transport.get(qs)
+        self._record([qs], [raw_result])
+        return raw_result
+
+    def get_bulk(self, query_strings):
+        raw_results = self._transport.get_bulk(query_strings)
+        self._record(query_strings, raw_results)
+        return raw_results
+
+    def _record(self, query_strings, raw_results):
+        with self._lock:
+            for query_string, raw_result in zip(query_strings, raw_results):
+                self._exchanges[get_exchange_key(query_string)] = raw_result
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self._path))
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            with tempfile.NamedTemporaryFile(dir=directory, prefix='.', suffix='.tmp', delete=False) as f:
+                with gzip.open(f, 'wt', encoding='utf-8') as gzip_file:
+                    json.dump(self._exchanges, gzip_file, sort_keys=True, separators=(',', ':'))
+        os.replace(f.name, self._path)
+
+
+class ReplayTransport:
+    """
+    Answers queries from the exchanges saved by a `RecordingTransport`, held in memory, without touching the network.
+    Queries that weren't recorded raise `PiwikReplayError`.
+    """
+
+    def __init__(self, exchanges):
+        self._exchanges = exchanges
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def get(self, qs):
+        try:
+            raw_result = self._exchanges[get_exchange_key(qs)]
+        except KeyError:
+            raise PiwikReplayError(qs)
+        metrics.run_report().increment('piwik.replayed_responses')
+        return raw_result
+
+    def get_bulk(self, query_strings):
+        return [self.get(query_string) for query_string in query_strings]
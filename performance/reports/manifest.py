@@ -0,0 +1,80 @@
+"""
+Manifest of the inputs a report was generated from, so that re-running it only regenerates what has changed
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from performance.billing import get_file_sha256
+
+MANIFEST_FILE_NAME = 'manifest.json'
+
+
+def get_content_hash(content):
+    """
+    :param content: JSON serialisable data; anything else, such as numpy numbers, is hashed as its string
+    """
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ReportManifest:
+    """
+    Records the SHA-256 of the verifications_by_rp.csv report a report was generated from, and for each RP a hash of
+    each of its other inputs, e.g. its config and Piwik data.
+    """
+
+    def __init__(self, path, data=None):
+        self._path = path
+        self._data = data or {'verifications': None, 'rps': {}}
+
+    @classmethod
+    def load(cls, path):
+        """
+        :return: the manifest saved at `path`, or an empty one if there isn't a valid one
+        """
+        try:
+            with open(path) as f:
+                return cls(path, json.load(f))
+        except (OSError, ValueError):
+            return cls(path)
+
+    def get_verifications_sha256(self, verifications_by_rp_csv_path):
+        """
+        Hash a verifications_by_rp.csv report, reusing the recorded hash if the file's size and modification time
+        haven't changed since it was recorded
+        """
+        stat = os.stat(verifications_by_rp_csv_path)
+        recorded = self._data['verifications']
+        if recorded and recorded['size'] == stat.st_size and recorded['mtime'] == stat.st_mtime:
+            return recorded['sha256']
+        return get_file_sha256(verifications_by_rp_csv_path)
+
+    def is_verifications_changed(self, sha256):
+        recorded = self._data['verifications']
+        return sha256 is None or recorded is None or recorded['sha256'] != sha256
+
+    def set_verifications(self, verifications_by_rp_csv_path, sha256):
+        stat = os.stat(verifications_by_rp_csv_path)
+        self._data['verifications'] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256}
+
+    def get_changed_rps(self, rp_input_hashes):
+        """
+        :param rp_input_hashes: dict of the hash of each input by input name, by RP name; inputs missing from it
+            aren't compared
+        :return: list of the RPs which have an input whose hash differs from the recorded one
+        """
+        recorded_rps = self._data['rps']
+        return [rp for rp, input_hashes in rp_input_hashes.items()
+                if any(recorded_rps.get(rp, {}).get(name) != input_hash for name, input_hash in input_hashes.items())]
+
+    def set_rp_inputs(self, rp, input_hashes):
+        self._data['rps'][rp] = input_hashes
+
+    def save(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(self._path), prefix='.', suffix='.tmp',
+                                         delete=False) as f:
+            json.dump(self._data, f, indent=2, sort_keys=True)
+        os.replace(f.name, self._path)
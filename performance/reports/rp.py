@@ -1,13 +1,26 @@
+import csv
+import io
+import logging
+import math
+import numbers
 import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
 
 import pandas
+import pygsheets
 
 import performance
 import performance.piwik as piwik
 import performance.billing as billing
+from performance import metrics
 from performance import prod_config as config
-from performance.gsheets import get_pygsheets_client
-from performance.reports.tests import conftest
+from performance.gsheets import get_pygsheets_client, GoogleSheetsRateLimiter
+from performance.pipeline import Pipeline, SkipStage
+from performance.reports.manifest import MANIFEST_FILE_NAME, ReportManifest, get_content_hash
 
 RP_REPORT_COLUMNS = [
     'rp',
@@ -23,34 +36,220 @@ RP_REPORT_COLUMNS = [
 ]
 
 RP_REPORT_OUTPUT_FOLDER = "rp_report"
+RP_DAILY_REPORT_OUTPUT_FOLDER = "rp_report_daily"
+# Stands in for the RP name in the name of the CSV file with every RP
+ALL_RPS_CSV_NAME = '_all-rps'
+
+# Successful verifications in verifications_by_rp reports are counted into these columns by response type; any
+# other response type isn't counted
+SUCCESS_COLUMNS_BY_RESPONSE_TYPE = {
+    'NEW': 'signup_success',
+    'RETURNING': 'signin_success',
+}
+
+# Metrics fetched from Piwik for each RP, in the order they're added to the report
+PIWIK_DATA_COLUMNS = ['signin_attempt', 'signup_attempt', 'single_idp_attempt', 'visits_will_not_work',
+                      'visits_might_not_work']
+
+# Journey type whose visits are counted into each attempt column
+ATTEMPT_JOURNEY_TYPES = {
+    'signin_attempt': 'SIGN_IN',
+    'signup_attempt': 'REGISTRATION',
+    'single_idp_attempt': 'SINGLE_IDP',
+}
+
+# Funnel page whose visits are counted into each column, for LOA2 RPs
+FUNNEL_PAGE_TITLES = {
+    'visits_will_not_work': piwik.WILL_NOT_WORK_PAGE,
+    'visits_might_not_work': piwik.MIGHT_NOT_WORK_PAGE,
+}
 
 # TODO this should come from config
 LOA1_RP_LIST = ["DFT DVLA VDL", "Get your State Pension", "NHS TRS", "NHS Pension Awards"]
 
 
+class GoogleSheetsExportResult:
+    def __init__(self):
+        self.succeeded = []
+        # Exceptions raised when exporting to each sheet which failed, by sheet key
+        self.failed = {}
+
+
+class GoogleSheetsExportError(Exception):
+    def __init__(self, date_starts, sheet_keys):
+        self.date_starts = date_starts
+        self.sheet_keys = sheet_keys
+        super().__init__(f"Google Sheets export failed for weeks starting {', '.join(date_starts)}, "
+                         f"for sheets: {', '.join(sheet_keys)}")
+
+
 class GoogleSheetsRelyingPartyReportExporter:
     SHEET_TAB_NAME = 'Sheet1'  # TODO hmmm
 
-    def __init__(self, config, pygsheets_client):
+    def __init__(self, config, pygsheets_client=None, pygsheets_client_factory=None, upsert=False):
+        """
+        Args:
+            config: configuration holding `rp_information` and the Google Sheets quotas
+            pygsheets_client: client to export with, unless `pygsheets_client_factory` is given
+            pygsheets_client_factory: optional function creating clients; when given, up to
+                `GSHEETS_MAX_CONCURRENT_WRITES` spreadsheets are written to at once, each thread with its own client
+                as they aren't thread safe. The threads are kept until `close`, and each spreadsheet is always
+                written to from the same one, so it's only opened once however many times the exporter is used.
+            upsert: when True, a column whose heading is already in the sheet is updated in place, and only if its
+                values have changed, rather than inserting another column with the same heading
+        """
         self._config = config
+        self._upsert = upsert
         self._pygsheets_client = pygsheets_client
+        self._pygsheets_client_factory = pygsheets_client_factory
+        self._rate_limiter = GoogleSheetsRateLimiter(config)
+        # Client and worksheets opened so far, by sheet key and tab name, for each thread
+        self._local = threading.local()
+        # Single threaded executors, and the one each sheet key is written to from
+        self._executors = []
+        self._executor_index_by_sheet_key = {}
+        self._executors_lock = threading.Lock()
 
     def export(self, data_frame, column_heading):
+        """
+        :return: GoogleSheetsExportResult listing the sheets which were and weren't updated
+        """
         data_frame = data_frame.fillna('')
+        values_lists_by_sheet_key = {}
         for row in data_frame.itertuples():
             rp_name = row.rp
             sheet_key = self._config.rp_information[rp_name]['sheet_key']
             if sheet_key:
                 values_list = self.format_for_gsheets(row, column_heading if column_heading is not None else rp_name)
-                # TODO check that column 1 contains expected field names
-                self.send_to_gsheets(values_list, sheet_key, self.SHEET_TAB_NAME)
-
-    def send_to_gsheets(self, values_list, sheet_key, sheet_tab_name):
-        sheet = self._pygsheets_client.open_by_key(sheet_key)
-        worksheet = sheet.worksheet_by_title(sheet_tab_name)
-
-        # insert a new column right after the one showing field name
-        worksheet.insert_cols(1, 1, values=values_list)
+                values_lists_by_sheet_key.setdefault(sheet_key, []).append(values_list)
+
+        sheet_keys = list(values_lists_by_sheet_key)
+        send = partial(self._try_send_to_gsheets, values_lists_by_sheet_key)
+        if self._pygsheets_client_factory is None:
+            errors = list(map(send, sheet_keys))
+        else:
+            futures = [self._get_executor(sheet_key).submit(send, sheet_key) for sheet_key in sheet_keys]
+            errors = [future.result() for future in futures]
+
+        result = GoogleSheetsExportResult()
+        for sheet_key, error in zip(sheet_keys, errors):
+            if error is None:
+                result.succeeded.append(sheet_key)
+            else:
+                result.failed[sheet_key] = error
+        return result
+
+    def close(self):
+        """
+        Stop the threads that exports ran in
+        """
+        with self._executors_lock:
+            for executor in self._executors:
+                executor.shutdown()
+            self._executors = []
+            self._executor_index_by_sheet_key = {}
+
+    def _get_executor(self, sheet_key):
+        with self._executors_lock:
+            if sheet_key not in self._executor_index_by_sheet_key:
+                # Spread sheets over the threads in the order they're first exported to
+                self._executor_index_by_sheet_key[sheet_key] = \
+                    len(self._executor_index_by_sheet_key) % self._config.GSHEETS_MAX_CONCURRENT_WRITES
+            index = self._executor_index_by_sheet_key[sheet_key]
+            while len(self._executors) <= index:
+                self._executors.append(ThreadPoolExecutor(max_workers=1))
+            return self._executors[index]
+
+    def _try_send_to_gsheets(self, values_lists_by_sheet_key, sheet_key):
+        try:
+            # TODO check that column 1 contains expected field names
+            if self._upsert:
+                self.upsert_to_gsheets(values_lists_by_sheet_key[sheet_key], sheet_key, self.SHEET_TAB_NAME)
+            else:
+                self.send_to_gsheets(values_lists_by_sheet_key[sheet_key], sheet_key, self.SHEET_TAB_NAME)
+        except Exception as e:
+            logging.exception(f'Failed to export to Google Sheet {sheet_key}')
+            return e
+        return None
+
+    def _get_pygsheets_client(self):
+        if self._pygsheets_client_factory is None:
+            return self._pygsheets_client
+        if not hasattr(self._local, 'pygsheets_client'):
+            self._local.pygsheets_client = self._pygsheets_client_factory()
+        return self._local.pygsheets_client
+
+    def get_worksheet(self, sheet_key, sheet_tab_name):
+        if not hasattr(self._local, 'worksheets'):
+            self._local.worksheets = {}
+        worksheets = self._local.worksheets
+        if (sheet_key, sheet_tab_name) not in worksheets:
+            sheet = self._rate_limiter.call(1, self._get_pygsheets_client().open_by_key, sheet_key)
+            worksheets[(sheet_key, sheet_tab_name)] = sheet.worksheet_by_title(sheet_tab_name)
+        return worksheets[(sheet_key, sheet_tab_name)]
+
+    def send_to_gsheets(self, values_lists, sheet_key, sheet_tab_name):
+        """
+        Insert a column for each list of values right after the one showing field names, with one insert and one
+        update for the whole spreadsheet. Columns end up in the same order as if they'd been inserted one at a time,
+        with the last one first.
+        """
+        worksheet = self.get_worksheet(sheet_key, sheet_tab_name)
+
+        # Inserting and filling in the columns are separate calls so that either can be retried on its own
+        self._rate_limiter.call(1, worksheet.insert_cols, 1, len(values_lists))
+        self._rate_limiter.call(1, worksheet.update_col, 2, list(reversed(values_lists)))
+
+    def upsert_to_gsheets(self, values_lists, sheet_key, sheet_tab_name):
+        """
+        Write the lists of values with each heading to the columns with that heading, leaving columns which already
+        hold the same values untouched. Several RPs can share a sheet, so a heading can head several columns, which
+        are filled in the same order as `send_to_gsheets` would insert them. If the number of columns with a heading
+        has changed, they're deleted and inserted again in the same place. Lists of values with a heading which isn't
+        in the sheet yet are inserted as new columns, as in `send_to_gsheets`.
+        """
+        worksheet = self.get_worksheet(sheet_key, sheet_tab_name)
+        headings = self._rate_limiter.call(1, worksheet.get_row, 1)
+        column_indexes = {}
+        for index, heading in enumerate(headings, 1):
+            column_indexes.setdefault(heading, []).append(index)
+
+        values_lists_by_heading = {}
+        for values in values_lists:
+            values_lists_by_heading.setdefault(str(values[0]), []).append(values)
+        existing_headings = [heading for heading in values_lists_by_heading if heading in column_indexes]
+        new_values_lists = [values for heading, heading_values_lists in values_lists_by_heading.items()
+                            if heading not in column_indexes for values in heading_values_lists]
+
+        replaced_headings = []
+        if existing_headings:
+            indexes = [index for heading in existing_headings for index in column_indexes[heading]]
+            # One read covering all the existing columns; raw values so numbers compare exactly
+            columns = self._rate_limiter.call(
+                1, worksheet.get_values, (2, min(indexes)), (len(values_lists[0]), max(indexes)), majdim='COLUMNS',
+                include_all=True, value_render=pygsheets.ValueRenderOption('UNFORMATTED_VALUE'))
+            for heading in existing_headings:
+                heading_indexes = column_indexes[heading]
+                ordered_values_lists = list(reversed(values_lists_by_heading[heading]))
+                if len(heading_indexes) != len(ordered_values_lists):
+                    replaced_headings.append(heading)
+                    continue
+                for index, values in zip(heading_indexes, ordered_values_lists):
+                    offset = index - min(indexes)
+                    if not values_match(columns[offset] if offset < len(columns) else [], values[1:]):
+                        self._rate_limiter.call(1, worksheet.update_col, index, values)
+
+        # From the right, so that deleting and inserting columns doesn't move those still to be replaced
+        for heading in sorted(replaced_headings, key=lambda heading: column_indexes[heading][0], reverse=True):
+            heading_indexes = column_indexes[heading]
+            for index in reversed(heading_indexes):
+                self._rate_limiter.call(1, worksheet.delete_cols, index, 1)
+            ordered_values_lists = list(reversed(values_lists_by_heading[heading]))
+            self._rate_limiter.call(1, worksheet.insert_cols, heading_indexes[0] - 1, len(ordered_values_lists))
+            self._rate_limiter.call(1, worksheet.update_col, heading_indexes[0], ordered_values_lists)
+
+        if new_values_lists:
+            self.send_to_gsheets(new_values_lists, sheet_key, sheet_tab_name)
 
     def format_for_gsheets(self, row, column_heading):
         return [
@@ -68,6 +267,19 @@ class GoogleSheetsRelyingPartyReportExporter:
         ]
 
 
+def values_match(sheet_values, values):
+    """
+    Whether values read from a sheet are the same as the values which would be written to it
+    """
+    for sheet_value, value in zip(list(sheet_values) + [''] * (len(values) - len(sheet_values)), values):
+        if isinstance(value, numbers.Real) and isinstance(sheet_value, numbers.Real):
+            if not math.isclose(sheet_value, value, rel_tol=1e-9):
+                return False
+        elif str(sheet_value) != str(value):
+            return False
+    return True
+
+
 def test_upload(gsheets_key, date_start):
     """
     Similar to our unit test `test_export_metrics_to_google_sheets`, however because
@@ -78,6 +290,8 @@ def test_upload(gsheets_key, date_start):
     # of test RP's as are used in the rp_report_weekly fixture. We're using the fixture
     # because if you want to test the upload process, you don't want to have to wait around
     # for Piwik - any data will do.
+    from performance.reports.tests import conftest
+
     config = performance.config.TestConfig()
     pygsheets_client = get_pygsheets_client()
     for rp_info in config.rp_information.values():
@@ -97,47 +311,421 @@ def get_rp_names_from_df(df_verifications_by_rp):
     return df_verifications_by_rp.rp.unique().tolist()
 
 
-def get_df_successes_by_rp(df_verifications_by_rp):
-    df_verifications_by_rp = df_verifications_by_rp.rename(columns={'Response type': 'response_type'})
-    df_totals = df_verifications_by_rp.groupby(['rp', 'response_type']).count().reset_index()
-    df_totals.drop(['Timestamp', 'RP Entity Id'], axis=1, inplace=True)
-    df_totals = df_totals.rename(columns={'IDP Entity Id': 'successes'})
-    df_successes_by_rp = pandas.pivot_table(df_totals, values='successes', index='rp', columns='response_type',
-                                            fill_value=0)
-    df_successes_by_rp.reset_index(inplace=True)
-    df_successes_by_rp.columns = ['rp', 'signup_success', 'signin_success']
+def get_df_successes_by_rp(df_verifications_by_rp, by_date=False):
+    """
+    Count successful sign ups and sign ins for each RP
+    :param df_verifications_by_rp: verifications_by_rp data with RP names, either one row per verification or with
+        a 'count' column as returned by `billing.count_verifications_by_rp_csv_for_date`
+    :param by_date: count for each day and RP, from the data's `billing.VERIFICATION_DATE_COLUMN` column
+    :return: pandas.Dataframe with 'rp', 'signup_success' and 'signin_success' columns, sorted by RP, with a
+        `billing.VERIFICATION_DATE_COLUMN` column first if `by_date` is set
+    """
+    keys = [billing.VERIFICATION_DATE_COLUMN, 'rp'] if by_date else ['rp']
+    success_columns = list(SUCCESS_COLUMNS_BY_RESPONSE_TYPE.values())
+    df_by_rp_and_response_type = df_verifications_by_rp.groupby(keys + ['Response type'], observed=True)
+    if 'count' in df_verifications_by_rp.columns:
+        successes = df_by_rp_and_response_type['count'].sum()
+    else:
+        successes = df_by_rp_and_response_type.size()
+    if successes.empty:
+        key_dtypes = [(billing.VERIFICATION_DATE_COLUMN, 'datetime64[ns]'), ('rp', 'object')][-len(keys):]
+        return pandas.DataFrame({column: pandas.Series(dtype=dtype) for column, dtype in
+                                 key_dtypes + [(column, 'int64') for column in success_columns]})
+
+    df_successes_by_rp = successes.unstack(fill_value=0)
+    df_successes_by_rp.columns = df_successes_by_rp.columns.astype('object').map(SUCCESS_COLUMNS_BY_RESPONSE_TYPE)
+    df_successes_by_rp = df_successes_by_rp.loc[:, df_successes_by_rp.columns.notnull()]
+    df_successes_by_rp = df_successes_by_rp.reindex(columns=success_columns, fill_value=0).astype('int64')
+    df_successes_by_rp = df_successes_by_rp.rename_axis(None, axis='columns').reset_index()
+    df_successes_by_rp['rp'] = df_successes_by_rp['rp'].astype('object')
+
+    return df_successes_by_rp.sort_values(keys).reset_index(drop=True)
+
+
+def write_file_atomically(path, content):
+    """
+    Write to a temporary file which then replaces `path`, so that `path` never holds partially written content
+    """
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), prefix='.', suffix='.tmp', newline='',
+                                     delete=False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+
+
+def format_rp_rows_as_csv(df_export):
+    """
+    Serialise each RP's row of the report as 'field,value' lines, in one pass over the report
+    :return: dict of CSV content by RP name
+    """
+    df_export = df_export.astype('object').where(df_export.notnull(), '')
+    rp_csvs = {}
+    for row in df_export.itertuples(index=False):
+        content = io.StringIO()
+        csv.writer(content, lineterminator='\n').writerows(zip(df_export.columns, row))
+        rp_csvs[row.rp] = content.getvalue()
+    return rp_csvs
+
 
-    return df_successes_by_rp
+def get_csv_file_name(date_start, rp_name=ALL_RPS_CSV_NAME):
+    return f'{date_start}-{rp_name}-rp_report.csv'
 
 
-def export_metrics_to_csv(df_export, report_output_path, date_start):
-    report_output_path_for_week = os.path.join(report_output_path, RP_REPORT_OUTPUT_FOLDER, date_start)
-    if not os.path.exists(report_output_path_for_week):
-        os.makedirs(report_output_path_for_week)
+def export_metrics_to_csv(df_export, report_output_path, date_start, output_folder=RP_REPORT_OUTPUT_FOLDER, rps=None):
+    """
+    :param rps: only write the files for these RPs, along with the file for all RPs, or for every RP if None
+    """
+    report_output_path_for_week = os.path.join(report_output_path, output_folder, date_start)
+    os.makedirs(report_output_path_for_week, exist_ok=True)
 
-    # Create export file with all RPs data
-    df_export.to_csv(os.path.join(report_output_path_for_week, f'{date_start}-_all-rps-rp_report.csv'))
-    # Create export file per RP
-    for index, rp_data_row in df_export.iterrows():
-        rp_name = rp_data_row['rp']
-        rp_data_row.to_csv(os.path.join(report_output_path_for_week, f'{date_start}-{rp_name}-rp_report.csv'))
+    # Export file with all RPs data
+    file_contents = {get_csv_file_name(date_start): df_export.to_csv()}
+    # Export file per RP
+    df_export_by_rp = df_export if rps is None else df_export[df_export['rp'].isin(rps)]
+    for rp_name, rp_csv in format_rp_rows_as_csv(df_export_by_rp).items():
+        file_contents[get_csv_file_name(date_start, rp_name)] = rp_csv
 
+    with ThreadPoolExecutor(max_workers=config.CSV_EXPORT_MAX_WORKERS) as executor:
+        list(executor.map(lambda file_name: write_file_atomically(
+            os.path.join(report_output_path_for_week, file_name), file_contents[file_name]), file_contents))
 
-def export_metrics_to_google_sheets(df_export, date_start):
-    pygsheets_client = get_pygsheets_client()
-    exporter = GoogleSheetsRelyingPartyReportExporter(config, pygsheets_client)
-    exporter.export(df_export, column_heading=date_start)
 
+def create_google_sheets_exporter():
+    return GoogleSheetsRelyingPartyReportExporter(config, pygsheets_client_factory=get_pygsheets_client, upsert=True)
 
-def generate_weekly_report_for_date(date_start, report_output_path):
-    # load billing csv file
-    df_verifications_by_rp = billing.extract_verifications_by_rp_csv_for_date(date_start)
+
+def export_metrics_to_google_sheets(df_export, date_start, exporter=None):
+    if exporter is None:
+        exporter = create_google_sheets_exporter()
+        try:
+            return export_metrics_to_google_sheets(df_export, date_start, exporter)
+        finally:
+            exporter.close()
+
+    result = exporter.export(df_export, column_heading=date_start)
+    if result.failed:
+        logging.error(f'Google Sheets export for {date_start} failed for sheets: {", ".join(result.failed)}; '
+                      f'succeeded for sheets: {", ".join(result.succeeded)}')
+    else:
+        logging.info(f'Google Sheets export for {date_start} succeeded for {len(result.succeeded)} sheets')
+    return result
+
+
+def get_verification_counts_for_week(date_start):
+    """
+    Load the billing data for a week as verification counts with RP names
+    :param date_start: start date for the week
+    """
+    df_verifications_by_rp = billing.count_verifications_by_rp_csv_for_date(date_start)
     billing.augment_verifications_by_rp_with_rp_name(df_verifications_by_rp)
-    df_all = generate_weekly_report_df(date_start, df_verifications_by_rp)
-    # Re-order columns and choose the ones we actually (currently) want in our report
-    df_export = df_all[RP_REPORT_COLUMNS]
-    export_metrics_to_csv(df_export, report_output_path, date_start)
-    export_metrics_to_google_sheets(df_export, date_start)
+    return df_verifications_by_rp
+
+
+def get_rp_config(rp):
+    return {
+        'entity_ids': sorted(entity_id for entity_id, rp_name in config.rp_mapping.items() if rp_name == rp),
+        'information': config.rp_information.get(rp),
+    }
+
+
+class IncrementalWeeklyReport:
+    """
+    Regenerates a week's report for only the RPs whose inputs have changed since it was last generated, as recorded
+    in the manifest in the week's output folder, or whose CSV file is missing. An RP's inputs are its config, its
+    Piwik data and its successes from the verifications_by_rp.csv report, which is only loaded if it has changed or
+    another input has.
+
+    The file for all RPs is rewritten whenever any RP has changed, as are the Google Sheets holding a changed RP.
+    The report is generated by the stages of the pipeline from `create_pipeline`.
+    """
+
+    def __init__(self, date_start, report_output_path, force=False, verifications_by_rp_csv_path=None):
+        """
+        :param force: regenerate the report for every RP, whether or not its inputs have changed
+        :param verifications_by_rp_csv_path: path to the week's verifications_by_rp.csv report once
+            `billing.get_verifications_by_rp_csv_path_for_date` has brought it up to date with S3; it's brought up to
+            date here if not given
+        """
+        self.date_start = date_start
+        self._report_output_path = report_output_path
+        manifest_path = os.path.join(report_output_path, RP_REPORT_OUTPUT_FOLDER, date_start, MANIFEST_FILE_NAME)
+        self._manifest = ReportManifest(manifest_path) if force else ReportManifest.load(manifest_path)
+
+        # The local copy is only hashed once it's the same as the report in S3, which may have been replaced since it
+        # was downloaded. A missing report is treated as changed when it's streamed as it's loaded.
+        if verifications_by_rp_csv_path is None:
+            with metrics.run_report().stage('download_verifications'):
+                verifications_by_rp_csv_path = billing.get_verifications_by_rp_csv_path_for_date(
+                    date_start, download=not config.S3_STREAM_REPORTS)
+        self._verifications_by_rp_csv_path = verifications_by_rp_csv_path
+        self._verifications_sha256 = None
+        if os.path.exists(self._verifications_by_rp_csv_path):
+            with metrics.run_report().stage('hash_verifications'):
+                self._verifications_sha256 = self._manifest.get_verifications_sha256(
+                    self._verifications_by_rp_csv_path)
+
+        self._rps = sorted(set(config.rp_mapping.values()))
+        self._piwik_data = None
+        # Each stage adds the hashes of the inputs it gets to these
+        self._rp_input_hashes = {rp: {'config': get_content_hash(get_rp_config(rp))} for rp in self._rps}
+        self.changed_rps = None
+
+    def fetch_piwik_data(self):
+        self._piwik_data = get_piwik_data_for_rps(self.date_start, self._rps)
+        for rp, piwik_data in zip(self._rps, self._piwik_data):
+            self._rp_input_hashes[rp]['piwik'] = get_content_hash(piwik_data)
+
+    def is_verifications_changed(self):
+        return self._manifest.is_verifications_changed(self._verifications_sha256)
+
+    def get_changed_rps(self):
+        """
+        :return: list of the RPs with an input that has changed, or whose CSV file is missing, e.g. as it was deleted;
+            every RP if the CSV file with all RPs is missing
+        """
+        if not self._csv_file_exists(ALL_RPS_CSV_NAME):
+            return list(self._rps)
+        changed_rps = set(self._manifest.get_changed_rps(self._rp_input_hashes))
+        return [rp for rp in self._rps if rp in changed_rps or not self._csv_file_exists(rp)]
+
+    def _csv_file_exists(self, rp_name):
+        return os.path.exists(os.path.join(self._report_output_path, RP_REPORT_OUTPUT_FOLDER, self.date_start,
+                                           get_csv_file_name(self.date_start, rp_name)))
+
+    def is_up_to_date(self):
+        """
+        Only valid once the Piwik data has been fetched
+        """
+        return not (self.is_verifications_changed() or self.get_changed_rps())
+
+    def aggregate_successes(self, df_verifications_by_rp):
+        """
+        :param df_verifications_by_rp: the week's verification counts with RP names
+        :return: pandas.Dataframe with the successes of every RP
+        """
+        df_successes_rp = get_df_for_all_rps(get_df_successes_by_rp(df_verifications_by_rp))
+        for row in df_successes_rp.itertuples(index=False):
+            self._rp_input_hashes[row.rp]['successes'] = get_content_hash(
+                [int(row.signup_success), int(row.signin_success)])
+        return df_successes_rp
+
+    def transform(self, df_successes_rp):
+        """
+        Work out which RPs have changed, skipping the export if none have
+        :return: pandas.Dataframe of the report for every RP
+        """
+        self.changed_rps = self.get_changed_rps()
+        self._manifest.set_verifications(
+            self._verifications_by_rp_csv_path,
+            self._manifest.get_verifications_sha256(self._verifications_by_rp_csv_path))
+        if not self.changed_rps:
+            logging.info(f'No RP has changed for the week starting {self.date_start}')
+            self._manifest.save()
+            raise SkipStage()
+
+        logging.info(f'Exporting the week starting {self.date_start} for {len(self.changed_rps)} changed RPs')
+        df_all = merge_piwik_data(df_successes_rp, self._rps, self._piwik_data)
+        transform_metrics(df_all)
+        # Re-order columns and choose the ones we actually (currently) want in our report
+        return df_all[RP_REPORT_COLUMNS]
+
+    def export_csv(self, df_export):
+        export_metrics_to_csv(df_export, self._report_output_path, self.date_start, rps=self.changed_rps)
+        metrics.run_report().increment('rps_exported', len(self.changed_rps))
+
+    def export_google_sheets(self, df_export, google_sheets_exporter=None):
+        """
+        :return: GoogleSheetsExportResult for the sheets holding a changed RP
+        """
+        sheet_keys = {config.rp_information[rp]['sheet_key'] for rp in self.changed_rps}
+        df_export_by_sheet = df_export[df_export['rp'].map(lambda rp: config.rp_information[rp]['sheet_key'])
+                                       .isin(sheet_keys)]
+        return export_metrics_to_google_sheets(df_export_by_sheet, self.date_start, google_sheets_exporter)
+
+    def save_manifest(self, google_sheets_export_result):
+        """
+        :raises GoogleSheetsExportError: once the manifest is saved, if any sheet failed to export
+        """
+        # RPs whose sheet failed to export are left as they were, so that they're exported again next time
+        for rp in self.changed_rps:
+            if config.rp_information[rp]['sheet_key'] not in google_sheets_export_result.failed:
+                self._manifest.set_rp_inputs(rp, self._rp_input_hashes[rp])
+        self._manifest.save()
+        if google_sheets_export_result.failed:
+            raise GoogleSheetsExportError([self.date_start], sorted(google_sheets_export_result.failed))
+
+    def _load_verifications_unless_up_to_date(self, load_verifications):
+        if self.is_up_to_date():
+            logging.info(f'Report for the week starting {self.date_start} is up to date')
+            raise SkipStage()
+        return load_verifications()
+
+    def create_pipeline(self, load_verifications, google_sheets_exporter=None):
+        """
+        Fetch the Piwik data, unless it's already been fetched, while loading the verifications, which are only
+        loaded once Piwik has been queried if they haven't changed, as nothing may have. Then export to CSV and to
+        Google Sheets at the same time.
+        :param load_verifications: function returning the week's verification counts with RP names
+        :return: Pipeline
+        """
+        pipeline = Pipeline()
+        after_piwik = []
+        if self._piwik_data is None:
+            pipeline.add('fetch_piwik_data', self.fetch_piwik_data)
+            after_piwik = ['fetch_piwik_data']
+
+        if self.is_verifications_changed():
+            pipeline.add('load_verifications', load_verifications)
+        else:
+            pipeline.add('load_verifications', partial(self._load_verifications_unless_up_to_date, load_verifications),
+                         after=after_piwik)
+        pipeline.add('aggregate_successes', self.aggregate_successes, ['load_verifications'])
+        pipeline.add('transform_metrics', self.transform, ['aggregate_successes'], after=after_piwik)
+        pipeline.add('export_csv', self.export_csv, ['transform_metrics'])
+        pipeline.add('export_google_sheets', partial(self.export_google_sheets,
+                                                     google_sheets_exporter=google_sheets_exporter),
+                     ['transform_metrics'])
+        pipeline.add('save_manifest', self.save_manifest, ['export_google_sheets'], after=['export_csv'])
+        return pipeline
+
+
+def save_run_report(run_report, path):
+    run_report.save(path)
+    logging.info(f'Saved run report to {path}')
+    if config.LOG_RUN_REPORT:
+        run_report.log()
+
+
+def generate_weekly_report_for_date(date_start, report_output_path, force=False):
+    """
+    Generate the report for a week, recording how long each stage took in a run report next to the week's CSVs
+    """
+    run_report = metrics.start_run_report()
+    try:
+        report = IncrementalWeeklyReport(date_start, report_output_path, force)
+        report.create_pipeline(partial(get_verification_counts_for_week, date_start)).run()
+    finally:
+        save_run_report(run_report, os.path.join(report_output_path, RP_REPORT_OUTPUT_FOLDER, date_start,
+                                                 metrics.RUN_REPORT_FILE_NAME))
+
+
+def get_report_weeks(date_start, date_end):
+    """
+    :param date_start: start date for the first week
+    :param date_end: the last week reported on is the one starting on or before this date
+    :return: list of start dates, one for each week
+    """
+    week_start = billing.fromisoformat(date_start)
+    last_week_start = billing.fromisoformat(date_end)
+    weeks = []
+    while week_start <= last_week_start:
+        weeks.append(week_start.isoformat())
+        week_start += timedelta(days=7)
+    return weeks
+
+
+def generate_weekly_reports_for_date_range(date_start, date_end, report_output_path, force=False):
+    """
+    Generate the weekly report for every week from `date_start` to `date_end`, skipping weeks which are up to date.
+
+    Billing data for the weeks which aren't up to date is loaded in parallel by a pool of `REPORT_MAX_PROCESSES`
+    processes, starting as soon as each week's Piwik data has been fetched, while this process fetches Piwik data for
+    the following weeks and then exports each week in chronological order, so that the newest week ends up in the
+    first column of each sheet.
+    """
+    weeks = get_report_weeks(date_start, date_end)
+    if not weeks:
+        logging.warning(f'No weeks to report on from {date_start} to {date_end}')
+        return
+    logging.info(f'Generating reports for {len(weeks)} weeks from {weeks[0]} to {weeks[-1]}')
+    run_report = metrics.start_run_report()
+    try:
+        _generate_weekly_reports(weeks, report_output_path, force, run_report)
+    finally:
+        save_run_report(run_report, os.path.join(report_output_path, RP_REPORT_OUTPUT_FOLDER,
+                                                 f'{weeks[0]}_{weeks[-1]}-{metrics.RUN_REPORT_FILE_NAME}'))
+
+
+def _generate_weekly_reports(weeks, report_output_path, force, run_report):
+    # Download any missing or changed reports up front, rather than from several processes at once
+    with run_report.stage('download_verifications'):
+        with ThreadPoolExecutor(max_workers=config.REPORT_MAX_PROCESSES) as executor:
+            verifications_by_rp_csv_paths = list(executor.map(billing.get_verifications_by_rp_csv_path_for_date, weeks))
+
+    with ProcessPoolExecutor(max_workers=config.REPORT_MAX_PROCESSES) as executor:
+        reports = []
+        verification_counts = {}
+        for week, verifications_by_rp_csv_path in zip(weeks, verifications_by_rp_csv_paths):
+            report = IncrementalWeeklyReport(week, report_output_path, force, verifications_by_rp_csv_path)
+            with run_report.stage('fetch_piwik_data'):
+                report.fetch_piwik_data()
+            if report.is_up_to_date():
+                logging.info(f'Report for the week starting {week} is up to date')
+            else:
+                # Loaded by the other processes while Piwik data is fetched for the following weeks
+                verification_counts[week] = executor.submit(get_verification_counts_for_week, week)
+                reports.append(report)
+
+        if not reports:
+            return
+
+        google_sheets_exporter = create_google_sheets_exporter()
+        # Failing to export a week's sheets doesn't stop the following weeks, but fails the run once they're done
+        export_errors = []
+        try:
+            for report in reports:
+                logging.info(f'Generating report for week starting {report.date_start}')
+                try:
+                    # Looked up by week, as a report only loads its billing data if one of its RPs has changed
+                    report.create_pipeline(verification_counts[report.date_start].result,
+                                           google_sheets_exporter).run()
+                except GoogleSheetsExportError as e:
+                    export_errors.append(e)
+        finally:
+            google_sheets_exporter.close()
+    if export_errors:
+        raise GoogleSheetsExportError([date_start for e in export_errors for date_start in e.date_starts],
+                                      sorted({sheet_key for e in export_errors for sheet_key in e.sheet_keys}))
+
+
+def get_report_days(date_start):
+    return pandas.date_range(date_start, periods=7, freq='D')
+
+
+def get_verification_counts_by_day_for_week(date_start):
+    """
+    Load the billing data for a week as verification counts by day with RP names
+    :param date_start: start date for the week
+    """
+    df_verifications_by_rp = billing.count_verifications_by_rp_csv_for_date(date_start, by_date=True)
+    billing.augment_verifications_by_rp_with_rp_name(df_verifications_by_rp)
+    return df_verifications_by_rp
+
+
+def generate_daily_report_for_date(date_start, report_output_path):
+    """
+    Generate a report for each day of the week starting on `date_start`, from a single load of the week's billing
+    data and one daily Piwik query per metric and RP. Daily reports are only exported to CSV, as the sheets have a
+    column per week.
+    :return: pandas.Dataframe with the metrics for each day and RP
+    """
+    df_verifications_by_rp = get_verification_counts_by_day_for_week(date_start)
+    df_all = generate_daily_report_df(date_start, df_verifications_by_rp)
+    for day, df_day in df_all.groupby(billing.VERIFICATION_DATE_COLUMN):
+        df_export = df_day[RP_REPORT_COLUMNS].reset_index(drop=True)
+        export_metrics_to_csv(df_export, report_output_path, day.date().isoformat(), RP_DAILY_REPORT_OUTPUT_FOLDER)
+    return df_all
+
+
+def generate_daily_reports_for_date_range(date_start, date_end, report_output_path):
+    for week in get_report_weeks(date_start, date_end):
+        logging.info(f'Generating daily reports for week starting {week}')
+        generate_daily_report_for_date(week, report_output_path)
+
+
+def generate_daily_report_df(date_start, df_verifications_by_rp):
+    df = add_daily_piwik_data(date_start, df_verifications_by_rp)
+    transform_metrics(df)
+    return df
 
 
 def generate_weekly_report_df(date_start, df_verifications_by_rp):
@@ -167,9 +755,39 @@ def transform_metrics(df):
 def add_piwik_data(date_start, df_verifications_by_rp):
     df_successes_rp = get_df_successes_by_rp(df_verifications_by_rp)
     df_all_rp = get_df_for_all_rps(df_successes_rp)
-    for rp in get_rp_names_from_df(df_all_rp):
-        add_piwik_data_for_rp(date_start, df_all_rp, rp)
-    return df_all_rp
+    rps = get_rp_names_from_df(df_all_rp)
+    return merge_piwik_data(df_all_rp, rps, get_piwik_data_for_rps(date_start, rps))
+
+
+def add_daily_piwik_data(date_start, df_verifications_by_rp):
+    """
+    :param df_verifications_by_rp: verification counts by day with RP names
+    :return: pandas.Dataframe with the successes and Piwik data for each day of the week and RP
+    """
+    days = get_report_days(date_start)
+    df_successes_rp = get_df_successes_by_rp(df_verifications_by_rp, by_date=True)
+    df_all_rp = get_df_for_all_rps_by_date(df_successes_rp, days)
+    rps = get_rp_names_from_df(df_all_rp)
+    date_range = f'{days[0].date().isoformat()},{days[-1].date().isoformat()}'
+    piwik_data = get_piwik_data_for_rps(date_range, rps, piwik.client_for_period('day'))
+    return df_all_rp.merge(get_df_piwik_data_by_date(rps, piwik_data), on=[billing.VERIFICATION_DATE_COLUMN, 'rp'],
+                           how='left', validate='one_to_one')
+
+
+def get_piwik_data_for_rps(date_start, rps, piwik_client=None):
+    """
+    Fetch Piwik data for several RPs at once, keeping at most `PIWIK_MAX_CONCURRENT_REQUESTS` requests in flight
+    :param date_start: start date for the week
+    :param rps: list of RP names
+    :param piwik_client: PiwikClient to query instead of the default one, e.g. for other periods
+    :return: list of Piwik data dicts in the same order as `rps`
+    """
+    if config.PIWIK_CUSTOM_VARIABLE_BREAKDOWN:
+        return get_piwik_data_for_rps_by_custom_variable(date_start, rps, piwik_client)
+    if config.PIWIK_BULK_REQUESTS:
+        return get_piwik_data_for_rps_in_bulk(date_start, rps, piwik_client)
+    with ThreadPoolExecutor(max_workers=config.PIWIK_MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(partial(get_piwik_data_for_rp, date_start, piwik_client=piwik_client), rps))
 
 
 def get_df_for_all_rps(df_successes_rp):
@@ -183,19 +801,130 @@ def get_df_for_all_rps(df_successes_rp):
     return df_all_rp
 
 
-def add_piwik_data_for_rp(date_start, df_successes_rp, rp):
-    print("Getting data for {}".format(rp))
+def get_df_for_all_rps_by_date(df_successes_rp, days):
+    """
+    Add rows with no successes for each day and RP missing from daily successes, dropping any outside `days`
+    """
+    keys = [billing.VERIFICATION_DATE_COLUMN, 'rp']
+    all_rp_names = sorted(set(config.rp_mapping.values()))
+    index = pandas.MultiIndex.from_product([days, all_rp_names], names=keys)
+    return df_successes_rp.set_index(keys).reindex(index, fill_value=0).reset_index()
+
+
+def get_piwik_data_for_rps_in_bulk(date_start, rps, piwik_client=None):
+    """
+    Fetch Piwik data for several RPs by batching all of their queries into Piwik bulk requests
+    :param date_start: start date for the week
+    :param rps: list of RP names
+    :param piwik_client: PiwikClient to query instead of the default one
+    :return: list of Piwik data dicts in the same order as `rps`
+    """
+    bulk_request = piwik_client.bulk_request() if piwik_client else piwik.bulk_request()
+    pending_piwik_data = [get_piwik_data_for_rp(date_start, rp, bulk_request) for rp in rps]
+    bulk_request.send()
+    return [{column: result.value for column, result in piwik_data.items()} for piwik_data in pending_piwik_data]
+
+
+def get_piwik_data_for_rps_by_custom_variable(date_start, rps, piwik_client=None):
+    """
+    Fetch Piwik data for several RPs in one bulk request, getting each journey type's attempts for every RP from a
+    single query broken down by the RP custom variable, rather than from a query per RP and journey type. So are the
+    visits to each funnel page if `PIWIK_FUNNEL_PAGE_BREAKDOWN` is set, rather than 2 queries per LOA2 RP.
+    :param date_start: start date for the week, or a range of dates when `piwik_client` queries shorter periods
+    :param rps: list of RP names
+    :param piwik_client: PiwikClient to query instead of the default one
+    :return: list of Piwik data dicts in the same order as `rps`, with no attempts for RPs Piwik had no visits for
+    """
+    piwik_client = piwik_client or piwik.get_piwik_client()
+    by_period = piwik.is_multi_period(piwik_client.period, date_start)
+    bulk_request = piwik_client.bulk_request()
+    attempts_by_rp = {column: piwik.get_all_attempts_by_rp(date_start, journey_type, bulk_request)
+                      for column, journey_type in ATTEMPT_JOURNEY_TYPES.items()}
+    if config.PIWIK_FUNNEL_PAGE_BREAKDOWN:
+        page_visits_by_rp = {column: piwik.get_page_visits_by_rp(date_start, page_title, bulk_request)
+                             for column, page_title in FUNNEL_PAGE_TITLES.items()}
+        pending_page_data = [{} for _ in rps]
+    else:
+        page_visits_by_rp = {}
+        pending_page_data = [get_piwik_page_data_for_rp(date_start, rp, bulk_request) for rp in rps]
+    bulk_request.send()
+
+    piwik_data = []
+    for rp, page_data in zip(rps, pending_page_data):
+        rp_data = {column: get_visits_for_rp(result.value, rp, by_period) for column, result in attempts_by_rp.items()}
+        if is_loa2(rp):
+            rp_data.update({column: get_visits_for_rp(result.value, rp, by_period)
+                            for column, result in page_visits_by_rp.items()})
+        rp_data.update({column: result.value for column, result in page_data.items()})
+        piwik_data.append(rp_data)
+    return piwik_data
+
+
+def get_visits_for_rp(visits_by_rp, rp, by_period=False):
+    """
+    :param visits_by_rp: dict of visits by RP name, or of those dicts by date if `by_period` is set
+    """
+    if by_period:
+        return {date: visits_by_rp_for_date.get(rp, 0) for date, visits_by_rp_for_date in visits_by_rp.items()}
+    return visits_by_rp.get(rp, 0)
+
+
+def get_piwik_data_for_rp(date_start, rp, piwik_client=None):
+    logging.debug(f'Getting Piwik data for {rp}')
     # Note: The below metric is no longer used, and so has been disabled.
-    # all_referrals = piwik.get_all_referrals_for_rp(rp, date_start)
-    # df_all.loc[(df_all['rp'] == rp), 'all_referrals'] = all_referrals
-    signin_attempts = piwik.get_all_signin_attempts_for_rp(rp, date_start)
-    signup_attempts = piwik.get_all_signup_attempts_for_rp(rp, date_start)
-    single_idp_attempts = piwik.get_all_single_idp_attempts_for_rp(rp, date_start)
-    df_successes_rp.loc[(df_successes_rp['rp'] == rp), 'signin_attempt'] = signin_attempts
-    df_successes_rp.loc[(df_successes_rp['rp'] == rp), 'signup_attempt'] = signup_attempts
-    df_successes_rp.loc[(df_successes_rp['rp'] == rp), 'single_idp_attempt'] = single_idp_attempts
-    if is_loa2(rp):
-        visits_will_not_work = piwik.get_visits_will_not_work(rp, date_start)
-        visits_might_not_work = piwik.get_visits_might_not_work(rp, date_start)
-        df_successes_rp.loc[(df_successes_rp['rp'] == rp), 'visits_will_not_work'] = visits_will_not_work
-        df_successes_rp.loc[(df_successes_rp['rp'] == rp), 'visits_might_not_work'] = visits_might_not_work
+    # piwik_data['all_referrals'] = piwik.get_all_referrals_for_rp(rp, date_start)
+    piwik_data = {
+        'signin_attempt': piwik.get_all_signin_attempts_for_rp(rp, date_start, piwik_client),
+        'signup_attempt': piwik.get_all_signup_attempts_for_rp(rp, date_start, piwik_client),
+        'single_idp_attempt': piwik.get_all_single_idp_attempts_for_rp(rp, date_start, piwik_client),
+    }
+    piwik_data.update(get_piwik_page_data_for_rp(date_start, rp, piwik_client))
+    return piwik_data
+
+
+def get_piwik_page_data_for_rp(date_start, rp, piwik_client=None):
+    if not is_loa2(rp):
+        return {}
+    return {
+        'visits_will_not_work': piwik.get_visits_will_not_work(rp, date_start, piwik_client),
+        'visits_might_not_work': piwik.get_visits_might_not_work(rp, date_start, piwik_client),
+    }
+
+
+def get_df_piwik_data(rps, piwik_data):
+    """
+    Collect Piwik data for several RPs into one dataframe, with a float column for each metric that any RP has
+    :param rps: list of RP names
+    :param piwik_data: list of Piwik data dicts in the same order as `rps`
+    :return: pandas.Dataframe with an 'rp' column and one row per RP, with NaN for metrics an RP doesn't have
+    """
+    columns = [column for column in PIWIK_DATA_COLUMNS if any(column in rp_data for rp_data in piwik_data)]
+    df_piwik_data = pandas.DataFrame(
+        {column: [rp_data.get(column, math.nan) for rp_data in piwik_data] for column in columns},
+        columns=columns, dtype='float64')
+    df_piwik_data.insert(0, 'rp', rps)
+    return df_piwik_data
+
+
+def get_df_piwik_data_by_date(rps, piwik_data):
+    """
+    Collect daily Piwik data for several RPs into one dataframe, like `get_df_piwik_data`
+    :param rps: list of RP names
+    :param piwik_data: list of Piwik data dicts in the same order as `rps`, with values by date for each metric
+    :return: pandas.Dataframe with `billing.VERIFICATION_DATE_COLUMN` and 'rp' columns and one row per day and RP
+    """
+    date_column = billing.VERIFICATION_DATE_COLUMN
+    columns = [column for column in PIWIK_DATA_COLUMNS if any(column in rp_data for rp_data in piwik_data)]
+    df_piwik_data = pandas.concat(
+        [pandas.DataFrame(rp_data, columns=columns, dtype='float64') for rp_data in piwik_data],
+        keys=rps, names=['rp', date_column]).reset_index()
+    df_piwik_data[date_column] = pandas.to_datetime(df_piwik_data[date_column])
+    return df_piwik_data
+
+
+def merge_piwik_data(df_successes_rp, rps, piwik_data):
+    """
+    Join Piwik data for several RPs onto their successes in one merge
+    :return: new pandas.Dataframe with the Piwik metrics as extra columns
+    """
+    return df_successes_rp.merge(get_df_piwik_data(rps, piwik_data), on='rp', how='left', validate='one_to_one')
@@ -1,14 +1,23 @@
+import json
+import math
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from unittest.mock import patch, call, MagicMock
 
 import pandas
+import pytest
 from pandas.util.testing import assert_frame_equal
 from performance import piwik
 
 from performance.reports.rp import (
     get_rp_names_from_df, get_df_successes_by_rp, export_metrics_to_csv,
-    add_piwik_data_for_rp, transform_metrics, get_df_for_all_rps, GoogleSheetsRelyingPartyReportExporter,
+    merge_piwik_data, transform_metrics, get_df_for_all_rps, GoogleSheetsRelyingPartyReportExporter,
+    add_piwik_data, get_report_weeks, generate_weekly_reports_for_date_range, generate_daily_report_for_date,
+    generate_weekly_report_for_date, get_verification_counts_for_week, GoogleSheetsExportResult,
+    create_google_sheets_exporter, GoogleSheetsExportError,
 )
+from performance import prod_config
 from performance.tests.fixtures import get_sample_verifications_by_rp_dataframe, get_sample_successes_by_rp_dataframe
 from datetime import date
 
@@ -57,24 +66,82 @@ def test_get_successes_by_rp():
     assert_frame_equal(expected_successes_df, actual_successes_df)
 
 
-@patch("os.path.exists", return_value=True)
-@patch.object(pandas.DataFrame, "to_csv")
-@patch.object(pandas.Series, "to_csv")
-def test_export_metrics_to_csv_writes_to_folder_for_week(mock_series_to_csv, mock_dataframe_to_csv, _):
+def test_get_successes_by_rp_with_one_response_type_only():
+    verifications_by_rp_df = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
+    verifications_by_rp_df['Response type'] = 'NEW'
+
+    expected_successes_df = pandas.DataFrame.from_dict({
+        0: ["RP 1", 1, 0],
+        1: ["RP 2", 1, 0]
+    },
+        orient="index", columns=["rp", "signup_success", "signin_success"])
+    actual_successes_df = get_df_successes_by_rp(verifications_by_rp_df)
+    assert_frame_equal(expected_successes_df, actual_successes_df)
+
+
+def test_get_successes_by_rp_ignores_unknown_response_types():
+    verifications_by_rp_df = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
+    verifications_by_rp_df['Response type'] = ['RETURNING', 'SOMETHING_ELSE']
+
+    expected_successes_df = pandas.DataFrame.from_dict({
+        0: ["RP 1", 0, 1],
+        1: ["RP 2", 0, 0]
+    },
+        orient="index", columns=["rp", "signup_success", "signin_success"])
+    actual_successes_df = get_df_successes_by_rp(verifications_by_rp_df)
+    assert_frame_equal(expected_successes_df, actual_successes_df)
+
+
+def test_get_successes_by_rp_without_verifications():
+    verifications_by_rp_df = get_sample_verifications_by_rp_dataframe(with_rp_name=True).iloc[0:0]
+
+    actual_successes_df = get_df_successes_by_rp(verifications_by_rp_df)
+
+    assert actual_successes_df.empty
+    assert actual_successes_df.columns.tolist() == ["rp", "signup_success", "signin_success"]
+
+
+def test_get_successes_by_rp_from_verification_counts():
+    verification_counts_df = pandas.DataFrame.from_dict({
+        0: ["RP 1", "RETURNING", 5],
+        1: ["RP 1", "NEW", 2],
+        2: ["RP 2", "NEW", 3],
+    },
+        orient="index", columns=["rp", "Response type", "count"])
+
+    expected_successes_df = pandas.DataFrame.from_dict({
+        0: ["RP 1", 2, 5],
+        1: ["RP 2", 3, 0]
+    },
+        orient="index", columns=["rp", "signup_success", "signin_success"])
+    actual_successes_df = get_df_successes_by_rp(verification_counts_df)
+    assert_frame_equal(expected_successes_df, actual_successes_df)
+
+
+def test_export_metrics_to_csv_writes_to_folder_for_week(tmpdir):
     df_export = get_test_metrics_dataframe()
-    report_output_path = "output-path"
+    report_output_path = str(tmpdir)
     date_start = "2001-01-01"
 
     export_metrics_to_csv(df_export, report_output_path, date_start)
 
-    mock_dataframe_to_csv.assert_called_with(
-        os.path.join(report_output_path, "rp_report", date_start, f'{date_start}-_all-rps-rp_report.csv'))
+    report_output_path_for_week = tmpdir.join("rp_report", date_start)
+    assert sorted(os.listdir(str(report_output_path_for_week))) == [
+        f'{date_start}-_all-rps-rp_report.csv',
+        f'{date_start}-rp1-rp_report.csv',
+        f'{date_start}-rp2-rp_report.csv',
+    ]
+    assert report_output_path_for_week.join(f'{date_start}-_all-rps-rp_report.csv').read() == df_export.to_csv()
+    assert report_output_path_for_week.join(f'{date_start}-rp2-rp_report.csv').read() == 'rp,rp2\nsuccess,1\n'
+
 
-    assert mock_series_to_csv.mock_calls == [
-        call(os.path.join(report_output_path, "rp_report", date_start, f'{date_start}-rp1-rp_report.csv')),
-        call(os.path.join(report_output_path, "rp_report", date_start, f'{date_start}-rp2-rp_report.csv'))
+def test_export_metrics_to_csv_quotes_and_blanks_values(tmpdir):
+    df_export = pandas.DataFrame({'rp': ['RP, with comma'], 'success': [None], 'success_fraction': [0.25]})
 
-    ]
+    export_metrics_to_csv(df_export, str(tmpdir), "2001-01-01")
+
+    assert tmpdir.join("rp_report", "2001-01-01", '2001-01-01-RP, with comma-rp_report.csv').read() == \
+        'rp,"RP, with comma"\nsuccess,\nsuccess_fraction,0.25\n'
 
 
 def test_transform_metrics_calculates_computed_metrics_accurately():
@@ -100,36 +167,216 @@ def test_transform_metrics_calculates_computed_metrics_accurately():
     assert_frame_equal(df, expected_df)
 
 
-@patch.object(piwik, 'get_visits_might_not_work')
-@patch.object(piwik, 'get_visits_will_not_work')
-@patch.object(piwik, 'get_all_single_idp_attempts_for_rp')
-@patch.object(piwik, 'get_all_signup_attempts_for_rp')
-@patch.object(piwik, 'get_all_signin_attempts_for_rp')
-def test_add_piwik_data_for_rp(mock_get_all_signin_attempts_for_rp, mock_get_all_signup_attempts_for_rp,
-                               mock_get_all_single_idp_attempts_for_rp, mock_get_visits_will_not_work,
-                               mock_get_visits_might_not_work):
-    date_start = '2018-09-01'
+def test_merge_piwik_data():
     df_successes_rp = get_sample_successes_by_rp_dataframe()
-    rp = 'RP 1'
-    mock_get_all_signin_attempts_for_rp.return_value = 150
-    mock_get_all_signup_attempts_for_rp.return_value = 250
-    mock_get_all_single_idp_attempts_for_rp.return_value = 50
-    mock_get_visits_will_not_work.return_value = 20
-    mock_get_visits_might_not_work.return_value = 30
+    piwik_data = [
+        {'signin_attempt': 150, 'signup_attempt': 250, 'single_idp_attempt': 50, 'visits_will_not_work': 20,
+         'visits_might_not_work': 30},
+        # LOA1 RPs have no will/might not work metrics
+        {'signin_attempt': 400, 'signup_attempt': 600, 'single_idp_attempt': 0},
+    ]
     expected_df = pandas.DataFrame.from_dict({
-        0: ['RP 1', 200, 100, 150.0, 250.0, 50.0, 20.0, 30.0]
+        0: ['RP 1', 200, 100, 150.0, 250.0, 50.0, 20.0, 30.0],
+        1: ['RP 2', 500, 300, 400.0, 600.0, 0.0, math.nan, math.nan],
     },
         orient="index",
         columns=["rp", "signup_success", "signin_success", "signin_attempt",
                  "signup_attempt", "single_idp_attempt",
                  "visits_will_not_work", "visits_might_not_work"])
 
-    add_piwik_data_for_rp(date_start, df_successes_rp, rp)
-    actual_df = df_successes_rp.loc[df_successes_rp['rp'] == rp]
+    actual_df = merge_piwik_data(df_successes_rp, ['RP 1', 'RP 2'], piwik_data)
 
     assert_frame_equal(expected_df, actual_df)
 
 
+def test_export_metrics_to_google_sheets_upserts_columns(config, rp_report_weekly):
+    report = rp_report_weekly.iloc[0:3]
+    config.rp_information['RP 2']['sheet_key'] = 'RP2SHEET'
+    config.rp_information['RP 3']['sheet_key'] = 'RP3SHEET'
+    exporter = GoogleSheetsRelyingPartyReportExporter(config, MagicMock(), upsert=True)
+    rp_1_values, rp_2_values, rp_3_values = [exporter.format_for_gsheets(row, '2001-01-01')
+                                             for row in report.itertuples()]
+    worksheets = {
+        # Exported before with the same values
+        '1234ABCD': MagicMock(**{'get_row.return_value': ['', '2001-01-08', '2001-01-01'],
+                                 'get_values.return_value': [rp_1_values[1:]]}),
+        # Exported before with different values
+        'RP2SHEET': MagicMock(**{'get_row.return_value': ['', '2001-01-01'],
+                                 'get_values.return_value': [[0] * 9]}),
+        # Not exported yet
+        'RP3SHEET': MagicMock(**{'get_row.return_value': ['', '2000-12-25']}),
+    }
+    exporter._pygsheets_client.open_by_key.side_effect = lambda sheet_key: MagicMock(
+        **{'worksheet_by_title.return_value': worksheets[sheet_key]})
+
+    exporter.export(report, '2001-01-01')
+
+    assert worksheets['1234ABCD'].get_values.call_args[0] == ((2, 3), (10, 3))
+    worksheets['1234ABCD'].update_col.assert_not_called()
+    worksheets['1234ABCD'].insert_cols.assert_not_called()
+    assert worksheets['RP2SHEET'].update_col.mock_calls == [call(2, rp_2_values)]
+    worksheets['RP2SHEET'].insert_cols.assert_not_called()
+    worksheets['RP3SHEET'].get_values.assert_not_called()
+    assert worksheets['RP3SHEET'].insert_cols.mock_calls == [call(1, 1)]
+    assert worksheets['RP3SHEET'].update_col.mock_calls == [call(2, [rp_3_values])]
+
+
+class FakeWorksheet:
+    """Holds a sheet as a list of columns, with the parts of the pygsheets worksheet API the exporter uses"""
+
+    def __init__(self, columns):
+        self.columns = [list(column) for column in columns]
+
+    def get_row(self, row):
+        return [column[row - 1] if row <= len(column) else '' for column in self.columns]
+
+    def get_values(self, start, end, **_):
+        return [column[start[0] - 1:end[0]] for column in self.columns[start[1] - 1:end[1]]]
+
+    def insert_cols(self, col, number):
+        self.columns[col:col] = [[] for _ in range(number)]
+
+    def update_col(self, index, values):
+        values_lists = values if values and isinstance(values[0], list) else [values]
+        for offset, column in enumerate(values_lists):
+            self.columns[index - 1 + offset] = list(column)
+
+    def delete_cols(self, index, number):
+        del self.columns[index - 1:index - 1 + number]
+
+
+def export_to_fake_worksheet(config, worksheet, *reports_and_headings):
+    exporter = GoogleSheetsRelyingPartyReportExporter(config, MagicMock(), upsert=True)
+    exporter._pygsheets_client.open_by_key.return_value.worksheet_by_title.return_value = worksheet
+    for report, column_heading in reports_and_headings:
+        exporter.export(report, column_heading)
+    return worksheet
+
+
+def test_export_metrics_to_google_sheets_upserts_every_rp_column_in_a_shared_sheet(config, rp_report_weekly):
+    report = rp_report_weekly.iloc[0:3]
+    changed_report = report.assign(number_of_signups=report.number_of_signups + [1, 2, 3])
+    worksheet = export_to_fake_worksheet(config, FakeWorksheet([['field']]), (report, '2001-01-08'),
+                                         (report, '2001-01-01'), (changed_report, '2001-01-01'))
+
+    expected_worksheet = export_to_fake_worksheet(config, FakeWorksheet([['field']]), (report, '2001-01-08'),
+                                                  (changed_report, '2001-01-01'))
+    assert worksheet.columns == expected_worksheet.columns
+    assert [column[6] for column in worksheet.columns[1:4]] == list(reversed(changed_report.number_of_signups))
+
+    # One RP more than last time, so every column for the week is written again
+    export_to_fake_worksheet(config, worksheet, (rp_report_weekly.iloc[0:4], '2001-01-01'))
+    expected_worksheet = export_to_fake_worksheet(config, FakeWorksheet([['field']]), (report, '2001-01-08'),
+                                                  (rp_report_weekly.iloc[0:4], '2001-01-01'))
+    assert worksheet.columns == expected_worksheet.columns
+
+
+def fake_piwik_metric(metric_name):
+    return lambda rp, date_start, piwik_client: len(f'{rp} {metric_name}')
+
+
+@patch.object(piwik, 'get_visits_might_not_work', side_effect=fake_piwik_metric('might not work'))
+@patch.object(piwik, 'get_visits_will_not_work', side_effect=fake_piwik_metric('will not work'))
+@patch.object(piwik, 'get_all_single_idp_attempts_for_rp', side_effect=fake_piwik_metric('single idp'))
+@patch.object(piwik, 'get_all_signup_attempts_for_rp', side_effect=fake_piwik_metric('signup'))
+@patch.object(piwik, 'get_all_signin_attempts_for_rp', side_effect=fake_piwik_metric('signin'))
+def test_add_piwik_data_fetches_concurrently_with_same_result_as_sequentially(*_):
+    date_start = '2018-09-01'
+    df_verifications_by_rp = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
+
+    with patch('performance.reports.rp.config.PIWIK_BULK_REQUESTS', False):
+        with patch('performance.reports.rp.config.PIWIK_MAX_CONCURRENT_REQUESTS', 1):
+            sequential_df = add_piwik_data(date_start, df_verifications_by_rp)
+        with patch('performance.reports.rp.config.PIWIK_MAX_CONCURRENT_REQUESTS', 4):
+            concurrent_df = add_piwik_data(date_start, df_verifications_by_rp)
+
+    assert_frame_equal(sequential_df, concurrent_df)
+    assert concurrent_df.loc[concurrent_df['rp'] == 'RP 3', 'signup_attempt'].tolist() == [len('RP 3 signup')]
+
+
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_add_piwik_data_in_bulk_maps_results_back_to_rps(mock_get_bulk):
+    def bulk_response(query_strings):
+        return [
+            [{'nb_visits': 7}] if qs['method'] == 'Actions.getPageTitles' else {'value': len(qs['segment'])}
+            for qs in query_strings
+        ]
+    mock_get_bulk.side_effect = bulk_response
+    date_start = '2018-09-01'
+    df_verifications_by_rp = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
+
+    with patch('performance.reports.rp.config.PIWIK_BULK_REQUESTS', True):
+        actual_df = add_piwik_data(date_start, df_verifications_by_rp)
+
+    # 4 RPs with 5 queries each, sent 5 at a time by the test configuration
+    assert mock_get_bulk.call_count == 4
+    rp_1 = actual_df.loc[actual_df['rp'] == 'RP 1'].iloc[0]
+    assert rp_1['signin_attempt'] == len(piwik.get_segment_query_string('RP 1', 'SIGN_IN'))
+    assert rp_1['single_idp_attempt'] == len(piwik.get_segment_query_string('RP 1', 'SINGLE_IDP'))
+    assert rp_1['visits_will_not_work'] == 7
+
+
+@patch('performance.reports.rp.config.PIWIK_CUSTOM_VARIABLE_BREAKDOWN', True)
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_add_piwik_data_by_custom_variable_gets_attempts_for_every_rp_at_once(mock_get_bulk):
+    visits_by_journey_type = {'SIGN_IN': {'RP 1': 11, 'RP 2': 12}, 'REGISTRATION': {'RP 1': 21}, 'SINGLE_IDP': {}}
+
+    def bulk_response(query_strings):
+        return [
+            [{'nb_visits': 7}] if qs['method'] == 'Actions.getPageTitles' else
+            [{'label': 'RP', 'slots': [{'scope': 'visit', 'index': 1}], 'subtable': [
+                {'label': rp, 'nb_visits': nb_visits}
+                for rp, nb_visits in visits_by_journey_type[qs['segment'].split('==')[1]].items()]}]
+            for qs in query_strings
+        ]
+    mock_get_bulk.side_effect = bulk_response
+    df_verifications_by_rp = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
+
+    actual_df = add_piwik_data('2018-09-01', df_verifications_by_rp).set_index('rp')
+
+    # 3 queries for the attempts of all RPs and 2 page queries for each of the 4 RPs, sent 5 at a time
+    sent_query_strings = [qs for c in mock_get_bulk.call_args_list for qs in c[0][0]]
+    assert len(sent_query_strings) == 11
+    assert sum(qs['method'] == 'CustomVariables.getCustomVariables' for qs in sent_query_strings) == 3
+    assert actual_df.loc['RP 1', ['signin_attempt', 'signup_attempt', 'single_idp_attempt']].tolist() == [11, 21, 0]
+    assert actual_df.loc['RP 2', ['signin_attempt', 'signup_attempt', 'single_idp_attempt']].tolist() == [12, 0, 0]
+    assert actual_df.loc['RP 4', 'signin_attempt'] == 0
+    assert actual_df.loc['RP 4', 'visits_will_not_work'] == 7
+
+
+@patch('performance.reports.rp.LOA1_RP_LIST', ['RP 3'])
+@patch('performance.reports.rp.config.PIWIK_FUNNEL_PAGE_BREAKDOWN', True)
+@patch('performance.reports.rp.config.PIWIK_CUSTOM_VARIABLE_BREAKDOWN', True)
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_add_piwik_data_by_custom_variable_gets_funnel_page_visits_for_every_rp_at_once(mock_get_bulk):
+    page_visits = {piwik.WILL_NOT_WORK_PAGE: {'RP 1': 5, 'RP 3': 6}, piwik.MIGHT_NOT_WORK_PAGE: {'RP 2': 8}}
+
+    def bulk_response(query_strings):
+        return [
+            [{'label': 'RP', 'slots': [{'scope': 'visit', 'index': 1}], 'subtable': [
+                {'label': rp, 'nb_visits': nb_visits}
+                for rp, nb_visits in page_visits.get(qs['segment'].split(';pageTitle=')[-1], {'RP 1': 1}).items()]}]
+            for qs in query_strings
+        ]
+    mock_get_bulk.side_effect = bulk_response
+    df_verifications_by_rp = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
+
+    actual_df = add_piwik_data('2018-09-01', df_verifications_by_rp).set_index('rp')
+
+    # 3 attempts queries and 2 funnel page queries for all RPs, in a single bulk request
+    assert mock_get_bulk.call_count == 1
+    sent_query_strings = mock_get_bulk.call_args[0][0]
+    assert {qs['method'] for qs in sent_query_strings} == {'CustomVariables.getCustomVariables'}
+    assert [qs['segment'] for qs in sent_query_strings[3:]] == [
+        f'customVariableValue3==REGISTRATION;pageTitle={piwik.WILL_NOT_WORK_PAGE}',
+        f'customVariableValue3==REGISTRATION;pageTitle={piwik.MIGHT_NOT_WORK_PAGE}',
+    ]
+    assert actual_df.loc['RP 1', ['visits_will_not_work', 'visits_might_not_work']].tolist() == [5, 0]
+    assert actual_df.loc['RP 2', ['visits_will_not_work', 'visits_might_not_work']].tolist() == [0, 8]
+    # RP 3 is LOA1, so isn't reported on for pages of the LOA2 journey
+    assert actual_df.loc['RP 3', ['visits_will_not_work', 'visits_might_not_work']].isnull().all()
+
+
 @patch('performance.reports.rp.config.rp_mapping', {
     "https://missing-rp-1.local": "Missing RP 1",
     "https://missing-rp-2.local": "Missing RP 2",
@@ -159,18 +406,355 @@ def test_export_metrics_to_google_sheets(config, rp_report_weekly):
     exporter = GoogleSheetsRelyingPartyReportExporter(config, pygsheets_client)
     exporter.export(rp_report_weekly, start_date)
 
-    number_of_rows = rp_report_weekly.shape[0]
-    assert pygsheets_client.open_by_key.call_count == number_of_rows
+    # All the test RPs share a sheet
+    pygsheets_client.open_by_key.assert_called_once_with('1234ABCD')
 
     santised_test_data = rp_report_weekly.fillna('')
-    assert worksheet_mock.insert_cols.mock_calls == [
-        call(1, 1, values=[
-            start_date,
-            row.all_referrals_with_intent,
-            row.success,
-            row.success_fraction_signup,
-            row.success_fraction_signin,
-            row.visits_will_not_work,
-            row.visits_might_not_work,
-        ]) for row in santised_test_data.itertuples()
+    assert worksheet_mock.insert_cols.mock_calls == [call(1, 4)]
+    assert worksheet_mock.update_col.mock_calls == [
+        call(2, [
+            [
+                start_date,
+                row.all_referrals_with_intent,
+                row.success,
+                row.success_fraction_signup,
+                row.success_fraction_signin,
+                row.overall_success_rate,
+                row.number_of_signups,
+                row.number_of_signins,
+                row.visits_will_not_work,
+                row.visits_might_not_work,
+            ] for row in reversed(list(santised_test_data.itertuples()))
+        ])
+    ]
+
+
+def test_export_metrics_to_google_sheets_concurrently_reports_failed_sheets(config, rp_report_weekly):
+    config.rp_information['RP 2']['sheet_key'] = 'FAILINGSHEET'
+    pygsheets_clients = []
+
+    def update_col(col, values):
+        # RP 2 is the only RP with 1242 visits_might_not_work
+        if values[0][-1] == 1242.0:
+            raise RuntimeError('sheet is protected')
+
+    def pygsheets_client_factory():
+        pygsheets_client = MagicMock()
+        worksheet_mock = pygsheets_client.open_by_key.return_value.worksheet_by_title.return_value
+        worksheet_mock.update_col.side_effect = update_col
+        pygsheets_clients.append(pygsheets_client)
+        return pygsheets_client
+
+    exporter = GoogleSheetsRelyingPartyReportExporter(config, MagicMock(), pygsheets_client_factory)
+    result = exporter.export(rp_report_weekly, '2001-01-01')
+
+    assert result.succeeded == ['1234ABCD']
+    assert list(result.failed) == ['FAILINGSHEET']
+    assert str(result.failed['FAILINGSHEET']) == 'sheet is protected'
+    assert 1 <= len(pygsheets_clients) <= config.GSHEETS_MAX_CONCURRENT_WRITES
+
+
+def test_export_metrics_to_google_sheets_opens_each_sheet_once_for_every_export(config, rp_report_weekly):
+    config.rp_information['RP 2']['sheet_key'] = 'RP2SHEET'
+    config.rp_information['RP 3']['sheet_key'] = 'RP3SHEET'
+    pygsheets_clients = []
+
+    def pygsheets_client_factory():
+        pygsheets_clients.append(MagicMock())
+        return pygsheets_clients[-1]
+
+    exporter = GoogleSheetsRelyingPartyReportExporter(config, MagicMock(), pygsheets_client_factory)
+    try:
+        for week in ['2001-01-01', '2001-01-08', '2001-01-15']:
+            assert exporter.export(rp_report_weekly, week).failed == {}
+    finally:
+        exporter.close()
+
+    assert len(pygsheets_clients) == config.GSHEETS_MAX_CONCURRENT_WRITES
+    assert sorted(c[0][0] for client in pygsheets_clients for c in client.open_by_key.call_args_list) == [
+        '1234ABCD', 'RP2SHEET', 'RP3SHEET']
+
+
+@patch('performance.reports.rp.get_pygsheets_client')
+def test_create_google_sheets_exporter_only_authorises_clients_when_exporting(mock_get_pygsheets_client,
+                                                                              rp_report_weekly):
+    exporter = create_google_sheets_exporter()
+    mock_get_pygsheets_client.assert_not_called()
+
+    try:
+        exporter.export(rp_report_weekly.iloc[0:1], '2001-01-01')
+    finally:
+        exporter.close()
+    mock_get_pygsheets_client.assert_called_once_with()
+
+
+def test_export_metrics_to_google_sheets_groups_rows_by_sheet(config, rp_report_weekly):
+    pygsheets_client = MagicMock()
+    config.rp_information['RP 2']['sheet_key'] = 'RP2SHEET'
+    config.rp_information['RP 3']['sheet_key'] = ''
+
+    exporter = GoogleSheetsRelyingPartyReportExporter(config, pygsheets_client)
+    exporter.export(rp_report_weekly, '2001-01-01')
+    exporter.export(rp_report_weekly, '2001-01-08')
+
+    # Each spreadsheet is only opened once, however many times it's written to
+    assert pygsheets_client.open_by_key.call_args_list == [call('1234ABCD'), call('RP2SHEET')]
+    assert pygsheets_client.open_by_key.return_value.worksheet_by_title.call_count == 2
+    worksheet_mock = pygsheets_client.open_by_key.return_value.worksheet_by_title.return_value
+    assert [c[1][:2] for c in worksheet_mock.insert_cols.mock_calls] == [(1, 2), (1, 1), (1, 2), (1, 1)]
+
+
+def test_get_report_weeks():
+    assert get_report_weeks('2018-07-02', '2018-07-22') == ['2018-07-02', '2018-07-09', '2018-07-16']
+    assert get_report_weeks('2018-07-02', '2018-07-02') == ['2018-07-02']
+    assert get_report_weeks('2018-07-02', '2018-07-01') == []
+
+
+@patch('performance.reports.rp.ProcessPoolExecutor', ThreadPoolExecutor)
+@patch('performance.reports.rp.IncrementalWeeklyReport')
+@patch('performance.reports.rp.create_google_sheets_exporter')
+@patch('performance.reports.rp.get_verification_counts_for_week', side_effect=lambda week: f'counts for {week}')
+@patch('performance.billing.get_verifications_by_rp_csv_path_for_date')
+def test_generate_weekly_reports_for_date_range_exports_changed_weeks_in_order(mock_get_csv_path, mock_get_counts,
+                                                                               mock_create_google_sheets_exporter,
+                                                                               mock_incremental_weekly_report,
+                                                                               tmpdir):
+    weeks = ['2018-07-02', '2018-07-09', '2018-07-16']
+    exported = []
+    reports = {week: MagicMock(date_start=week, **{
+        'is_up_to_date.return_value': week == '2018-07-09',
+        'create_pipeline.side_effect': lambda load_verifications, exporter: MagicMock(
+            run=lambda: exported.append((load_verifications(), exporter))),
+    }) for week in weeks}
+    mock_incremental_weekly_report.side_effect = lambda week, *_: reports[week]
+
+    generate_weekly_reports_for_date_range('2018-07-02', '2018-07-16', str(tmpdir))
+
+    assert sorted(c[0][0] for c in mock_get_csv_path.call_args_list) == weeks
+    mock_create_google_sheets_exporter.assert_called_once_with()
+    # The week which is up to date isn't loaded or exported
+    assert sorted(c[0][0] for c in mock_get_counts.call_args_list) == ['2018-07-02', '2018-07-16']
+    assert exported == [
+        (f'counts for {week}', mock_create_google_sheets_exporter.return_value) for week in ['2018-07-02', '2018-07-16']
+    ]
+    run_report = json.loads(tmpdir.join('rp_report', '2018-07-02_2018-07-16-run_report.json').read())
+    assert run_report['stages']['fetch_piwik_data']['count'] == 3
+
+
+@patch('performance.reports.rp.ProcessPoolExecutor', ThreadPoolExecutor)
+@patch('performance.reports.rp.IncrementalWeeklyReport')
+@patch('performance.reports.rp.create_google_sheets_exporter')
+@patch('performance.reports.rp.get_verification_counts_for_week', side_effect=lambda week: f'counts for {week}')
+@patch('performance.billing.get_verifications_by_rp_csv_path_for_date')
+def test_generate_weekly_reports_for_date_range_loads_billing_data_by_week(mock_get_csv_path, mock_get_counts,
+                                                                           mock_create_google_sheets_exporter,
+                                                                           mock_incremental_weekly_report, tmpdir):
+    loaded = []
+    reports = {week: MagicMock(date_start=week, **{
+        'is_up_to_date.return_value': False,
+        # The first week's RPs haven't changed, so it doesn't load its billing data
+        'create_pipeline.side_effect': lambda load_verifications, exporter, week=week: MagicMock(
+            run=lambda: week != '2018-07-02' and loaded.append((week, load_verifications()))),
+    }) for week in ['2018-07-02', '2018-07-09']}
+    mock_incremental_weekly_report.side_effect = lambda week, *_: reports[week]
+
+    generate_weekly_reports_for_date_range('2018-07-02', '2018-07-09', str(tmpdir))
+
+    assert loaded == [('2018-07-09', 'counts for 2018-07-09')]
+
+
+@patch('performance.reports.rp.ProcessPoolExecutor', ThreadPoolExecutor)
+@patch('performance.reports.rp.IncrementalWeeklyReport')
+@patch('performance.reports.rp.create_google_sheets_exporter')
+@patch('performance.reports.rp.get_verification_counts_for_week')
+@patch('performance.billing.get_verifications_by_rp_csv_path_for_date')
+def test_generate_weekly_reports_for_date_range_fails_after_every_week_if_a_sheet_failed(
+        mock_get_csv_path, mock_get_counts, mock_create_google_sheets_exporter, mock_incremental_weekly_report,
+        tmpdir):
+    exported = []
+
+    def run(week):
+        exported.append(week)
+        if week == '2018-07-02':
+            raise GoogleSheetsExportError([week], ['1234ABCD'])
+
+    reports = {week: MagicMock(date_start=week, **{
+        'is_up_to_date.return_value': False,
+        'create_pipeline.return_value.run.side_effect': partial(run, week),
+    }) for week in ['2018-07-02', '2018-07-09']}
+    mock_incremental_weekly_report.side_effect = lambda week, *_: reports[week]
+
+    with pytest.raises(GoogleSheetsExportError) as exc_info:
+        generate_weekly_reports_for_date_range('2018-07-02', '2018-07-09', str(tmpdir))
+
+    assert exported == ['2018-07-02', '2018-07-09']
+    assert exc_info.value.date_starts == ['2018-07-02']
+    mock_create_google_sheets_exporter.return_value.close.assert_called_once_with()
+
+
+@patch('performance.reports.rp.IncrementalWeeklyReport')
+def test_generate_weekly_reports_for_date_range_does_nothing_when_end_date_is_before_start(
+        mock_incremental_weekly_report, tmpdir):
+    generate_weekly_reports_for_date_range('2018-07-16', '2018-07-02', str(tmpdir))
+
+    mock_incremental_weekly_report.assert_not_called()
+    assert not tmpdir.listdir()
+
+
+def write_sample_verifications_by_rp_csv(tmpdir, date_start='2018-07-02', date_end='2018-07-08'):
+    verifications_directory = tmpdir.join('data', 'verifications')
+    verifications_directory.ensure(dir=True)
+    get_sample_verifications_by_rp_dataframe().to_csv(
+        str(verifications_directory.join(f'verifications_by_rp_{date_start}_{date_end}.csv')), index=False)
+
+
+@patch('performance.reports.rp.config.rp_mapping', {
+    "https://rp-entity-id-1.test.id": "RP 1",
+    "https://rp-entity-id-2.test.id": "RP 2",
+})
+@patch('performance.reports.rp.create_google_sheets_exporter')
+@patch('performance.reports.rp.get_verification_counts_for_week', wraps=get_verification_counts_for_week)
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_generate_weekly_report_for_date_only_regenerates_changed_rps(mock_get_bulk, mock_get_counts,
+                                                                      mock_create_google_sheets_exporter, tmpdir):
+    mock_get_bulk.side_effect = lambda query_strings: [
+        [{'nb_visits': 1}] if qs['method'] == 'Actions.getPageTitles' else {'value': 10} for qs in query_strings
+    ]
+    exporter = mock_create_google_sheets_exporter.return_value
+    exporter.export.return_value = GoogleSheetsExportResult()
+    write_sample_verifications_by_rp_csv(tmpdir)
+    week_directory = tmpdir.join('rp_report', '2018-07-02')
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+        assert mock_get_counts.call_count == 1
+        assert sorted(row.rp for row in exporter.export.call_args[0][0].itertuples()) == ['RP 1', 'RP 2']
+        assert week_directory.join('manifest.json').check()
+        run_report = json.loads(week_directory.join('run_report.json').read())
+        assert {'fetch_piwik_data', 'load_verifications', 'transform_metrics', 'export_csv',
+                'export_google_sheets'} <= set(run_report['stages'])
+        assert run_report['counters']['rps_exported'] == 2
+
+        # Nothing has changed, so the verifications report isn't even loaded
+        generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+        assert mock_get_counts.call_count == 1
+        assert exporter.export.call_count == 1
+
+        # RP 1's file has been deleted, so it's written again
+        week_directory.join('2018-07-02-RP 1-rp_report.csv').remove()
+        generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+        assert mock_get_counts.call_count == 2
+        assert week_directory.join('2018-07-02-RP 1-rp_report.csv').check()
+        assert json.loads(week_directory.join('run_report.json').read())['counters']['rps_exported'] == 1
+
+        # Only RP 2's config has changed, and it has a sheet of its own
+        week_directory.join('2018-07-02-RP 1-rp_report.csv').write('unchanged')
+        rp_2_information = dict(prod_config.rp_information['RP 2'], service_description='New', sheet_key='RP2SHEET')
+        with patch.dict('performance.reports.rp.config.rp_information', {'RP 2': rp_2_information}):
+            generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+        assert mock_get_counts.call_count == 3
+        assert [row.rp for row in exporter.export.call_args[0][0].itertuples()] == ['RP 2']
+        assert week_directory.join('2018-07-02-RP 1-rp_report.csv').read() == 'unchanged'
+        assert week_directory.join('2018-07-02-RP 2-rp_report.csv').check()
+
+
+@patch('performance.reports.rp.config.rp_mapping', {
+    "https://rp-entity-id-1.test.id": "RP 1",
+    "https://rp-entity-id-2.test.id": "RP 2",
+})
+@patch('performance.reports.rp.create_google_sheets_exporter')
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_generate_weekly_report_for_date_fails_when_a_sheet_fails_to_export(mock_get_bulk,
+                                                                            mock_create_google_sheets_exporter,
+                                                                            tmpdir):
+    mock_get_bulk.side_effect = lambda query_strings: [
+        [{'nb_visits': 1}] if qs['method'] == 'Actions.getPageTitles' else {'value': 10} for qs in query_strings
+    ]
+    result = GoogleSheetsExportResult()
+    result.failed['1234ABCD'] = RuntimeError('sheet is protected')
+    mock_create_google_sheets_exporter.return_value.export.return_value = result
+    write_sample_verifications_by_rp_csv(tmpdir)
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        with pytest.raises(GoogleSheetsExportError) as exc_info:
+            generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+
+    assert exc_info.value.sheet_keys == ['1234ABCD']
+    # The CSV files and manifest are still written, without the RPs whose sheet failed
+    manifest = json.loads(tmpdir.join('rp_report', '2018-07-02', 'manifest.json').read())
+    assert manifest['verifications'] is not None
+    assert manifest['rps'] == {}
+    assert tmpdir.join('rp_report', '2018-07-02', '2018-07-02-RP 1-rp_report.csv').check()
+
+
+@patch('performance.reports.rp.config.rp_mapping', {
+    "https://rp-entity-id-1.test.id": "RP 1",
+    "https://rp-entity-id-2.test.id": "RP 2",
+})
+@patch('performance.reports.rp.create_google_sheets_exporter')
+@patch('performance.billing.get_report_file')
+@patch('performance.reports.rp.get_verification_counts_for_week', wraps=get_verification_counts_for_week)
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_generate_weekly_report_for_date_checks_s3_for_a_new_report_before_hashing(mock_get_bulk, mock_get_counts,
+                                                                                   mock_get_report_file,
+                                                                                   mock_create_google_sheets_exporter,
+                                                                                   tmpdir):
+    mock_get_bulk.side_effect = lambda query_strings: [
+        [{'nb_visits': 1}] if qs['method'] == 'Actions.getPageTitles' else {'value': 10} for qs in query_strings
+    ]
+    mock_create_google_sheets_exporter.return_value.export.return_value = GoogleSheetsExportResult()
+    write_sample_verifications_by_rp_csv(tmpdir)
+    csv_path = tmpdir.join('data', 'verifications', 'verifications_by_rp_2018-07-02_2018-07-08.csv')
+    # Downloaded from S3 before
+    tmpdir.join('data', 'verifications', 'verifications_by_rp_2018-07-02_2018-07-08.csv.etag').write(
+        json.dumps({'etag': '"old"', 'size': csv_path.size()}))
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+        assert mock_get_counts.call_count == 1
+
+        # The report in S3 has since been replaced by one with another verification
+        mock_get_report_file.side_effect = lambda bucket_name, file_path, destination: csv_path.write(
+            csv_path.read() + csv_path.readlines()[-1])
+        generate_weekly_report_for_date('2018-07-02', str(tmpdir))
+
+    assert mock_get_counts.call_count == 2
+    assert mock_create_google_sheets_exporter.return_value.export.call_count == 2
+
+
+@patch('performance.reports.rp.config.rp_mapping', {
+    "https://rp-entity-id-1.test.id": "RP 1",
+    "https://rp-entity-id-2.test.id": "RP 2",
+})
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_generate_daily_report_for_date_buckets_verifications_by_day(mock_get_bulk, tmpdir):
+    days = [f'2018-07-0{day}' for day in range(2, 9)]
+    mock_get_bulk.side_effect = lambda query_strings: [
+        {day: [{'nb_visits': 1}] for day in days} if qs['method'] == 'Actions.getPageTitles' else
+        {day: 10 for day in days}
+        for qs in query_strings
     ]
+    verifications_directory = tmpdir.mkdir('data').mkdir('verifications')
+    pandas.DataFrame.from_dict({
+        0: ["https://rp-entity-id-1.test.id", "2018-07-02T10:00:00.000Z", "RETURNING", "https://idp/sso"],
+        # Verifications are bucketed by day in London, where this is the early hours of 3 July
+        1: ["https://rp-entity-id-1.test.id", "2018-07-02T23:30:00.000Z", "NEW", "https://idp/sso"],
+        2: ["https://rp-entity-id-2.test.id", "2018-07-04T01:00:00.000Z", "NEW", "https://idp/sso"],
+    }, orient="index", columns=["RP Entity Id", "Timestamp", "Response type", "IDP Entity Id"]).to_csv(
+        str(verifications_directory.join('verifications_by_rp_2018-07-02_2018-07-08.csv')), index=False)
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        df_all = generate_daily_report_for_date('2018-07-02', str(tmpdir))
+
+    assert {(qs['period'], qs['date']) for batch in mock_get_bulk.call_args_list for qs in batch[0][0]} == {
+        ('day', '2018-07-02,2018-07-08')}
+    assert len(df_all) == 14
+    successes = df_all.set_index(['Date', 'rp'])[['signin_success', 'signup_success']]
+    assert successes.loc[(pandas.Timestamp('2018-07-02'), 'RP 1')].tolist() == [1, 0]
+    assert successes.loc[(pandas.Timestamp('2018-07-03'), 'RP 1')].tolist() == [0, 1]
+    assert successes.loc[(pandas.Timestamp('2018-07-04'), 'RP 2')].tolist() == [0, 1]
+    assert successes.values.sum() == 3
+    assert (df_all['signin_attempt'] == 10).all()
+    assert (df_all['visits_will_not_work'] == 1).all()
+    assert tmpdir.join('rp_report_daily', '2018-07-03', '2018-07-03-RP 1-rp_report.csv').check()
+    assert len(tmpdir.join('rp_report_daily').listdir()) == 7
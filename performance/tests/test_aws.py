@@ -0,0 +1,112 @@
+import hashlib
+import io
+import json
+from unittest.mock import patch, Mock, ANY
+
+import pytest
+
+from performance import aws
+
+
+def get_mock_s3_client(etag, size):
+    s3_client = Mock()
+    s3_client.head_object.return_value = {'ETag': etag, 'ContentLength': size}
+    return s3_client
+
+
+def test_get_report_file_skips_download_when_local_etag_matches(tmpdir):
+    destination = tmpdir.join('report.csv')
+    destination.write('content')
+    tmpdir.join('report.csv.etag').write(json.dumps({'etag': '"abc-2"', 'size': 7}))
+    s3_client = get_mock_s3_client('"abc-2"', 7)
+
+    with patch('performance.aws.get_s3_client', return_value=s3_client):
+        downloaded = aws.get_report_file('bucket', 'rp/report.csv', str(destination))
+
+    assert not downloaded
+    s3_client.head_object.assert_called_once_with(Bucket='bucket', Key='rp/report.csv')
+    s3_client.download_file.assert_not_called()
+
+
+def test_get_report_file_skips_download_when_md5_matches_single_part_etag(tmpdir):
+    destination = tmpdir.join('report.csv')
+    destination.write('content')
+    s3_client = get_mock_s3_client(f'"{hashlib.md5(b"content").hexdigest()}"', 7)
+
+    with patch('performance.aws.get_s3_client', return_value=s3_client):
+        assert not aws.get_report_file('bucket', 'rp/report.csv', str(destination))
+
+    s3_client.download_file.assert_not_called()
+
+
+def test_get_report_file_downloads_changed_object_and_records_etag(tmpdir):
+    destination = tmpdir.join('report.csv')
+    destination.write('old content')
+    tmpdir.join('report.csv.etag').write(json.dumps({'etag': '"old"', 'size': 11}))
+    s3_client = get_mock_s3_client('"new"', 11)
+    s3_client.download_file.side_effect = lambda bucket, key, path, Config: open(path, 'w').write('new content')
+
+    with patch('performance.aws.get_s3_client', return_value=s3_client):
+        assert aws.get_report_file('bucket', 'rp/report.csv', str(destination))
+
+    s3_client.download_file.assert_called_once_with('bucket', 'rp/report.csv', ANY, Config=ANY)
+    assert destination.read() == 'new content'
+    assert json.loads(tmpdir.join('report.csv.etag').read()) == {'etag': '"new"', 'size': 11}
+    assert sorted(tmpdir.listdir()) == [destination, tmpdir.join('report.csv.etag')]
+
+
+def test_saving_streaming_body_saves_object_once_read_in_full(tmpdir):
+    destination = tmpdir.join('report.csv')
+
+    with aws.SavingStreamingBody(io.BytesIO(b'a,b\n1,2\n'), str(destination), '"etag"', 8) as stream:
+        assert stream.read(4) == b'a,b\n'
+        assert not destination.check()
+        assert stream.read() == b'1,2\n'
+
+    assert destination.read_binary() == b'a,b\n1,2\n'
+    assert json.loads(tmpdir.join('report.csv.etag').read()) == {'etag': '"etag"', 'size': 8}
+
+
+def test_saving_streaming_body_discards_partly_read_object(tmpdir):
+    with aws.SavingStreamingBody(io.BytesIO(b'a,b\n1,2\n'), str(tmpdir.join('report.csv')), '"etag"', 8) as stream:
+        stream.read(4)
+
+    assert tmpdir.listdir() == []
+
+
+def test_saving_streaming_body_raises_on_truncated_object(tmpdir):
+    stream = aws.SavingStreamingBody(io.BytesIO(b'a,b\n'), str(tmpdir.join('report.csv')), '"etag"', 8)
+
+    with pytest.raises(IOError):
+        stream.read()
+
+    assert tmpdir.listdir() == []
+
+
+@patch('performance.aws.config.S3_MULTIPART_CHUNKSIZE', 4)
+def test_file_matches_multipart_etag(tmpdir):
+    path = tmpdir.join('report.csv')
+    path.write('a,b\n1,2\n3')
+    part_md5s = b''.join(hashlib.md5(part).digest() for part in (b'a,b\n', b'1,2\n', b'3'))
+    etag = f'"{hashlib.md5(part_md5s).hexdigest()}-3"'
+
+    assert aws.file_matches_etag(str(path), etag)
+    assert not aws.file_matches_etag(str(path), f'"{hashlib.md5(part_md5s).hexdigest()}-2"')
+
+
+@patch('performance.aws.boto3.Session')
+def test_get_s3_client_creates_new_client_after_fork(mock_session, monkeypatch):
+    monkeypatch.setattr(aws, '_session', None)
+    monkeypatch.setattr(aws, '_s3_client', None)
+    monkeypatch.setattr(aws, '_session_pid', 1)
+    mock_session.return_value.client.side_effect = lambda service: Mock()
+
+    with patch('performance.aws.os.getpid', return_value=1):
+        s3_client = aws.get_s3_client()
+        assert aws.get_s3_client() is s3_client
+    with patch('performance.aws.os.getpid', return_value=2):
+        forked_s3_client = aws.get_s3_client()
+        assert aws.get_s3_client() is forked_s3_client
+
+    assert forked_s3_client is not s3_client
+    assert mock_session.call_count == 2
@@ -0,0 +1,92 @@
+import pytest
+from pandas.util.testing import assert_frame_equal
+
+from performance.benchmarks.generator import generate_verifications_by_rp, get_rp_mapping, write_verifications_by_rp_csv
+from performance.benchmarks.suite import (
+    MEMORY_ENVIRONMENT, STARTUP_COMMANDS, SLOW_IMPORTS, find_regressions, get_environment_differences,
+    get_startup_imports,
+)
+from performance.billing import read_verifications_by_rp_csv
+
+
+def test_generate_verifications_by_rp_is_seeded():
+    df_verifications_by_rp = generate_verifications_by_rp(1000, rps=5, idps=2, seed=1)
+
+    assert_frame_equal(df_verifications_by_rp, generate_verifications_by_rp(1000, rps=5, idps=2, seed=1))
+    assert not df_verifications_by_rp.equals(generate_verifications_by_rp(1000, rps=5, idps=2, seed=2))
+
+
+def test_generate_verifications_by_rp_follows_parameters():
+    df_verifications_by_rp = generate_verifications_by_rp(1000, rps=5, idps=2, response_type_mix={'NEW': 1},
+                                                          date_start='2018-07-02')
+
+    assert list(df_verifications_by_rp.columns) == ['RP Entity Id', 'Timestamp', 'Response type', 'IDP Entity Id']
+    assert set(df_verifications_by_rp['RP Entity Id']) == set(get_rp_mapping(5))
+    assert df_verifications_by_rp['IDP Entity Id'].nunique() == 2
+    assert set(df_verifications_by_rp['Response type']) == {'NEW'}
+    assert df_verifications_by_rp['Timestamp'].min() >= '2018-07-02T00:00:00.000Z'
+    assert df_verifications_by_rp['Timestamp'].max() < '2018-07-09T00:00:00.000Z'
+
+
+def test_write_verifications_by_rp_csv_writes_in_chunks(tmpdir):
+    path = str(tmpdir.join('verifications_by_rp.csv'))
+
+    write_verifications_by_rp_csv(path, 25, chunk_rows=10)
+
+    assert len(read_verifications_by_rp_csv(path)) == 25
+
+
+def test_find_regressions_ignores_small_differences():
+    baseline = {'results': {'1m': {
+        'stage 1': {'seconds': 1.0, 'peak_memory_bytes': 100 * 1024 * 1024},
+        'stage 2': {'seconds': 0.01, 'peak_memory_bytes': 1024},
+    }}}
+    results = {'1m': {
+        'stage 1': {'seconds': 1.5, 'peak_memory_bytes': 101 * 1024 * 1024},
+        'stage 2': {'seconds': 0.02, 'peak_memory_bytes': 2048},
+    }}
+
+    assert find_regressions(results, baseline, tolerance=0.25) == [
+        '1m stage 1 seconds: 1.5 against a baseline of 1.0']
+
+
+def test_find_regressions_only_compares_memory_without_timings():
+    baseline = {'results': {'1m': {'stage 1': {'seconds': 1.0, 'peak_memory_bytes': 100 * 1024 * 1024}}}}
+    results = {'1m': {'stage 1': {'seconds': 2.0, 'peak_memory_bytes': 200 * 1024 * 1024}}}
+
+    assert find_regressions(results, baseline, tolerance=0.25, compare_timings=False) == [
+        f'1m stage 1 peak_memory_bytes: {200 * 1024 * 1024} against a baseline of {100 * 1024 * 1024}']
+
+
+def test_get_environment_differences():
+    environment = {'python': '3.6.8', 'pandas': '0.23.4', 'processor_count': 4}
+
+    assert get_environment_differences(environment, environment) == []
+    assert get_environment_differences(dict(environment, processor_count=1), environment) == [
+        'processor_count is 4 rather than 1']
+    assert get_environment_differences(None, environment) == [
+        'the baseline does not record the environment it was recorded in']
+
+
+def test_get_environment_differences_only_compares_names_given():
+    environment = {'python': '3.6.8', 'pandas': '0.23.4', 'numpy': '1.15.4', 'processor_count': 4}
+
+    assert get_environment_differences(dict(environment, processor_count=1), environment, MEMORY_ENVIRONMENT) == []
+    assert get_environment_differences(dict(environment, numpy='1.16.0'), environment, MEMORY_ENVIRONMENT) == [
+        'numpy is 1.15.4 rather than 1.16.0']
+
+
+def test_find_regressions_compares_nothing_without_timings_or_memory():
+    baseline = {'results': {'1m': {'stage 1': {'seconds': 1.0, 'peak_memory_bytes': 100 * 1024 * 1024}}}}
+    results = {'1m': {'stage 1': {'seconds': 2.0, 'peak_memory_bytes': 200 * 1024 * 1024}}}
+
+    assert find_regressions(results, baseline, tolerance=0.25, compare_timings=False, compare_memory=False) == []
+
+
+@pytest.mark.parametrize('name', list(STARTUP_COMMANDS))
+def test_startup_commands_dont_import_slow_modules(name):
+    assert get_startup_imports(STARTUP_COMMANDS[name]).isdisjoint(SLOW_IMPORTS)
+
+
+def test_get_startup_imports_finds_imported_modules():
+    assert {'json', 'pandas'} <= get_startup_imports(['-c', 'import json, pandas'])
@@ -1,9 +1,13 @@
-from unittest.mock import patch
+import io
+from unittest.mock import patch, ANY, Mock
 
+import pandas
+import pytest
 from pandas.util.testing import assert_frame_equal
 
 import performance.billing as billing
-from performance.tests.fixtures import get_sample_verifications_by_rp_dataframe, get_sample_rp_mapping
+from performance.config import get_sample_rp_mapping
+from performance.tests.fixtures import get_sample_verifications_by_rp_dataframe
 from performance import prod_config as config
 
 
@@ -18,10 +22,41 @@ def test_extract_verifications_with_local_rp_csv_for_date(mock_get_report,
     billing.extract_verifications_by_rp_csv_for_date(date_start)
 
     mock_get_report.assert_not_called()
-    mock_pandas_read_csv.assert_called_with(expected_verification_csv_filepath_to_load)
+    mock_pandas_read_csv.assert_called_with(expected_verification_csv_filepath_to_load, usecols=None,
+                                            dtype=billing.VERIFICATIONS_BY_RP_DTYPES, chunksize=None)
 
 
-@patch('os.path.exists', side_effect=[False, True])  # File does not exist but data/verifications directory does
+@patch('os.path.exists', return_value=True)
+@patch('pandas.read_csv')
+@patch('performance.billing.get_report_file')
+def test_extract_verifications_only_parses_requested_columns(mock_get_report, mock_pandas_read_csv, _):
+    billing.extract_verifications_by_rp_csv_for_date('2018-07-02', columns=['RP Entity Id', 'Response type'])
+
+    mock_pandas_read_csv.assert_called_with(ANY, usecols=['RP Entity Id', 'Response type'],
+                                            dtype={'RP Entity Id': 'category', 'Response type': 'category'},
+                                            chunksize=None)
+
+
+def test_count_verifications_by_rp_csv_for_date_streams_chunks(tmpdir):
+    verifications_directory = tmpdir.mkdir('data').mkdir('verifications')
+    sample_verifications_by_rp = pandas.concat([get_sample_verifications_by_rp_dataframe()] * 3, ignore_index=True)
+    sample_verifications_by_rp.to_csv(
+        str(verifications_directory.join('verifications_by_rp_2018-07-02_2018-07-08.csv')), index=False)
+    expected_counts = pandas.DataFrame({
+        'RP Entity Id': ["https://rp-entity-id-1.test.id", "https://rp-entity-id-2.test.id"],
+        'Response type': ["RETURNING", "NEW"],
+        'count': [3, 3],
+    }).astype({'RP Entity Id': 'category', 'Response type': 'category'})
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        actual_counts = billing.count_verifications_by_rp_csv_for_date('2018-07-02', chunksize=2)
+
+    assert_frame_equal(expected_counts, actual_counts)
+
+
+@patch('performance.billing.config.S3_STREAM_REPORTS', False)
+# File does not exist but data/verifications directory does, then the file has been downloaded
+@patch('os.path.exists', side_effect=[False, True, True])
 @patch('pandas.read_csv', return_value={})
 @patch('performance.billing.get_report_file')
 def test_retrieve_report_file_from_s3_when_no_local_exists(mock_get_report, mock_pandas_read_csv, mock_path_exists):
@@ -35,10 +70,89 @@ def test_retrieve_report_file_from_s3_when_no_local_exists(mock_get_report, mock
     mock_get_report.assert_called_with(config.S3_BILLING_REPORTS_BUCKET, s3_path, destination_path)
 
 
+def test_count_verifications_by_rp_csv_for_date_parses_report_as_it_streams_from_s3(tmpdir):
+    sample_csv = get_sample_verifications_by_rp_dataframe().to_csv(index=False).encode('utf-8')
+    s3_client = Mock()
+    s3_client.get_object.return_value = {'Body': io.BytesIO(sample_csv), 'ETag': '"etag"',
+                                         'ContentLength': len(sample_csv)}
+    expected_counts = pandas.DataFrame({
+        'RP Entity Id': ["https://rp-entity-id-1.test.id", "https://rp-entity-id-2.test.id"],
+        'Response type': ["RETURNING", "NEW"],
+        'count': [1, 1],
+    }).astype({'RP Entity Id': 'category', 'Response type': 'category'})
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)), \
+            patch('performance.aws.get_s3_client', return_value=s3_client):
+        actual_counts = billing.count_verifications_by_rp_csv_for_date('2018-07-02', chunksize=1)
+
+    assert_frame_equal(expected_counts, actual_counts)
+    s3_client.get_object.assert_called_once_with(Bucket=config.S3_BILLING_REPORTS_BUCKET,
+                                                 Key='rp/verifications_by_rp_2018-07-02_2018-07-08.csv')
+    s3_client.download_file.assert_not_called()
+    local_copy = tmpdir.join('data', 'verifications', 'verifications_by_rp_2018-07-02_2018-07-08.csv')
+    assert local_copy.read_binary() == sample_csv
+
+
 @patch('performance.billing.config.rp_mapping', get_sample_rp_mapping())
 def test_augment_verifications_by_rp_with_rp_name():
     sample_verifications_by_rp = get_sample_verifications_by_rp_dataframe()
     expected_transformed_data = get_sample_verifications_by_rp_dataframe(with_rp_name=True)
 
+    expected_transformed_data['rp'] = expected_transformed_data['rp'].astype('category')
+
     billing.augment_verifications_by_rp_with_rp_name(sample_verifications_by_rp)
     assert_frame_equal(expected_transformed_data, sample_verifications_by_rp)
+
+
+@patch('performance.billing.config.rp_mapping', get_sample_rp_mapping())
+def test_augment_verifications_by_rp_with_rp_name_reports_all_unknown_entity_ids():
+    sample_verifications_by_rp = get_sample_verifications_by_rp_dataframe()
+    sample_verifications_by_rp['RP Entity Id'] = [
+        "https://unknown-rp-2.test.id", "https://unknown-rp-1.test.id"]
+
+    with pytest.raises(billing.UnknownRelyingPartyError) as exc_info:
+        billing.augment_verifications_by_rp_with_rp_name(sample_verifications_by_rp)
+
+    assert exc_info.value.entity_ids == ["https://unknown-rp-1.test.id", "https://unknown-rp-2.test.id"]
+    assert 'rp' not in sample_verifications_by_rp.columns
+
+
+def write_sample_verifications_by_rp_csv(tmpdir):
+    verifications_directory = tmpdir.mkdir('data').mkdir('verifications')
+    csv_path = verifications_directory.join('verifications_by_rp_2018-07-02_2018-07-08.csv')
+    get_sample_verifications_by_rp_dataframe().to_csv(str(csv_path), index=False)
+    return csv_path
+
+
+@patch('performance.billing.config.VERIFICATIONS_COLUMNAR_CACHE', True)
+def test_extract_verifications_reads_columnar_copy_on_later_runs(tmpdir):
+    write_sample_verifications_by_rp_csv(tmpdir)
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        parsed_verifications = billing.extract_verifications_by_rp_csv_for_date('2018-07-02')
+        with patch('pandas.read_csv', side_effect=AssertionError('CSV should not be parsed again')):
+            cached_verifications = billing.extract_verifications_by_rp_csv_for_date('2018-07-02')
+            cached_counts = billing.count_verifications_by_rp_csv_for_date('2018-07-02')
+
+    assert_frame_equal(parsed_verifications, cached_verifications)
+    assert cached_verifications['RP Entity Id'].dtype == 'category'
+    assert cached_counts['count'].tolist() == [1, 1]
+
+
+@patch('performance.billing.config.VERIFICATIONS_COLUMNAR_CACHE', True)
+def test_columnar_copy_is_only_used_while_it_matches_the_csv(tmpdir):
+    csv_path = write_sample_verifications_by_rp_csv(tmpdir)
+
+    with patch('performance.billing.config.VERIFY_DATA_PIPELINE_CONFIG_PATH', str(tmpdir)):
+        billing.count_verifications_by_rp_csv_for_date('2018-07-02')
+        # Same content downloaded again
+        csv_path.setmtime(csv_path.mtime() + 60)
+        assert billing.read_columnar_copy(str(csv_path), billing.VERIFICATIONS_BY_RP_REPORT_COLUMNS) is not None
+        # Columns that weren't copied
+        assert billing.read_columnar_copy(str(csv_path)) is None
+
+        pandas.concat([get_sample_verifications_by_rp_dataframe()] * 2).to_csv(str(csv_path), index=False)
+        assert billing.read_columnar_copy(str(csv_path), billing.VERIFICATIONS_BY_RP_REPORT_COLUMNS) is None
+        counts = billing.count_verifications_by_rp_csv_for_date('2018-07-02')
+
+    assert counts['count'].tolist() == [2, 2]
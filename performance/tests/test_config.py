@@ -1,6 +1,8 @@
 import json
 from unittest.mock import patch, mock_open
 
+import pytest
+
 import performance.config
 
 RP_MAPPING_STREAM = """
@@ -59,3 +61,23 @@ def test_instantiation_loads_rp_config():
     assert config.rp_mapping == sample_rp_mapping
 
     assert "rp-name-2" == config.rp_mapping["entityid-2"]
+
+
+@patch('performance.config.Config.VERIFY_DATA_PIPELINE_CONFIG_PATH', 'missing-config-path')
+def test_lazy_config_reads_class_settings_without_loading_configuration():
+    lazy_config = performance.config.LazyConfig(performance.config.Config)
+
+    assert lazy_config.DEFAULT_OUTPUT_PATH == performance.config.Config.DEFAULT_OUTPUT_PATH
+    with pytest.raises(FileNotFoundError):
+        lazy_config.rp_mapping
+
+
+def test_lazy_config_is_built_once_on_first_use():
+    lazy_config = performance.config.LazyConfig(performance.config.TestConfig)
+
+    lazy_config.rp_mapping['https://rp-entity-id-5.test.id'] = 'RP 5'
+    with patch.object(lazy_config, 'S3_STREAM_REPORTS', False):
+        assert lazy_config.S3_STREAM_REPORTS is False
+
+    assert lazy_config.rp_mapping['https://rp-entity-id-5.test.id'] == 'RP 5'
+    assert lazy_config.S3_STREAM_REPORTS is True
@@ -0,0 +1,66 @@
+from unittest.mock import Mock, call
+
+import pytest
+from googleapiclient.errors import HttpError
+
+from performance.gsheets import TokenBucket, GoogleSheetsRateLimiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_allows_bursts_then_limits_rate():
+    clock = FakeClock()
+    sleep = Mock(side_effect=clock.sleep)
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=sleep)
+
+    for _ in range(3):
+        bucket.acquire()
+    sleep.assert_not_called()
+
+    bucket.acquire(2)
+    assert sleep.mock_calls == [call(1.0)]
+    assert clock.now == 1.0
+
+
+def http_error(status):
+    return HttpError(Mock(status=status), b'')
+
+
+def get_rate_limiter_config():
+    config = Mock()
+    config.GSHEETS_REQUESTS_PER_MINUTE_PER_USER = 6000
+    config.GSHEETS_REQUESTS_PER_MINUTE_PER_PROJECT = 6000
+    config.GSHEETS_RATE_LIMIT_BURST = 100
+    config.GSHEETS_MAX_RETRIES = 2
+    config.GSHEETS_RETRY_BACKOFF_FACTOR = 1
+    return config
+
+
+def test_rate_limiter_backs_off_when_quota_exceeded():
+    sleep = Mock()
+    rate_limiter = GoogleSheetsRateLimiter(get_rate_limiter_config(), sleep=sleep)
+    api_call = Mock(side_effect=[http_error(429), http_error(429), 'result'])
+
+    assert rate_limiter.call(1, api_call, 'sheet-key') == 'result'
+    assert api_call.mock_calls == [call('sheet-key')] * 3
+    assert sleep.mock_calls == [call(1), call(2)]
+
+
+def test_rate_limiter_gives_up_after_max_retries_or_on_other_errors():
+    rate_limiter = GoogleSheetsRateLimiter(get_rate_limiter_config(), sleep=Mock())
+
+    with pytest.raises(HttpError):
+        rate_limiter.call(1, Mock(side_effect=[http_error(429)] * 3))
+    api_call = Mock(side_effect=http_error(403))
+    with pytest.raises(HttpError):
+        rate_limiter.call(1, api_call)
+    assert api_call.call_count == 1
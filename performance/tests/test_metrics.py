@@ -0,0 +1,64 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+from performance import metrics
+
+
+def get_fake_clock(*times):
+    return Mock(side_effect=list(times))
+
+
+def test_stage_times_are_added_up_by_name():
+    run_report = metrics.RunReport(clock=get_fake_clock(0, 1, 3, 10, 14, 20))
+
+    with run_report.stage('export_csv'):
+        pass
+    with run_report.stage('export_csv'):
+        pass
+
+    assert run_report.to_dict()['stages'] == {'export_csv': {'seconds': 6, 'count': 2}}
+
+
+def test_latencies_are_counted_into_buckets():
+    run_report = metrics.RunReport()
+
+    for seconds in [0.01, 0.05, 0.3, 0.3, 120]:
+        run_report.observe_latency('piwik.VisitsSummary.getVisits', seconds)
+
+    latency = run_report.to_dict()['latencies']['piwik.VisitsSummary.getVisits']
+    assert latency['count'] == 5
+    assert latency['max_seconds'] == 120
+    assert latency['buckets']['<=0.05'] == 2
+    assert latency['buckets']['<=0.5'] == 2
+    assert latency['buckets']['>60'] == 1
+    assert sum(latency['buckets'].values()) == 5
+
+
+def test_counters_can_be_incremented_from_several_threads():
+    run_report = metrics.RunReport()
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _: run_report.increment('piwik.bytes_received', 3), range(1000)))
+
+    assert run_report.to_dict()['counters'] == {'piwik.bytes_received': 3000}
+
+
+def test_save_writes_the_run_report_as_json(tmpdir):
+    run_report = metrics.RunReport()
+    run_report.increment('s3.downloads')
+    path = tmpdir.join('rp_report', '2018-07-02', metrics.RUN_REPORT_FILE_NAME)
+
+    run_report.save(str(path))
+
+    assert json.loads(path.read())['counters'] == {'s3.downloads': 1}
+    assert tmpdir.join('rp_report', '2018-07-02').listdir() == [path]
+
+
+def test_start_run_report_replaces_the_current_report():
+    metrics.run_report().increment('piwik.requests')
+
+    run_report = metrics.start_run_report()
+
+    assert metrics.run_report() is run_report
+    assert run_report.to_dict()['counters'] == {}
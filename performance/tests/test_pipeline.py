@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from performance.pipeline import Pipeline, SkipStage
+
+
+def test_independent_stages_run_at_the_same_time():
+    # Each stage waits for the other to start, so they'd time out if run one after the other
+    barrier = threading.Barrier(2, timeout=5)
+
+    def fetch(result):
+        barrier.wait()
+        return result
+    pipeline = Pipeline()
+    pipeline.add('fetch_billing', lambda: fetch('billing'))
+    pipeline.add('fetch_piwik', lambda: fetch('piwik'))
+    pipeline.add('transform', lambda billing, piwik: f'{billing} and {piwik}', ['fetch_billing', 'fetch_piwik'])
+
+    assert pipeline.run()['transform'] == 'billing and piwik'
+
+
+def test_stages_get_the_results_of_their_dependencies_in_order():
+    calls = []
+    pipeline = Pipeline()
+    pipeline.add('a', lambda: 1)
+    pipeline.add('b', lambda: calls.append('b'))
+    pipeline.add('c', lambda a: a + 1, ['a'])
+    pipeline.add('d', lambda c, a: calls.append('d') or (c, a), ['c', 'a'], after=['b'])
+
+    results = pipeline.run()
+
+    assert results['d'] == (2, 1)
+    assert calls == ['b', 'd']
+
+
+def test_skipped_stages_skip_the_stages_which_depend_on_them():
+    def skip():
+        raise SkipStage()
+    pipeline = Pipeline()
+    pipeline.add('load', skip)
+    pipeline.add('other', lambda: 'other')
+    pipeline.add('transform', lambda df: df, ['load'])
+    pipeline.add('export', lambda: 'export', after=['transform'])
+
+    assert pipeline.run() == {'other': 'other'}
+
+
+def test_failed_stages_stop_the_pipeline():
+    def fail():
+        raise IOError('Download failed')
+    exported = []
+    pipeline = Pipeline()
+    pipeline.add('load', fail)
+    pipeline.add('export', lambda df: exported.append(df), ['load'])
+
+    with pytest.raises(IOError):
+        pipeline.run()
+    assert exported == []
+
+
+def test_stages_can_only_depend_on_stages_already_added():
+    pipeline = Pipeline()
+
+    with pytest.raises(ValueError):
+        pipeline.add('transform', lambda df: df, ['load'])
@@ -3,7 +3,7 @@ from unittest.mock import patch, Mock
 import pytest
 from _pytest.fixtures import fixture
 
-from performance import piwik
+from performance import metrics, piwik
 
 
 @pytest.mark.parametrize("function_under_test,journey_type", [
@@ -138,17 +138,27 @@ def test_setup_variables(**update):
     return res
 
 
-@patch('requests.get')
-def test_get_nb_visits_for_rp(mock_requests_get, test_setup_variables):
-    mock_requests_get.return_value.json.return_value = {"value": 5}
-
+def get_mock_config(test_setup_variables):
     mock_config = Mock()
     mock_config.PIWIK_PERIOD = test_setup_variables['piwik_period']
     mock_config.PIWIK_LIMIT = test_setup_variables['piwik_filter_limit']
     mock_config.PIWIK_BASE_URL = test_setup_variables['piwik_base_url']
     mock_config.PIWIK_AUTH_TOKEN = test_setup_variables['piwik_auth_token']
+    mock_config.PIWIK_BULK_BATCH_SIZE = 2
+    mock_config.PIWIK_MAX_CONCURRENT_REQUESTS = 2
+    mock_config.PIWIK_POOL_SIZE = 2
+    mock_config.PIWIK_TIMEOUT = (1, 2)
+    mock_config.PIWIK_MAX_RETRIES = 3
+    mock_config.PIWIK_RETRY_BACKOFF_FACTOR = 0.5
+    mock_config.PIWIK_CACHE_ENABLED = False
+    return mock_config
 
-    piwik_client = piwik.PiwikClient(mock_config)
+
+@patch('requests.Session.get')
+def test_get_nb_visits_for_rp(mock_requests_get, test_setup_variables):
+    mock_requests_get.return_value.json.return_value = {"value": 5}
+
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables))
 
     expected_piwik_query_string = {
         'module': 'API',
@@ -166,21 +176,16 @@ def test_get_nb_visits_for_rp(mock_requests_get, test_setup_variables):
     visits_for_rp = piwik_client.get_nb_visits_for_rp(test_setup_variables['date'], test_setup_variables['segment'])
 
     assert visits_for_rp == 5
-    mock_requests_get.assert_called_with(test_setup_variables['piwik_base_url'], expected_piwik_query_string)
+    mock_requests_get.assert_called_with(
+        test_setup_variables['piwik_base_url'], params=expected_piwik_query_string, timeout=(1, 2))
 
 
-@patch('requests.get')
+@patch('requests.Session.get')
 def test_get_nb_visits_for_page(mock_requests_get, test_setup_variables):
     nb_visits_value = 8
     mock_requests_get.return_value.json.return_value = sample_get_page_titles_response(nb_visits_value)
 
-    mock_config = Mock()
-    mock_config.PIWIK_PERIOD = test_setup_variables['piwik_period']
-    mock_config.PIWIK_LIMIT = test_setup_variables['piwik_filter_limit']
-    mock_config.PIWIK_BASE_URL = test_setup_variables['piwik_base_url']
-    mock_config.PIWIK_AUTH_TOKEN = test_setup_variables['piwik_auth_token']
-
-    piwik_client = piwik.PiwikClient(mock_config)
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables))
 
     expected_piwik_query_string = {
         'module': 'API',
@@ -197,4 +202,216 @@ def test_get_nb_visits_for_page(mock_requests_get, test_setup_variables):
     visits_for_page = piwik_client.get_nb_visits_for_page(test_setup_variables['date'], test_setup_variables['segment'])
 
     assert visits_for_page == nb_visits_value
-    mock_requests_get.assert_called_with(test_setup_variables['piwik_base_url'], expected_piwik_query_string)
+    mock_requests_get.assert_called_with(
+        test_setup_variables['piwik_base_url'], params=expected_piwik_query_string, timeout=(1, 2))
+
+
+@patch('requests.Session.post')
+def test_get_bulk(mock_requests_post, test_setup_variables):
+    mock_requests_post.return_value.json.return_value = [{"value": 5}]
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables))
+    query_string = piwik_client.get_nb_visits_for_rp_query_string('test-date', 'customVariableValue1==rp')
+
+    raw_results = piwik_client.get_bulk([query_string])
+
+    assert raw_results == [{"value": 5}]
+    mock_requests_post.assert_called_with(test_setup_variables['piwik_base_url'], timeout=(1, 2), data={
+        'module': 'API',
+        'format': 'JSON',
+        'method': 'API.getBulkRequest',
+        'token_auth': test_setup_variables['piwik_auth_token'],
+        'urls[0]': 'idSite=1&filter_limit=-1&date=test-date&period=week&method=VisitsSummary.getVisits'
+                   '&segment=customVariableValue1%3D%3Drp&expanded=1',
+    })
+
+
+@pytest.mark.parametrize('response', [
+    {'result': 'error', 'message': 'You can\'t access this resource as it requires a \'view\' access'},
+    [{'value': 5}],
+])
+@patch('requests.Session.post')
+def test_get_bulk_raises_without_a_result_for_each_query(mock_requests_post, response, test_setup_variables, tmpdir):
+    mock_requests_post.return_value.json.return_value = response
+    mock_config = get_mock_config(test_setup_variables)
+    mock_config.PIWIK_CACHE_ENABLED = True
+    mock_config.PIWIK_CACHE_PATH = str(tmpdir)
+    mock_config.PIWIK_CACHE_MAX_SIZE = 1024
+    mock_config.PIWIK_CACHE_TTL = 60
+    piwik_client = piwik.PiwikClient(mock_config)
+    query_strings = [piwik_client.get_nb_visits_for_rp_query_string('2018-07-02', f'customVariableValue1=={rp}')
+                     for rp in ['rp1', 'rp2']]
+
+    with pytest.raises(piwik.PiwikBulkRequestError):
+        piwik_client.get_bulk(query_strings)
+
+    assert tmpdir.listdir() == []
+
+
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_bulk_request_sends_queries_in_batches_and_maps_results_back(mock_get_bulk, test_setup_variables):
+    mock_get_bulk.side_effect = [
+        [{"value": 1}, [{"nb_visits": 2}]],
+        [{"value": 3}],
+    ]
+    bulk_request = piwik.PiwikClient(get_mock_config(test_setup_variables)).bulk_request()
+
+    visits_rp_1 = bulk_request.get_nb_visits_for_rp('test-date', 'segment-1')
+    visits_page = bulk_request.get_nb_visits_for_page('test-date', 'segment-2')
+    visits_rp_3 = bulk_request.get_nb_visits_for_rp('test-date', 'segment-3')
+    bulk_request.send()
+
+    assert mock_get_bulk.call_count == 2
+    assert [visits_rp_1.value, visits_page.value, visits_rp_3.value] == [1, 2, 3]
+
+
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_bulk_request_parses_daily_results_over_a_date_range(mock_get_bulk, test_setup_variables):
+    mock_get_bulk.return_value = [
+        {"2018-07-02": 1, "2018-07-03": 0},
+        {"2018-07-02": [{"nb_visits": 2}], "2018-07-03": []},
+    ]
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables)).for_period('day')
+    bulk_request = piwik_client.bulk_request()
+
+    visits_rp = bulk_request.get_nb_visits_for_rp('2018-07-02,2018-07-03', 'segment-1')
+    visits_page = bulk_request.get_nb_visits_for_page('2018-07-02,2018-07-03', 'segment-2')
+    bulk_request.send()
+
+    assert mock_get_bulk.call_args[0][0][0]['period'] == 'day'
+    assert visits_rp.value == {"2018-07-02": 1, "2018-07-03": 0}
+    assert visits_page.value == {"2018-07-02": 2, "2018-07-03": 0}
+
+
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_bulk_request_raises_on_failed_sub_request(mock_get_bulk, test_setup_variables):
+    mock_get_bulk.return_value = [{"result": "error", "message": "Segment is not supported"}]
+    bulk_request = piwik.PiwikClient(get_mock_config(test_setup_variables)).bulk_request()
+    bulk_request.get_nb_visits_for_rp('test-date', 'bad-segment')
+
+    with pytest.raises(piwik.PiwikBulkRequestError):
+        bulk_request.send()
+
+
+def test_session_retries_transient_failures_with_backoff(test_setup_variables):
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables))
+
+    adapter = piwik_client.session.get_adapter('https://piwik.local')
+    assert adapter._pool_maxsize == 2
+    assert adapter.max_retries.total == 3
+    assert adapter.max_retries.backoff_factor == 0.5
+    assert set(adapter.max_retries.status_forcelist) == {429, 500, 502, 503, 504}
+
+
+@patch('requests.Session.get')
+def test_get_uses_cached_response(mock_requests_get, test_setup_variables, tmpdir):
+    mock_requests_get.return_value.json.return_value = {"value": 5}
+    mock_config = get_mock_config(test_setup_variables)
+    mock_config.PIWIK_CACHE_ENABLED = True
+    mock_config.PIWIK_CACHE_PATH = str(tmpdir)
+    mock_config.PIWIK_CACHE_MAX_SIZE = 1024
+    mock_config.PIWIK_CACHE_TTL = 60
+    piwik_client = piwik.PiwikClient(mock_config)
+
+    assert piwik_client.get_nb_visits_for_rp('2018-07-02', 'segment') == 5
+    assert piwik_client.get_nb_visits_for_rp('2018-07-02', 'segment') == 5
+    assert mock_requests_get.call_count == 1
+
+    piwik_client.bypass_cache = True
+    piwik_client.get_nb_visits_for_rp('2018-07-02', 'segment')
+    assert mock_requests_get.call_count == 2
+
+
+@patch.object(piwik.PiwikClient, 'get_bulk')
+def test_bulk_request_only_sends_uncached_queries(mock_get_bulk, test_setup_variables):
+    mock_get_bulk.return_value = [{"value": 2}]
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables))
+    piwik_client.cache = Mock()
+    piwik_client.cache.get.side_effect = lambda qs: {"value": 1} if qs['segment'] == 'cached' else None
+    bulk_request = piwik_client.bulk_request()
+
+    cached = bulk_request.get_nb_visits_for_rp('test-date', 'cached')
+    uncached = bulk_request.get_nb_visits_for_rp('test-date', 'uncached')
+    bulk_request.send()
+
+    assert (cached.value, uncached.value) == (1, 2)
+    sent_query_strings = mock_get_bulk.call_args[0][0]
+    assert [qs['segment'] for qs in sent_query_strings] == ['uncached']
+
+
+@patch('requests.Session.get')
+def test_get_records_requests_in_run_report(mock_requests_get, test_setup_variables):
+    mock_requests_get.return_value.json.return_value = {"value": 5}
+    mock_requests_get.return_value.content = b'{"value": 5}'
+    piwik_client = piwik.PiwikClient(get_mock_config(test_setup_variables))
+    run_report = metrics.start_run_report()
+
+    piwik_client.get_nb_visits_for_rp('2018-07-02', 'segment')
+    piwik_client.get_nb_visits_for_rp('2018-07-02', 'segment')
+
+    report = run_report.to_dict()
+    assert report['counters'] == {'piwik.requests': 2, 'piwik.bytes_received': 24}
+    assert report['latencies']['piwik.VisitsSummary.getVisits']['count'] == 2
+
+
+@patch('requests.Session.post')
+def test_replay_exchanges_answers_queries_recorded_by_record_exchanges(mock_requests_post, tmpdir):
+    mock_requests_post.return_value.json.return_value = [{"value": 5}]
+    path = str(tmpdir.join('piwik.json.gz'))
+
+    with patch('performance.piwik._piwik_client', None):
+        piwik.record_exchanges(path)
+        bulk_request = piwik.bulk_request()
+        piwik.get_all_signin_attempts_for_rp('RP 1', '2018-07-02', bulk_request)
+        bulk_request.send()
+        piwik.save_recorded_exchanges()
+
+    with patch('performance.piwik._piwik_client', None):
+        piwik.replay_exchanges(path)
+        bulk_request = piwik.bulk_request()
+        result = piwik.get_all_signin_attempts_for_rp('RP 1', '2018-07-02', bulk_request)
+        bulk_request.send()
+
+    assert result.value == 5
+    assert mock_requests_post.call_count == 1
+
+
+def sample_get_custom_variables_response(visits_by_rp):
+    return [
+        {
+            "label": "JOURNEY_TYPE",
+            "nb_visits": 500,
+            "slots": [{"scope": "visit", "index": 3}],
+            "subtable": [{"label": "SIGN_IN", "nb_visits": 500}],
+        },
+        {
+            "label": "RP",
+            "nb_visits": sum(visits_by_rp.values()),
+            "slots": [{"scope": "visit", "index": 1}],
+            "subtable": [{"label": rp, "nb_visits": nb_visits} for rp, nb_visits in visits_by_rp.items()],
+        },
+    ]
+
+
+def test_parse_nb_visits_by_custom_variable_value_reads_the_variable_in_the_slot():
+    raw_result = sample_get_custom_variables_response({'RP 1': 300, 'RP 2': 200})
+
+    assert piwik.parse_nb_visits_by_custom_variable_value(raw_result, slot=1) == {'RP 1': 300, 'RP 2': 200}
+    assert piwik.parse_nb_visits_by_custom_variable_value(raw_result, slot=3) == {'SIGN_IN': 500}
+    assert piwik.parse_nb_visits_by_custom_variable_value(raw_result, slot=2) == {}
+    assert piwik.parse_nb_visits_by_custom_variable_value([], slot=1) == {}
+
+
+@patch('requests.Session.get')
+def test_get_all_attempts_by_rp_queries_custom_variables_for_the_journey_type(mock_requests_get,
+                                                                              test_setup_variables):
+    mock_requests_get.return_value.json.return_value = sample_get_custom_variables_response({'RP 1': 3})
+    mock_config = get_mock_config(test_setup_variables)
+    mock_config.PIWIK_RP_CUSTOM_VARIABLE_SLOT = 1
+
+    visits_by_rp = piwik.get_all_attempts_by_rp('2018-07-02', 'SIGN_IN', piwik.PiwikClient(mock_config))
+
+    assert visits_by_rp == {'RP 1': 3}
+    query_string = mock_requests_get.call_args[1]['params']
+    assert query_string['method'] == 'CustomVariables.getCustomVariables'
+    assert query_string['segment'] == 'customVariableValue3==SIGN_IN'
+    assert query_string['expanded'] == '1'
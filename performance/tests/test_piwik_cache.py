@@ -0,0 +1,89 @@
+import os
+from datetime import date
+from unittest.mock import patch
+
+import pytest
+
+from performance.piwik_cache import PiwikResponseCache, get_period_end, is_closed_period
+
+
+@pytest.mark.parametrize("period,date_string,expected_period_end", [
+    ('day', '2018-07-04', date(2018, 7, 4)),
+    ('week', '2018-07-04', date(2018, 7, 8)),
+    ('week', '2018-07-02', date(2018, 7, 8)),
+    ('month', '2018-02-10', date(2018, 2, 28)),
+    ('year', '2018-02-10', date(2018, 12, 31)),
+    ('range', '2018-07-02,2018-07-10', date(2018, 7, 10)),
+    ('day', '2018-07-02,2018-07-08', date(2018, 7, 8)),
+    ('week', '2018-07-02,2018-07-10', date(2018, 7, 15)),
+    ('week', 'today', None),
+    ('day', 'last7', None),
+])
+def test_get_period_end(period, date_string, expected_period_end):
+    assert get_period_end(period, date_string) == expected_period_end
+
+
+def test_is_closed_period():
+    assert is_closed_period('week', '2018-07-02', today=date(2018, 7, 9))
+    assert not is_closed_period('week', '2018-07-02', today=date(2018, 7, 8))
+    assert not is_closed_period('week', 'today', today=date(2018, 7, 9))
+
+
+def query_string(date_string, segment='segment'):
+    return {
+        'module': 'API',
+        'format': 'JSON',
+        'token_auth': 'secret-token',
+        'method': 'VisitsSummary.getVisits',
+        'idSite': '1',
+        'date': date_string,
+        'period': 'week',
+        'segment': segment,
+        'filter_limit': '-1',
+    }
+
+
+def test_cache_returns_stored_response_and_ignores_token(tmpdir):
+    cache = PiwikResponseCache(str(tmpdir), max_size=1024, ttl=60)
+    cache.set(query_string('2018-07-02'), {'value': 3})
+
+    other_token_query_string = dict(query_string('2018-07-02'), token_auth='other-token')
+
+    assert cache.get(other_token_query_string) == {'value': 3}
+    assert cache.get(query_string('2018-07-02', segment='other')) is None
+    assert 'secret-token' not in ''.join(open(os.path.join(str(tmpdir), f)).read() for f in os.listdir(str(tmpdir)))
+
+
+def test_cache_expires_open_periods_but_not_closed_ones(tmpdir):
+    cache = PiwikResponseCache(str(tmpdir), max_size=1024, ttl=60)
+    closed_query_string = query_string('2018-07-02')
+    open_query_string = query_string(date.today().isoformat())
+    cache.set(closed_query_string, {'value': 1})
+    cache.set(open_query_string, {'value': 2})
+
+    with patch('time.time', return_value=10 ** 12):
+        assert cache.get(closed_query_string) == {'value': 1}
+        assert cache.get(open_query_string) is None
+
+
+def test_cache_evicts_least_recently_used_entries(tmpdir):
+    cache = PiwikResponseCache(str(tmpdir), max_size=120, ttl=60)
+    cache.set(query_string('2018-07-02'), {'value': 1})
+    cache.set(query_string('2018-07-09'), {'value': 2})
+    # Make the first entry the most recently used
+    os.utime(os.path.join(str(tmpdir), cache.key(query_string('2018-07-09')) + '.json'), (0, 0))
+    cache.get(query_string('2018-07-02'))
+
+    cache.set(query_string('2018-07-16'), {'value': 3})
+
+    assert cache.get(query_string('2018-07-09')) is None
+    assert cache.get(query_string('2018-07-02')) == {'value': 1}
+    assert cache.get(query_string('2018-07-16')) == {'value': 3}
+
+
+def test_cache_returns_response_evicted_while_it_was_read(tmpdir):
+    cache = PiwikResponseCache(str(tmpdir), max_size=1024, ttl=60)
+    cache.set(query_string('2018-07-02'), {'value': 3})
+
+    with patch('os.utime', side_effect=FileNotFoundError):
+        assert cache.get(query_string('2018-07-02')) == {'value': 3}
@@ -0,0 +1,38 @@
+from unittest.mock import Mock
+
+import pytest
+
+from performance.piwik_transport import PiwikReplayError, RecordingTransport, ReplayTransport, get_exchange_key
+
+
+def get_query_string(segment, token_auth='token'):
+    return {'module': 'API', 'format': 'JSON', 'token_auth': token_auth, 'idSite': '1', 'date': '2018-07-02',
+            'period': 'week', 'method': 'VisitsSummary.getVisits', 'segment': segment}
+
+
+def test_exchange_key_ignores_auth_token_and_parameter_order():
+    query_string = get_query_string('customVariableValue1==RP 1')
+    reordered = dict(reversed(list(get_query_string('customVariableValue1==RP 1', token_auth='other').items())))
+
+    assert get_exchange_key(query_string) == get_exchange_key(reordered)
+    assert 'token' not in get_exchange_key(query_string)
+
+
+def test_recorded_exchanges_are_replayed(tmpdir):
+    transport = Mock()
+    transport.get.return_value = {'value': 1}
+    transport.get_bulk.return_value = [{'value': 2}, [{'nb_visits': 3}]]
+    path = str(tmpdir.join('piwik.json.gz'))
+    recording_transport = RecordingTransport(transport, path)
+
+    assert recording_transport.get(get_query_string('segment-1')) == {'value': 1}
+    assert recording_transport.get_bulk([get_query_string('segment-2'), get_query_string('segment-3')]) == [
+        {'value': 2}, [{'nb_visits': 3}]]
+    recording_transport.save()
+    replay_transport = ReplayTransport.load(path)
+
+    assert replay_transport.get(get_query_string('segment-2')) == {'value': 2}
+    assert replay_transport.get_bulk([get_query_string('segment-3'), get_query_string('segment-1')]) == [
+        [{'nb_visits': 3}], {'value': 1}]
+    with pytest.raises(PiwikReplayError):
+        replay_transport.get(get_query_string('segment-4'))
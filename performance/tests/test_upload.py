@@ -1,4 +1,8 @@
-from unittest.mock import Mock, ANY
+import hashlib
+import os
+from unittest.mock import Mock, ANY, call
+
+from botocore.exceptions import ClientError
 
 from performance.uploader import Uploader
 
@@ -12,4 +16,78 @@ def test_upload():
     uploader.upload('bucket_name', 'file_name')
 
     aws_resource_mock.Bucket.assert_called_with('bucket_name')
-    bucket.upload_file.assert_called_with('file_name', ANY, ANY)
+    bucket.upload_file.assert_called_with('file_name', ANY, ANY, Config=None)
+
+
+def test_upload_directory_only_uploads_changed_files(tmpdir):
+    week_directory = tmpdir.mkdir('rp_report').mkdir('2018-07-02')
+    week_directory.join('unchanged.csv').write('unchanged')
+    week_directory.join('changed.csv').write('changed')
+    week_directory.join('new.csv').write('new')
+    directory = str(tmpdir.join('rp_report'))
+    heads = {
+        'output/rp/rp_report/2018-07-02/unchanged.csv': {
+            'ETag': f'"{hashlib.md5(b"unchanged").hexdigest()}"', 'ContentLength': 9},
+        'output/rp/rp_report/2018-07-02/changed.csv': {
+            'ETag': f'"{hashlib.md5(b"old").hexdigest()}"', 'ContentLength': 3},
+    }
+
+    def head_object(Bucket, Key):
+        if Key not in heads:
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        return heads[Key]
+
+    aws_resource_mock = Mock()
+    aws_resource_mock.meta.client.head_object.side_effect = head_object
+    bucket = aws_resource_mock.Bucket.return_value
+    transfer_config = Mock()
+    uploader = Uploader(aws_resource_mock, transfer_config, max_concurrent_uploads=2)
+
+    uploaded = uploader.upload_directory('bucket_name', directory)
+
+    changed_file = os.path.join(directory, '2018-07-02', 'changed.csv')
+    new_file = os.path.join(directory, '2018-07-02', 'new.csv')
+    assert uploaded == [changed_file, new_file]
+    bucket.upload_file.assert_has_calls([
+        call(changed_file, 'output/rp/rp_report/2018-07-02/changed.csv', {'ServerSideEncryption': 'AES256'},
+             Config=transfer_config),
+        call(new_file, 'output/rp/rp_report/2018-07-02/new.csv', {'ServerSideEncryption': 'AES256'},
+             Config=transfer_config),
+    ], any_order=True)
+    assert bucket.upload_file.call_count == 2
+
+
+def test_upload_directory_gives_the_same_keys_however_the_directory_is_given(tmpdir, monkeypatch):
+    tmpdir.mkdir('rp_report').mkdir('2018-07-02').join('report.csv').write('content')
+    monkeypatch.chdir(tmpdir)
+    aws_resource_mock = Mock()
+    aws_resource_mock.meta.client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+    bucket = aws_resource_mock.Bucket.return_value
+    uploader = Uploader(aws_resource_mock)
+
+    for directory in [str(tmpdir.join('rp_report')), 'rp_report', './rp_report/', f'{tmpdir}//rp_report']:
+        uploader.upload_directory('bucket_name', directory)
+
+    assert [args[1] for args, _ in bucket.upload_file.call_args_list] == [
+        'output/rp/rp_report/2018-07-02/report.csv'] * 4
+
+
+def test_upload_directory_skips_hidden_temporary_and_internal_files(tmpdir):
+    week_directory = tmpdir.mkdir('rp_report').mkdir('2018-07-02')
+    for file_name in ['report.csv', '.report.csv.partial', 'report.tmp', 'manifest.json', 'run_report.json']:
+        week_directory.join(file_name).write('content')
+    tmpdir.join('rp_report', '2018-07-02_2018-07-16-run_report.json').write('content')
+    directory = str(tmpdir.join('rp_report'))
+    aws_resource_mock = Mock()
+    aws_resource_mock.meta.client.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+    uploader = Uploader(aws_resource_mock)
+
+    assert uploader.upload_directory('bucket_name', directory) == [
+        os.path.join(directory, '2018-07-02', 'report.csv'),
+    ]
+    assert uploader.upload_directory('bucket_name', directory, include_internal=True) == [
+        os.path.join(directory, '2018-07-02', 'manifest.json'),
+        os.path.join(directory, '2018-07-02', 'report.csv'),
+        os.path.join(directory, '2018-07-02', 'run_report.json'),
+        os.path.join(directory, '2018-07-02_2018-07-16-run_report.json'),
+    ]
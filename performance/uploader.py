@@ -1,18 +1,114 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from performance.aws import file_matches_etag
+from performance.metrics import RUN_REPORT_FILE_NAME
+
+UPLOAD_EXTRA_ARGS = {'ServerSideEncryption': 'AES256'}
+# Files the reports keep for themselves next to their output: the manifest written by performance.reports.manifest
+# and the run reports
+INTERNAL_FILE_NAMES = ('manifest.json', RUN_REPORT_FILE_NAME)
+INTERNAL_FILE_SUFFIXES = (f'-{RUN_REPORT_FILE_NAME}',)
+
+
+def is_uploadable(file_name, include_internal=False):
+    """
+    Whether a file found in a directory being uploaded should be uploaded. Hidden and temporary files, such as those
+    still being written, never are.
+
+    Args:
+        file_name: Base name of the file.
+        include_internal: Whether to upload the reports' manifests and run reports too.
+    """
+    if file_name.startswith('.') or file_name.endswith('.tmp'):
+        return False
+    return include_internal or not (file_name in INTERNAL_FILE_NAMES or file_name.endswith(INTERNAL_FILE_SUFFIXES))
+
+
 class Uploader:
-    def __init__(self, resource):
+    def __init__(self, resource, transfer_config=None, max_concurrent_uploads=1):
         """
         Args:
             resource: AWS S3 resource object.
+            transfer_config: boto3.s3.transfer.TransferConfig for multipart uploads, or None for boto3's defaults.
+            max_concurrent_uploads: Number of files to upload at once when uploading a directory.
         """
         self._resource = resource
+        self._transfer_config = transfer_config
+        self._max_concurrent_uploads = max_concurrent_uploads
+
+    @staticmethod
+    def get_key(file_name):
+        return f'output/rp/{file_name}'
 
-    def upload(self, bucket_name, file_name):
+    def upload(self, bucket_name, file_name, key_name=None):
         """
         Upload a file given by its name to an S3 bucket.
 
         Args:
             bucket_name: Name of the bucket to upload the file to.
             file_name: Name of the file to upload.
+            key_name: Name to give the file's key, by default `file_name`.
         """
         bucket = self._resource.Bucket(bucket_name)
-        bucket.upload_file(file_name, f'output/rp/{file_name}', {'ServerSideEncryption': 'AES256'})
+        bucket.upload_file(
+            file_name, self.get_key(key_name or file_name), UPLOAD_EXTRA_ARGS, Config=self._transfer_config)
+
+    def is_uploaded(self, bucket_name, file_name, key_name=None):
+        """
+        Check whether a file's content has already been uploaded to an S3 bucket, by comparing it with the ETag of
+        its object.
+
+        Args:
+            bucket_name: Name of the bucket the file would be uploaded to.
+            file_name: Name of the file.
+            key_name: Name the file's key would have, by default `file_name`.
+        """
+        try:
+            head = self._resource.meta.client.head_object(Bucket=bucket_name, Key=self.get_key(key_name or file_name))
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return False
+            raise
+        return head['ContentLength'] == os.path.getsize(file_name) and file_matches_etag(file_name, head['ETag'])
+
+    def sync_file(self, bucket_name, file_name, key_name=None):
+        if self.is_uploaded(bucket_name, file_name, key_name):
+            logging.info(f'Skipping unchanged {file_name}')
+            return False
+        self.upload(bucket_name, file_name, key_name)
+        logging.info(f'Uploaded {file_name}')
+        return True
+
+    def upload_directory(self, bucket_name, directory, include_internal=False):
+        """
+        Upload every file under a directory to an S3 bucket, skipping files which are unchanged since they were last
+        uploaded and those `is_uploadable` rules out. Each file's key is named after its path from the directory's
+        parent, e.g. `output/rp/rp_report/2018-07-02/report.csv`, however the directory's path is given.
+
+        Args:
+            bucket_name: Name of the bucket to upload the files to.
+            directory: Path of the directory to upload.
+            include_internal: Whether to upload the reports' manifests and run reports too.
+
+        Returns:
+            List of the names of the files that were uploaded.
+        """
+        file_names = sorted(
+            os.path.join(dir_path, file_name)
+            for dir_path, _, file_names in os.walk(directory)
+            for file_name in file_names
+            if is_uploadable(file_name, include_internal)
+        )
+        parent_directory = os.path.dirname(os.path.abspath(directory))
+
+        def sync_file(file_name):
+            key_name = os.path.relpath(file_name, parent_directory).replace(os.sep, '/')
+            return self.sync_file(bucket_name, file_name, key_name)
+
+        with ThreadPoolExecutor(max_workers=self._max_concurrent_uploads) as executor:
+            uploaded = list(executor.map(sync_file, file_names))
+        return [file_name for file_name, was_uploaded in zip(file_names, uploaded) if was_uploaded]